@@ -1,55 +1,283 @@
+from aqi import AqiEngine
 from btserver import BTServer
-from btserver import BTError
-from sensor import SensorServer
+from history import BlockSummaries, HistoryArchive, HistoryArchiver, HistoryCache, HourlySketches, open_storage
+from history import decode_token, downsample, encode_history, scale_range, scale_time
+from metrics import Metrics
+from realtime import FrameCache, RealtimeBroadcaster, parse_deadbands
+from sensor import DEFAULT_CHANNEL_MAP, ReplayServer, SensorProcess, SensorServer, get_channel_names, get_source_columns
+from sensor import open_source, parse_channel_map
+from uplink import Uplink
 
 import argparse
 import asyncore
 import json
 import logging
+import socket
 import sqlite3
+from itertools import chain
 from threading import Thread
 from time import gmtime, sleep, strftime, time
 
 logger = logging.getLogger(__name__)
 
 
+def split_payload(payload, chunk_size=256):
+    # Split an encoded payload into chunks that fit in the quantum of the link scheduler
+    for i in xrange(0, len(payload), chunk_size):
+        yield payload[i:i + chunk_size]
+
+
+def cache_lines(lines, history_cache, start_time, end_time, history_format):
+    # Yield the lines of a history transfer, and cache the whole response once all of them have been generated
+    h_lines = []
+    for line in lines:
+        h_lines.append(line)
+        yield line
+    history_cache.put(start_time, end_time, history_format, "".join(h_lines))
+
+
+def read_history(history_archive, history_storage, start_time, end_time):
+    # Rows older than the retention period live in the archive, so read them from there first. Rows we already got from
+    # the archive are skipped in the storage, in case the archiver was interrupted before deleting them.
+    storage_start_time = start_time
+    if history_archive is not None:
+        for row in history_archive.read_range(start_time, end_time):
+            storage_start_time = row[0] + 1
+            yield row
+
+    rows = iter(history_storage.query(storage_start_time, end_time))
+    first_row = next(rows, None)
+    last_time = storage_start_time - 1
+    if history_archive is not None:
+        # The archiver runs in a thread of its own, and may have moved a day from the storage to the archive after the
+        # archive was read that far. It writes the day file before deleting the rows, so the rows older than the oldest
+        # stored row once the query has started are all in the archive: read the ones we missed from there.
+        first_time = history_storage.get_first_time()
+        archive_end_time = end_time if first_time is None else min(end_time, first_time - 1)
+        for row in history_archive.read_range(storage_start_time, archive_end_time):
+            last_time = row[0]
+            yield row
+
+    # A storage query that started before the deletion still returns the rows read again from the archive
+    if first_row is not None and first_row[0] > last_time:
+        yield first_row
+    for row in rows:
+        if row[0] > last_time:
+            yield row
+
+
 if __name__ == '__main__':
     # Create option parser
     usage = "usage: %prog [options] arg"
     parser = argparse.ArgumentParser()
     parser.add_argument("--output", dest="output_format", default="csv",
-                        help="set output format: csv, json")
+                        help="set default output format of real-time frames: csv, json, binary")
     parser.add_argument("--database", dest="database_name", default="air_pollution_data.db",
-                        help="specify database file")
+                        help="specify database file, or directory for the segment storage engine")
+    parser.add_argument("--storage", dest="storage_engine", default="sqlite",
+                        help="set history storage engine: sqlite, segment")
+    parser.add_argument("--timestamps", dest="timestamps", default="s",
+                        help="set time resolution of a new database: s, ms; existing databases keep their own")
+    parser.add_argument("--sample-period", dest="sample_period", default="2.4",
+                        help="specify time between the starts of two rounds of sensor readings in seconds")
+    parser.add_argument("--settle-time", dest="settle_time", default="0.05",
+                        help="specify time the MUX output takes to settle before each ADC reading in seconds")
+    parser.add_argument("--channel-map", dest="channel_map", default=DEFAULT_CHANNEL_MAP,
+                        help="specify ADC input and MUX channel of each of the 12 sensor channels, such as 'A0.0,A1.0,"
+                             "A0.1,A1.1,...' for two MUXes sharing the select lines, or 'A2' for an input without MUX")
+    parser.add_argument("--overrun", dest="overrun_policy", default="skip",
+                        help="set what to do when a round of sensor readings overruns its period: skip the missed "
+                             "samples, or compress the following periods to catch up")
+    parser.add_argument("--motion-rate", dest="motion_rate", default="0",
+                        help="specify rate in Hz at which the onboard motion sensors are polled, 0 to not record them")
+    parser.add_argument("--onboard-sensors", dest="onboard_sensors", action="store_true",
+                        help="record the onboard temperature and pressure in every round of sensor readings")
+    parser.add_argument("--deadband", dest="deadband", default="",
+                        help="set per-channel deadbands of the delta real-time mode, such as 'PM25=0.5,NO2=1'")
+    parser.add_argument("--keyframe-interval", dest="keyframe_interval", default="20",
+                        help="specify number of delta real-time frames between keyframes")
+    parser.add_argument("--acquisition-process", dest="acquisition_process", action="store_true",
+                        help="read sensors in a separate process that shares samples through shared memory")
+    parser.add_argument("--record-trace", dest="record_trace", default="",
+                        help="specify file the raw ADC readings are recorded to, gzip-compressed if it ends with .gz")
+    parser.add_argument("--replay", dest="replay", default="",
+                        help="specify trace (.csv or .csv.gz) or history database to replay instead of reading sensors")
+    parser.add_argument("--replay-speed", dest="replay_speed", default="1",
+                        help="specify how many times faster than recorded to replay; 0 replays as fast as possible")
     parser.add_argument("--baud-rate", dest="baud_rate", default="115200",
                         help="specify Bluetooth baud rate in bps")
+    parser.add_argument("--backlog", dest="backlog", default="1",
+                        help="specify number of pending Bluetooth connections")
+    parser.add_argument("--max-clients", dest="max_clients", default="0",
+                        help="specify maximum number of connected clients, 0 for no limit")
+    parser.add_argument("--history-cache-size", dest="history_cache_size", default="1048576",
+                        help="specify the size of the history response cache in bytes, 0 to disable it")
+    parser.add_argument("--retention-days", dest="retention_days", default="0",
+                        help="specify number of days raw rows stay in the database before being archived, 0 to keep "
+                             "them forever")
+    parser.add_argument("--archive-dir", dest="archive_dir", default="archive",
+                        help="specify directory of the compressed per-day archive files")
+    parser.add_argument("--uplink-url", dest="uplink_url", default="",
+                        help="specify HTTP endpoint the history is forwarded to, empty to keep it on the board")
+    parser.add_argument("--uplink-interval", dest="uplink_interval", default="60",
+                        help="specify number of seconds between two uploads once the backlog is sent")
+    parser.add_argument("--uplink-batch", dest="uplink_batch", default="1000",
+                        help="specify maximum number of rows per upload")
+    parser.add_argument("--station", dest="station", default=socket.gethostname(),
+                        help="specify name of this board in the uploads")
 
     args = parser.parse_args()
+    if args.replay and args.acquisition_process:
+        parser.error("--replay cannot be combined with --acquisition-process")
+
+    # Source of the samples replayed instead of those of the sensors
+    replay_source = None
+    if args.replay:
+        try:
+            replay_source = open_source(args.replay, args.storage_engine)
+        except (IOError, ValueError, sqlite3.Error) as e:
+            parser.error("cannot replay {}: {}".format(args.replay, e))
+
+    # Metrics shared by all the servers
+    metrics = Metrics()
+
+    # Deadbands of the real-time clients in delta mode
+    deadbands = parse_deadbands(args.deadband)
+
+    # ADC inputs and MUX channels the sensor channels are wired to
+    channel_map = parse_channel_map(args.channel_map)
+
+    # Cache of encoded history responses for ranges that will not change anymore
+    history_cache = HistoryCache(max_bytes=int(args.history_cache_size), metrics=metrics)
 
     # Create a BT server
     uuid = "94f39d29-7d6d-437d-973b-fba39e49d4ee"
     bt_service_name = "Air Pollution Sensor"
-    bt_server = BTServer(uuid, bt_service_name)
+    bt_server = BTServer(uuid, bt_service_name, backlog=int(args.backlog), max_clients=int(args.max_clients),
+                         baud_rate=int(args.baud_rate), metrics=metrics)
+    bt_server.scheduler.start()
+
+    # Fan-out of the real-time frames to the subscribed clients
+    broadcaster = RealtimeBroadcaster(bt_server.scheduler, default_format=args.output_format, deadbands=deadbands,
+                                      keyframe_interval=int(args.keyframe_interval), metrics=metrics)
 
     # Create BT server thread and run it
     bt_server_thread = Thread(target=asyncore.loop, name="BT Server Thread")
     bt_server_thread.daemon = True
     bt_server_thread.start()
 
-    # Create sensor server thread and run it
-    sensor_server = SensorServer(database_name=args.database_name)
-    sensor_server.daemon = True
-    sensor_server.start()
+    # Time resolution of the database in time units per second: whole seconds, or milliseconds for sub-second sampling
+    resolution = 1000 if args.timestamps == "ms" else 1
 
-    # Create database connection and retrieve its cursor
+    # Create the database if it does not exist yet, and open the history storage for reading. An existing database keeps
+    # the resolution it was created with, so the old ones stay in whole seconds.
+    # The motion and onboard channels are added to the history, existing databases included, when they are recorded
+    motion_rate = float(args.motion_rate)
+    value_columns = get_channel_names(motion_rate > 0, args.onboard_sensors)
+    if replay_source is not None:
+        value_columns = get_source_columns(replay_source)
+    history_storage = None
     try:
-        db_conn = sqlite3.connect(args.database_name)
-        db_cur = db_conn.cursor()
+        open_storage(args.storage_engine, args.database_name, value_columns, writable=True,
+                     resolution=resolution).close()
+        history_storage = open_storage(args.storage_engine, args.database_name, value_columns)
+        resolution = history_storage.resolution
     except Exception as e:
-        logger.error("Error connecting the database {}, reason: {}".format(args.database_name, e.message))
+        logger.error("Error connecting the database {}, reason: {}".format(args.database_name, repr(e)))
+
+    # Per-block summaries of the history for clients that synchronize their own cache, one block per hour
+    block_summaries = BlockSummaries(args.database_name.rstrip("/") + ".blocks", block_seconds=3600 * resolution,
+                                     resolution=resolution, metrics=metrics)
+
+    # Per-hour quantile sketches of every channel for percentile queries, saved next to the history as well
+    hourly_sketches = HourlySketches(args.database_name.rstrip("/") + ".sketches", value_columns,
+                                     block_seconds=3600 * resolution, metrics=metrics)
+
+    # Rolling means of the air quality index, updated with every sample
+    aqi_engine = AqiEngine(value_columns, resolution)
+
+    # Create sensor server thread, or process, whose samples are then read from shared memory. A replay server feeds
+    # the recorded samples through the same calibration, storage, analytics and broadcast, keeping their time stamps.
+    trace_path = args.record_trace or None
+    if replay_source is not None:
+        sensor_server = ReplayServer(replay_source, speed=float(args.replay_speed), database_name=args.database_name,
+                                     storage_engine=args.storage_engine, block_summaries=block_summaries,
+                                     resolution=resolution, metrics=metrics, aqi_engine=aqi_engine,
+                                     sketches=hourly_sketches)
+    elif args.acquisition_process:
+        sensor_server = SensorProcess(database_name=args.database_name, storage_engine=args.storage_engine,
+                                      resolution=resolution, period=float(args.sample_period),
+                                      settle_time=float(args.settle_time), overrun_policy=args.overrun_policy,
+                                      motion_rate=motion_rate, onboard=args.onboard_sensors, channel_map=channel_map,
+                                      trace_path=trace_path)
+    else:
+        sensor_server = SensorServer(database_name=args.database_name, storage_engine=args.storage_engine,
+                                     block_summaries=block_summaries, resolution=resolution,
+                                     period=float(args.sample_period), settle_time=float(args.settle_time),
+                                     overrun_policy=args.overrun_policy, metrics=metrics, motion_rate=motion_rate,
+                                     onboard=args.onboard_sensors, channel_map=channel_map, aqi_engine=aqi_engine,
+                                     sketches=hourly_sketches, trace_path=trace_path)
+    sensor_server.daemon = True
+
+    # Create the archiver thread that moves old rows into the cold archive
+    history_archive = None
+    history_archiver = None
+    if int(args.retention_days) > 0:
+        history_archive = HistoryArchive(args.archive_dir, resolution)
+        history_archiver = HistoryArchiver(args.storage_engine, args.database_name, sensor_server.sensor_names,
+                                           history_archive, int(args.retention_days), metrics=metrics)
+        history_archiver.daemon = True
+
+    # Create the uplink thread that forwards the history to the central endpoint
+    uplink = None
+    if args.uplink_url:
+        uplink = Uplink(args.uplink_url, args.storage_engine, args.database_name, sensor_server.sensor_names,
+                        args.station, archive=history_archive, batch_rows=int(args.uplink_batch),
+                        interval=int(args.uplink_interval), resolution=resolution, metrics=metrics)
+        uplink.daemon = True
+
+    # Bring the block summaries up to date with the rows written since the last saved block, before any thread starts
+    # moving or inserting rows
+    if history_storage is not None:
+        last_time = history_storage.get_last_time()
+        if last_time is not None:
+            block_summaries.rebuild(read_history(history_archive, history_storage,
+                                                 block_summaries.get_saved_time() or 0, last_time))
+            hourly_sketches.rebuild(read_history(history_archive, history_storage,
+                                                 hourly_sketches.get_saved_time() or 0, last_time))
+            aqi_engine.rebuild(read_history(history_archive, history_storage, last_time - aqi_engine.window + 1,
+                                            last_time))
+
+    # Run the sensor server, archiver and uplink threads
+    sensor_server.start()
+    if history_archiver is not None:
+        history_archiver.start()
+    if uplink is not None:
+        uplink.start()
 
     while True:
         msg = ""
+        if args.acquisition_process:
+            # The sensor process cannot update the block summaries, sketches and AQI of this process, so add the rows
+            # it committed
+            rows, complete = sensor_server.get_new_rows()
+            if complete:
+                for row in rows:
+                    block_summaries.add(row)
+                    hourly_sketches.add(row)
+                    aqi_engine.add(row)
+            elif history_storage is not None:
+                logger.warn("Missed samples of the sensor process, rebuilding block summaries...")
+                print "WARN: Missed samples of the sensor process, rebuilding block summaries..."
+                last_commit_time = sensor_server.get_last_commit_time()
+                block_summaries.rebuild(read_history(history_archive, history_storage,
+                                                     (block_summaries.last_time or 0) + 1, last_commit_time))
+                hourly_sketches.rebuild(read_history(history_archive, history_storage,
+                                                     (hourly_sketches.last_time or 0) + 1, last_commit_time))
+                aqi_engine.rebuild(read_history(history_archive, history_storage,
+                                                max((aqi_engine.last_time or 0) + 1,
+                                                    last_commit_time - aqi_engine.window + 1), last_commit_time))
+
         sensor_output = sensor_server.get_sensor_output()
         epoch_time = int(time())                    # epoch time
         temp = sensor_output.get('Temp', -1)
@@ -58,29 +286,58 @@ if __name__ == '__main__':
         SN3 = sensor_output.get('CO', -1)
         SN4 = sensor_output.get('SO2', -1)
         PM25 = sensor_output.get('PM25', -1)
+        aqi = aqi_engine.snapshot()
+
+        # Frames of this sample are encoded once per distinct subscription, and shared by the clients. The time of the
+        # sample is in the resolution of the database.
+        sample = {'time': sensor_output.get('time', int(time() * resolution)),
+                  'temp': temp,
+                  'SN1': SN1,
+                  'SN2': SN2,
+                  'SN3': SN3,
+                  'SN4': SN4,
+                  'PM25': PM25,
+                  'AQI': -1 if aqi['aqi'] is None else aqi['aqi']}
+        for name in ('PM25', 'OX', 'CO', 'NO2', 'SO2'):
+            sub_index = aqi['sub_indices'].get(name)
+            sample['AQI_' + name] = -1 if sub_index is None else sub_index
+        frame_cache = FrameCache(sample, metrics=metrics, resolution=resolution)
+
+        # Forget the delta encoding state of the clients that are gone
+        active_client_handlers = bt_server.get_active_client_handlers()
+        broadcaster.forget(active_client_handlers)
 
-        r_msg = ""
-        if args.output_format == "csv":
-            # Create CSV message "'real-time', time, temp, SN1, SN2, SN3, SN4, PM25".
-            r_msg = "{},{},{},{},{},{},{}".format(epoch_time, temp, SN1, SN2, SN3, SN4, PM25)
-        elif args.output_format == "json":
-            # Create JSON message.
-            output = {'time': epoch_time,
-                      'temp': temp,
-                      'SN1': SN1,
-                      'SN2': SN2,
-                      'SN3': SN3,
-                      'SN4': SN4,
-                      'PM25': PM25}
-            r_msg = json.dumps(output)
-
-        for client_handler in bt_server.get_active_client_handlers():
+        for client_handler in active_client_handlers:
             # Use a copy() to get the copy of the set, avoiding 'set change size during iteration' error.
+            # Times of the commands and of the responses are in the resolution the client asked for
+            client_resolution = client_handler.sending_status.get('resolution')
             if client_handler.sending_status.get('history')[0]:
                 start_time = client_handler.sending_status.get('history')[1]
                 end_time = client_handler.sending_status.get('history')[2]
-                fmt_start_time = strftime("%Y-%m-%d %H:%M:%S", gmtime(start_time))
-                fmt_end_time = strftime("%Y-%m-%d %H:%M:%S", gmtime(end_time))
+                max_points = client_handler.sending_status.get('history')[3]
+                token = client_handler.sending_status.get('history')[4]
+
+                # A resumed transfer continues after the last row of the token, with the CRC of what was sent so far.
+                # Tokens are in the resolution of the database.
+                resume_time = None
+                crc = 0
+                if token is None:
+                    start_time, end_time = scale_range(start_time, end_time, client_resolution, resolution)
+                else:
+                    try:
+                        start_time, end_time, max_points, resume_time, crc = decode_token(token)
+                    except ValueError as e:
+                        logger.warn("{}, skipping...".format(e))
+                        print "WARN: {}, skipping...".format(e)
+                        bt_server.scheduler.send_bulk(client_handler, ["h\n"])
+                        client_handler.sending_status['history'] = [False, -1, -1, 0, None]
+                        continue
+                # Downsampled responses are cached apart from full-resolution ones
+                history_format = "csv" if max_points == 0 else "csv/{}".format(max_points)
+                if client_resolution != 1:
+                    history_format += "@{}".format(client_resolution)
+                fmt_start_time = strftime("%Y-%m-%d %H:%M:%S", gmtime(start_time // resolution))
+                fmt_end_time = strftime("%Y-%m-%d %H:%M:%S", gmtime(end_time // resolution))
 
                 logger.info("Client requests history between {} and {}".format(fmt_start_time, fmt_end_time))
                 print "INFO: Client requests history between {} and {}".format(fmt_start_time, fmt_end_time)
@@ -91,49 +348,105 @@ if __name__ == '__main__':
                                 .format(fmt_start_time, fmt_end_time))
                     print "WARN: Start time {} is greater than end time {}, skipping..."\
                         .format(fmt_start_time, fmt_end_time)
-                elif db_cur is None:
+                    # Send end-of-message indicator
+                    bt_server.scheduler.send_bulk(client_handler, ["h\n"])
+                elif history_storage is None:
                     logger.error("SQL database {} is not available, skipping...".format(args.database_name))
                     print "ERROR: SQL database {} is not available, skipping...".format(args.database_name)
+                    # Send end-of-message indicator
+                    bt_server.scheduler.send_bulk(client_handler, ["h\n"])
                 else:
-                    # If start time is smaller than or equal to end time AND SQL database is available, do SQL query
-                    # from the database.
-                    db_cur.execute("SELECT * FROM history WHERE time >= {} AND time <= {}".format(start_time, end_time))
-                    # Get the result
-                    results = db_cur.fetchall()
-                    n = len(results)
-
-                    logger.info("Number of data points in the results is {}, sending them at {} bps"
-                                .format(n, args.baud_rate))
-                    print "INFO: Number of data points in the results is {}, sending them at {} bps"\
-                        .format(n, args.baud_rate)
-
-                    i = 0
-                    print "INFO: Sending results (0/0)...\r",
-                    for row in results:
-                        i += 1
-                        h_msg = "{},{},{},{},{},{},{}".format(row[0], row[1], row[2], row[3], row[4], row[5], row[6])
-                        client_handler.send('h' + h_msg + '\n')
-
-                        print "INFO: Sending results ({}/{})...\r".format(i, n),
-                        # A character is 8-bit long, so the whole string has (len(h_msg) + 2) * 8 bits; the default
-                        # baud rate for HC-05 standard is 9600, so the time for the Bluetooth socket to process the
-                        # string is (len(h_msg) + 2) * 8 / args.baud_rate; we add 10% margin to this time and wait for
-                        # such a long time before we send the next row.
-                        sleep(((len(h_msg) + 2) * 8 * 1.1 / int(args.baud_rate)))
+                    # The buckets of a downsampled range depend on the rows in it, so a range that is still open is
+                    # closed at its newest committed row. Its tokens then carry a range that no longer changes, and a
+                    # resumed transfer picks the same points as the interrupted one.
+                    if max_points > 0 and resume_time is None:
+                        newest_time = history_storage.get_last_time()
+                        if newest_time is not None and start_time <= newest_time < end_time:
+                            end_time = newest_time
+                    # Rows older than the newest committed sample never change, so the response of a range that ends
+                    # before it can be served from and saved to the cache.
+                    cacheable = end_time < sensor_server.get_last_commit_time() and resume_time is None
+                    payload = history_cache.get(start_time, end_time, history_format) if cacheable else None
 
-                    # Send end-of-message indicator
-                    print "\nINFO: Done"
-                    client_handler.send("h\n")
+                    if payload is not None:
+                        logger.info("Sending {} cached bytes at {} bps".format(len(payload), args.baud_rate))
+                        print "INFO: Sending {} cached bytes at {} bps".format(len(payload), args.baud_rate)
+                        lines = split_payload(payload)
+                    else:
+                        # If start time is smaller than or equal to end time AND SQL database is available, do SQL
+                        # query from the database.
+                        if max_points > 0:
+                            # Stream the range through the downsampler, so only max_points rows are kept in memory. A
+                            # resumed transfer runs the downsampler again over the closed range of its token, and skips
+                            # the rows that were already sent.
+                            rows = read_history(history_archive, history_storage, start_time, end_time)
+                            results = [row for row in downsample(rows, start_time, end_time, max_points)
+                                       if resume_time is None or row[0] > resume_time]
+                        else:
+                            results = list(read_history(history_archive, history_storage,
+                                                        start_time if resume_time is None else resume_time + 1,
+                                                        end_time))
+                        n = len(results)
+
+                        logger.info("Number of data points in the results is {}, sending them at {} bps"
+                                    .format(n, args.baud_rate))
+                        print "INFO: Number of data points in the results is {}, sending them at {} bps"\
+                            .format(n, args.baud_rate)
+
+                        # The lines are encoded lazily by the link scheduler, which shares the link with the other
+                        # clients and paces the writes to the baud rate.
+                        lines = encode_history(results, start_time, end_time, max_points, crc, resolution=resolution,
+                                               client_resolution=client_resolution)
+                        if cacheable:
+                            lines = cache_lines(lines, history_cache, start_time, end_time, history_format)
+
+                    # Send end-of-message indicator after the rows
+                    bt_server.scheduler.send_bulk(client_handler, chain(lines, ["h\n"]))
 
                 # Reset history status
-                client_handler.sending_status['history'] = [False, -1, -1]
+                client_handler.sending_status['history'] = [False, -1, -1, 0, None]
+            elif client_handler.sending_status.get('sync')[0]:
+                start_time, end_time = scale_range(client_handler.sending_status.get('sync')[1],
+                                                   client_handler.sending_status.get('sync')[2],
+                                                   client_resolution, resolution)
+
+                # Add the leading character 's' to each block summary, and end with an empty 's' line. The client
+                # compares them with its cache and requests the blocks that differ with the 'history' command.
+                s_lines = ["s{},{},{:08x}\n".format(scale_time(block, resolution, client_resolution), count, crc)
+                           for block, count, crc in block_summaries.get(start_time, end_time, client_resolution)]
+                s_lines.append("s\n")
+                bt_server.scheduler.send_bulk(client_handler, s_lines)
+
+                client_handler.sending_status['sync'] = [False, -1, -1]
+            elif client_handler.sending_status.get('metrics'):
+                # Add the leading character 'm' to indicate it is a metrics snapshot
+                bt_server.scheduler.send_bulk(client_handler, ['m' + json.dumps(metrics.snapshot()) + '\n'])
+                client_handler.sending_status['metrics'] = False
+            elif client_handler.sending_status.get('percentile')[0]:
+                _, name, start_time, end_time, q = client_handler.sending_status.get('percentile')
+                start_time, end_time = scale_range(start_time, end_time, client_resolution, resolution)
+
+                # Answer 'p<channel>,<q>,<value>,<number of samples>', with no value if the range has no sample
+                channel = hourly_sketches.get_channel(name)
+                if channel is None:
+                    logger.warn("Unknown channel {} in percentile request, skipping...".format(name))
+                    print "WARN: Unknown channel {} in percentile request, skipping...".format(name)
+                    sketch = None
+                else:
+                    sketch = hourly_sketches.get(channel, start_time, end_time)
+                value = None if sketch is None else sketch.quantile(q / 100.0)
+                bt_server.scheduler.send_bulk(client_handler, ["p{},{},{},{}\n".format(
+                    name, q, "" if value is None else value, 0 if sketch is None else sketch.count)])
+                client_handler.sending_status['percentile'] = [False, None, -1, -1, 0.0]
+            elif client_handler.sending_status.get('aqi'):
+                # Add the leading character 'a' to indicate it is an AQI snapshot, with its time in the resolution of
+                # the client
+                snapshot = aqi
+                if aqi['time'] is not None:
+                    snapshot = dict(aqi, time=scale_time(aqi['time'], resolution, client_resolution))
+                bt_server.scheduler.send_bulk(client_handler, ['a' + json.dumps(snapshot) + '\n'])
+                client_handler.sending_status['aqi'] = False
             elif client_handler.sending_status.get('real-time'):
-                try:
-                    # Add the leading character 'r' to indicate its a real-time data, and a newline character '\n'
-                    # to indicate the end of the line
-                    client_handler.send('r' + r_msg + '\n')
-                except Exception as e:
-                    BTError.print_error(handler=client_handler, error=BTError.ERR_WRITE, error_message=repr(e))
-                    client_handler.handle_close()
+                broadcaster.send(client_handler, frame_cache, epoch_time)
         # Sleep for 3 seconds
         sleep(3)
@@ -0,0 +1,2 @@
+from breakpoints import CATEGORIES, POLLUTANTS, get_category, get_sub_index
+from engine import AqiEngine, RollingMean
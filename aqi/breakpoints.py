@@ -0,0 +1,44 @@
+import math
+
+# AQI categories of the US EPA, by upper index
+CATEGORIES = [(50, "Good"), (100, "Moderate"), (150, "Unhealthy for Sensitive Groups"), (200, "Unhealthy"),
+              (300, "Very Unhealthy"), (500, "Hazardous")]
+
+# Pollutants of the index: history channel, averaging window in hours, factor from the unit of the channel to the unit
+# of the breakpoints, number of decimals the concentration is truncated to, and breakpoints (low concentration, high
+# concentration, low index, high index) of the US EPA (40 CFR 58 appendix G, PM2.5 as revised in 2024). The OX sensor
+# stands in for ozone.
+POLLUTANTS = [
+    ('PM25', 24, 1.0, 1, [(0.0, 9.0, 0, 50), (9.1, 35.4, 51, 100), (35.5, 55.4, 101, 150), (55.5, 125.4, 151, 200),
+                          (125.5, 225.4, 201, 300), (225.5, 325.4, 301, 500)]),
+    ('OX', 8, 0.001, 3, [(0.000, 0.054, 0, 50), (0.055, 0.070, 51, 100), (0.071, 0.085, 101, 150),
+                         (0.086, 0.105, 151, 200), (0.106, 0.200, 201, 300)]),
+    ('CO', 8, 0.001, 1, [(0.0, 4.4, 0, 50), (4.5, 9.4, 51, 100), (9.5, 12.4, 101, 150), (12.5, 15.4, 151, 200),
+                         (15.5, 30.4, 201, 300), (30.5, 50.4, 301, 500)]),
+    ('NO2', 1, 1.0, 0, [(0, 53, 0, 50), (54, 100, 51, 100), (101, 360, 101, 150), (361, 649, 151, 200),
+                        (650, 1249, 201, 300), (1250, 2049, 301, 500)]),
+    ('SO2', 1, 1.0, 0, [(0, 35, 0, 50), (36, 75, 51, 100), (76, 185, 101, 150), (186, 304, 151, 200),
+                        (305, 604, 201, 300), (605, 1004, 301, 500)]),
+]
+
+
+def get_sub_index(concentration, decimals, breakpoints):
+    """Get the index of a concentration, in the unit of the breakpoints, by linear interpolation
+
+    Concentrations are truncated as the EPA does, negative ones, from sensor noise, count as zero, and those above the
+    last breakpoint get the highest index.
+    """
+    scale = 10 ** decimals
+    c = max(0.0, math.floor(concentration * scale + 1e-9) / scale)
+    for c_low, c_high, i_low, i_high in breakpoints:
+        if c <= c_high:
+            return int(round((i_high - i_low) / float(c_high - c_low) * (max(c, c_low) - c_low) + i_low))
+    return breakpoints[-1][3]
+
+
+def get_category(index):
+    # Get the category name of an index
+    for upper, name in CATEGORIES:
+        if index <= upper:
+            return name
+    return CATEGORIES[-1][1]
@@ -0,0 +1,118 @@
+import logging
+import math
+from collections import deque
+from threading import Lock
+
+from breakpoints import POLLUTANTS, get_category, get_sub_index
+
+logger = logging.getLogger(__name__)
+
+
+class RollingMean(object):
+    """Mean of the values of a sliding time window, updated in O(1) per value
+
+    Values are summed into fixed buckets, so the window holds window / bucket sums whatever the sample rate. A bucket
+    leaves the window once it is entirely older than the window, and the running sum is then summed again from the
+    buckets so that rounding errors do not pile up over the uptime.
+    """
+
+    def __init__(self, window, bucket):
+        self.window = window
+        self.bucket = bucket
+        # Buckets [start time, sum, count], oldest first
+        self.buckets = deque()
+        self.sum = 0.0
+        self.count = 0
+
+    def add(self, t, value):
+        start = t - t % self.bucket
+        if len(self.buckets) == 0 or self.buckets[-1][0] < start:
+            self.buckets.append([start, 0.0, 0])
+        # A value older than the newest bucket, which only happens if the clock went back, goes into the newest bucket
+        bucket = self.buckets[-1]
+        bucket[1] += value
+        bucket[2] += 1
+        self.sum += value
+        self.count += 1
+        self.expire(t)
+
+    def expire(self, now):
+        # Drop the buckets that ended before the window of now
+        expired = False
+        while len(self.buckets) > 0 and self.buckets[0][0] + self.bucket <= now - self.window:
+            self.buckets.popleft()
+            expired = True
+        if expired:
+            self.sum = sum(bucket[1] for bucket in self.buckets)
+            self.count = sum(bucket[2] for bucket in self.buckets)
+
+    def get_mean(self):
+        # Get the mean of the window, or None if it has no value
+        return None if self.count == 0 else self.sum / self.count
+
+
+class AqiEngine(object):
+    """Air quality index of the samples, updated incrementally
+
+    Every sample updates a rolling mean per pollutant over its regulatory averaging window (24 h for PM2.5, 8 h for CO
+    and ozone, 1 h for NO2 and SO2), from which the sub-index of each pollutant and the overall index, the highest
+    sub-index, are derived on request. Adding a sample costs the same whatever the length of the windows, so the sensor
+    server feeds every sample as it is inserted, and the state is rebuilt from the history in one pass at startup.
+    """
+
+    def __init__(self, value_columns, resolution=1, bucket_seconds=60):
+        self.resolution = resolution
+        # Pollutants that are channels of the history: name, column of the row, unit factor, decimals, breakpoints
+        self.pollutants = [(name, list(value_columns).index(name) + 1, factor, decimals, breakpoints)
+                           for name, _, factor, decimals, breakpoints in POLLUTANTS if name in value_columns]
+        windows = dict((name, hours) for name, hours, _, _, _ in POLLUTANTS)
+        self.means = dict((name, RollingMean(windows[name] * 3600 * resolution, bucket_seconds * resolution))
+                          for name, _, _, _, _ in self.pollutants)
+        # Longest window, in time units, the span of history the state is rebuilt from
+        self.window = max(windows.values()) * 3600 * resolution
+        self.last_time = None
+        self.lock = Lock()
+
+    def rebuild(self, rows):
+        """Build the state from the rows of the longest window, in one pass, at startup"""
+        n = 0
+        for row in rows:
+            self.add(row)
+            n += 1
+        logger.info("Rebuilt AQI rolling means from {} rows".format(n))
+
+    def add(self, row):
+        # Add a row, inserted in time order. Missing values are skipped.
+        with self.lock:
+            for name, column, _, _, _ in self.pollutants:
+                value = row[column]
+                if value is not None and not math.isnan(value):
+                    self.means[name].add(row[0], value)
+            self.last_time = row[0]
+
+    def get(self):
+        """Get the time of the last sample, and the rolling mean, in the unit of the channel, and the sub-index of
+        every pollutant, None when its window has no sample"""
+        with self.lock:
+            means = {}
+            sub_indices = {}
+            for name, _, factor, decimals, breakpoints in self.pollutants:
+                if self.last_time is not None:
+                    self.means[name].expire(self.last_time)
+                mean = self.means[name].get_mean()
+                means[name] = mean
+                sub_indices[name] = None if mean is None else get_sub_index(mean * factor, decimals, breakpoints)
+            return self.last_time, means, sub_indices
+
+    def snapshot(self):
+        # Get the state as a JSON-serializable dict: time, rolling means, sub-indices, index, its category and the
+        # pollutant that sets it
+        last_time, means, sub_indices = self.get()
+        known = [(index, name) for name, index in sub_indices.items() if index is not None]
+        index, dominant = max(known) if len(known) > 0 else (None, None)
+        return {'time': last_time,
+                'means': means,
+                'sub_indices': sub_indices,
+                'aqi': index,
+                'category': None if index is None else get_category(index),
+                'dominant': dominant}
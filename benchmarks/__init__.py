@@ -0,0 +1,6 @@
+from fakesys import FakeSysfs
+from cases import CASES, BenchContext, FakeSensorServer
+from suite import compare_results, load_results, measure, run_suite, save_results
+from linkload import LinkClient, run_load
+from ringstress import run_stress
+from stress import StressServer, run_sampling_stress
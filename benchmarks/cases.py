@@ -0,0 +1,515 @@
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import tempfile
+from functools import partial
+
+from aqi import AqiEngine
+from btserver import BTClientHandler, LinkScheduler
+from fakesys import FakeSysfs
+from history import BlockSummaries, HistoryArchive, HourlySketches, decode_token, downsample, encode_history, migrate
+from history import open_storage
+from realtime import ALL_CHANNELS, CHANNELS, FrameCache, RealtimeBroadcaster
+from sensor import DEFAULT_CHANNEL_MAP, SENSOR_NAMES, MotionPoller, SampleRing, SensorServer, calibrate
+from sensor import parse_channel_map
+from sensor.neo import Barometer, DriverManager, Gpio, Temp
+
+# Raw readings of a round, in mV, and a calibrated history row, typical of the sensors
+CHANNEL_VALUES = [572.0, 3.1, 244.5, 265.7, 426.2, 400.2, 358.6, 283.3, 314.9, 300.1, 797.3, 2.0]
+ROW_VALUES = (22.0, 31.5, 40.2, 380.4, 9.7, 12.5)
+
+# First time stamp of the rows written by the cases, and time between two rows, in seconds
+FIRST_TIME = 1700000000
+PERIOD = 2
+
+# Number of rows of the histories that the query cases read
+QUERY_ROWS = 10000
+
+# Length of a day, and number of rows of the databases that the scan cases read, three days of samples
+DAY = 86400
+SCAN_ROWS = 3 * DAY // PERIOD
+
+# Channel map of six MUXes sharing the select lines, one into each of the inputs A0 to A5, so that the 12 channels
+# need two MUX switches instead of 12
+GROUPED_CHANNEL_MAP = ",".join("A{}.{}".format(n % 6, n // 6) for n in xrange(0, 12))
+
+# MUX settle time of the channel map cases, in seconds, shorter than on the board to keep the runs short
+SETTLE_TIME = 0.002
+
+# Commands a client sends, which the handler reads in two pieces split in the middle of a line
+COMMANDS = ["start PM25,NO2,AQI every 2", "format json", "timestamps ms", "history 1700000000 1700086400 500",
+            "sync 1700000000 1700086400", "percentile PM25 1700000000 1700086400 95", "aqi", "metrics", "stop"]
+
+
+class BenchContext(object):
+    """Temporary directory and fake sysfs trees shared by the cases of a run, and what to clean up afterwards"""
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix="benchmarks-")
+        self.sysfs = FakeSysfs()
+        self.cleanups = []
+
+    def get_path(self, name):
+        return os.path.join(self.directory, name)
+
+    def add_cleanup(self, function):
+        self.cleanups.append(function)
+
+    def close(self):
+        # Clean up in the reverse order, the fake trees last
+        while self.cleanups:
+            self.cleanups.pop()()
+        self.sysfs.close()
+        shutil.rmtree(self.directory)
+
+
+class FakeSensorServer(SensorServer):
+    # Sensor server whose GPIOs and ADC are the fake sysfs trees, with no MUX settle time unless given so that only the
+    # Python side of a round is measured
+    def __init__(self, sysfs, database_name, **kwargs):
+        self.gpio_path = sysfs.gpio_path
+        self.iio_path = sysfs.iio_path
+        self.drivers = DriverManager(sysfs.i2c_path, sysfs.module_path)
+        kwargs.setdefault('settle_time', 0)
+        SensorServer.__init__(self, database_name=database_name, **kwargs)
+
+    def close(self):
+        # Reset the MUX select lines while the fake tree is there, and release the ADC inputs and the storage
+        for i in xrange(0, 4):
+            self.gpio.digitalWrite(24 + i, 0)
+        self.adc.close()
+        if self.storage is not None:
+            self.storage.close()
+            self.storage = None
+
+
+class FakeClient(object):
+    # Client handler as the broadcast sees it: only its subscription
+    def __init__(self, channels, every, delta, output_format, resolution):
+        self.sending_status = {'subscription': [channels, every, -1, delta],
+                               'format': output_format,
+                               'resolution': resolution}
+
+
+def get_server(context, name):
+    server = FakeSensorServer(context.sysfs, context.get_path(name + ".db"))
+    context.add_cleanup(server.close)
+    return server
+
+
+def get_row(k):
+    return (FIRST_TIME + k * PERIOD,) + ROW_VALUES
+
+
+def get_sample(k):
+    # Real-time sample of the k-th round, whose values move so that delta frames carry some channels
+    sample = dict(zip(ALL_CHANNELS, [value + (k % 7) * 0.3 for value in ROW_VALUES] + [57, 57, 12, 3, 20, 1]))
+    sample['time'] = FIRST_TIME + k * PERIOD
+    return sample
+
+
+def bench_read_all(context):
+    # One round of readings: 12 MUX switches and 12 ADC reads
+    server = get_server(context, "read-all")
+    return server.adc.read_all, 1
+
+
+def bench_read_mapped(context, spec):
+    # One round of readings through a channel map, with a MUX settle time after every switch
+    server = FakeSensorServer(context.sysfs, context.get_path("read-mapped.db"), channel_map=parse_channel_map(spec),
+                              settle_time=SETTLE_TIME)
+    context.add_cleanup(server.close)
+    return server.adc.read_all, 1
+
+
+def bench_set_mux_channel(context):
+    # Switch the MUX through its 16 channels
+    server = get_server(context, "set-mux-channel")
+
+    def run():
+        for m in xrange(0, 16):
+            server.set_mux_channel(m)
+
+    return run, 16
+
+
+def bench_gpio_setup(context):
+    # GPIO startup of the sensor server: create the Gpio and set the MUX pins 24 to 27 as low outputs. Their GPIOs are
+    # already exported in the fake tree, as after a previous run of the server.
+    def run():
+        gpio = Gpio(context.sysfs.gpio_path)
+        for pin in xrange(24, 28):
+            gpio.pinMode(pin, gpio.OUTPUT)
+            gpio.digitalWrite(pin, gpio.LOW)
+
+    return run, 1
+
+
+def bench_onboard_setup(context):
+    # Setup of the onboard temperature sensor and barometer at startup, with their drivers already loaded and their
+    # devices instantiated
+    def run():
+        manager = DriverManager(context.sysfs.i2c_path, context.sysfs.module_path)
+        board_temp = Temp(manager)
+        barometer = Barometer(manager)
+        board_temp.reader.close()
+        barometer.treader.close()
+        barometer.preader.close()
+
+    return run, 1
+
+
+def bench_read_onboard(context):
+    # Onboard temperature and pressure sampled in a round
+    server = FakeSensorServer(context.sysfs, context.get_path("read-onboard.db"), onboard=True)
+    context.add_cleanup(server.close)
+    if server.read_onboard() != (23.5, 101.5):
+        raise AssertionError("onboard values {} instead of (23.5, 101.5)".format(server.read_onboard()))
+    return server.read_onboard, 1
+
+
+def bench_calibrate(context):
+    def run():
+        for _ in xrange(0, 100):
+            calibrate(CHANNEL_VALUES)
+
+    return run, 100
+
+
+def bench_ring(context):
+    # Publish a sample into the shared-memory ring and read the newest one back, as the acquisition and the serving
+    # processes do
+    ring = SampleRing(len(SENSOR_NAMES), slots=64)
+    context.add_cleanup(ring.close)
+    counter = [0]
+
+    def run():
+        counter[0] += 1
+        ring.publish(get_row(counter[0]))
+        ring.get_latest()
+
+    return run, 1
+
+
+def bench_motion_round(context, n_samples=240):
+    # Motion polled at 100 Hz for a round of 2.4 s, and its summary, per sample
+    poller = MotionPoller(100, path=context.sysfs.motion_path)
+    context.add_cleanup(poller.close)
+
+    def run():
+        for _ in xrange(0, n_samples):
+            poller.poll()
+        poller.get_summary()
+
+    return run, n_samples
+
+
+def bench_store_row(context):
+    # Storage, commit and the analytics of a sample, as the sensor server does in every round
+    server = get_server(context, "store-row")
+    server.storage = open_storage(server.storage_engine, server.database_name, server.sensor_names, writable=True)
+    server.block_summaries = BlockSummaries(server.database_name + ".blocks", block_seconds=3600)
+    server.sketches = HourlySketches(server.database_name + ".sketches", SENSOR_NAMES, block_seconds=3600)
+    server.aqi_engine = AqiEngine(SENSOR_NAMES)
+    counter = [0]
+
+    def run():
+        counter[0] += 1
+        server.store_row(get_row(counter[0]))
+
+    return run, 1
+
+
+def bench_insert_commit(context, engine):
+    # Insert and commit one row at a time
+    storage = open_storage(engine, context.get_path("insert." + engine), SENSOR_NAMES, writable=True)
+    context.add_cleanup(storage.close)
+    counter = [0]
+
+    def run():
+        counter[0] += 1
+        storage.insert(get_row(counter[0]))
+        storage.commit()
+
+    return run, 1
+
+
+def bench_insert_many(context, engine):
+    # Insert and commit rows a thousand at a time
+    storage = open_storage(engine, context.get_path("insert-many." + engine), SENSOR_NAMES, writable=True)
+    context.add_cleanup(storage.close)
+    counter = [0]
+
+    def run():
+        rows = [get_row(counter[0] + k) for k in xrange(0, 1000)]
+        counter[0] += 1000
+        storage.insert_many(rows)
+        storage.commit()
+
+    return run, 1000
+
+
+def bench_query_csv(context, engine, max_points=0):
+    # Query a history and encode it as the lines of a history response, downsampled to max_points rows if given
+    path = context.get_path("query.{}.{}".format(engine, max_points))
+    storage = open_storage(engine, path, SENSOR_NAMES, writable=True)
+    storage.insert_many([get_row(k) for k in xrange(0, QUERY_ROWS)])
+    storage.commit()
+    storage.close()
+    storage = open_storage(engine, path, SENSOR_NAMES)
+    context.add_cleanup(storage.close)
+    start_time = FIRST_TIME
+    end_time = FIRST_TIME + QUERY_ROWS * PERIOD
+
+    def run():
+        rows = storage.query(start_time, end_time)
+        if max_points > 0:
+            rows = downsample(rows, start_time, end_time, max_points)
+        for _ in encode_history(rows, start_time, end_time, max_points):
+            pass
+
+    return run, QUERY_ROWS
+
+
+def bench_query_day(context, engine):
+    # Query a day of rows out of three days, as Python rows
+    path = context.get_path("query-day." + engine)
+    storage = open_storage(engine, path, SENSOR_NAMES, writable=True)
+    storage.insert_many([get_row(k) for k in xrange(0, SCAN_ROWS)])
+    storage.commit()
+    storage.close()
+    storage = open_storage(engine, path, SENSOR_NAMES)
+    context.add_cleanup(storage.close)
+    start_time = FIRST_TIME + DAY
+    end_time = start_time + DAY - 1
+
+    def run():
+        for _ in storage.query(start_time, end_time):
+            pass
+
+    return run, DAY // PERIOD
+
+
+def bench_archive_rows(context):
+    # Encode rows as archive lines and decode them back. Their millisecond times are long integers, as on a 32-bit
+    # board, whose repr() ends with an 'L'.
+    rows = [(long(FIRST_TIME + k * PERIOD) * 1000,) + ROW_VALUES[:-1] + (None,) for k in xrange(0, 100)]
+    if [HistoryArchive.decode_row(HistoryArchive.encode_row(row)) for row in rows] != rows:
+        raise AssertionError("Archive rows with long times do not survive the round trip")
+
+    def run():
+        for row in rows:
+            HistoryArchive.decode_row(HistoryArchive.encode_row(row))
+
+    return run, len(rows)
+
+
+def bench_downsample(context, max_points=800):
+    # Downsample a day of rows with a spike to max_points rows, without the storage
+    rows = [get_row(k) for k in xrange(0, DAY // PERIOD)]
+    spike = len(rows) // 3
+    rows[spike] = rows[spike][:-1] + (1000.0,)
+    start_time = FIRST_TIME
+    end_time = FIRST_TIME + DAY - 1
+    if not any(row[-1] == 1000.0 for row in downsample(rows, start_time, end_time, max_points)):
+        raise AssertionError("The downsampler dropped the spike")
+
+    def run():
+        for _ in downsample(rows, start_time, end_time, max_points):
+            pass
+
+    return run, len(rows)
+
+
+def bench_resume(context, mean_bytes=200000):
+    # Transfer a day of rows to a client that is disconnected after exponentially distributed numbers of bytes, and
+    # resumes the transfer from the last continuation token it got
+    path = context.get_path("resume.db")
+    storage = open_storage("sqlite", path, SENSOR_NAMES, writable=True)
+    storage.insert_many([get_row(k) for k in xrange(0, DAY // PERIOD)])
+    storage.commit()
+    context.add_cleanup(storage.close)
+    start_time = FIRST_TIME
+    end_time = FIRST_TIME + DAY - 1
+
+    def run():
+        drops = random.Random(1)
+        token = None
+        while True:
+            budget = drops.expovariate(1.0 / mean_bytes)
+            if token is None:
+                lines = encode_history(storage.query(start_time, end_time), start_time, end_time)
+            else:
+                last_time, crc = decode_token(token)[3:]
+                lines = encode_history(storage.query(last_time + 1, end_time), start_time, end_time, crc=crc)
+            for line in lines:
+                budget -= len(line)
+                if budget < 0:
+                    break
+                if line[0] == "c":
+                    token = line[1:-1]
+            else:
+                return token
+
+    # The CRC of the last token of the resumed transfer is the one of the whole transfer
+    crc = 0
+    for line in encode_history(storage.query(start_time, end_time), start_time, end_time):
+        if line[0] == "c":
+            crc = decode_token(line[1:-1])[4]
+    if decode_token(run())[4] != crc:
+        raise AssertionError("The resumed transfer does not have the CRC of the whole transfer")
+
+    return run, DAY // PERIOD
+
+
+def create_legacy_history(path, n):
+    # History of n rows in the layout of the databases created before the time key was aliased to the rowid
+    db_conn = sqlite3.connect(path)
+    db_conn.execute("CREATE TABLE history (time int PRIMARY KEY NOT NULL, {})"
+                    .format(", ".join("{} real".format(name) for name in SENSOR_NAMES)))
+    db_conn.executemany("INSERT INTO history VALUES (?, ?, ?, ?, ?, ?, ?)", (get_row(k) for k in xrange(0, n)))
+    db_conn.commit()
+    db_conn.close()
+
+
+def bench_scan_day(context, legacy):
+    # Count and sum a day of rows in SQLite alone, so that building the Python rows does not hide the cost of the key
+    # layout
+    path = context.get_path("scan.{}.db".format("legacy" if legacy else "rowid"))
+    create_legacy_history(path, SCAN_ROWS)
+    if not legacy:
+        migrate(path, chunk_size=50000)
+    db_conn = sqlite3.connect(path)
+    context.add_cleanup(db_conn.close)
+    start_time = FIRST_TIME + DAY
+    end_time = start_time + DAY - 1
+
+    def run():
+        db_conn.execute("SELECT COUNT(*), SUM(PM25) FROM history WHERE time >= ? AND time <= ?",
+                        (start_time, end_time)).fetchone()
+
+    return run, DAY // PERIOD
+
+
+def bench_migrate(context):
+    # Migrate a copy of a legacy database of a day of rows, in chunks of 50000 rows
+    template = context.get_path("migrate-legacy.db")
+    create_legacy_history(template, DAY // PERIOD)
+    path = context.get_path("migrate.db")
+
+    def run():
+        shutil.copyfile(template, path)
+        migrate(path, chunk_size=50000)
+
+    return run, DAY // PERIOD
+
+
+def bench_frame(context, output_format):
+    # Encode a new sample into a frame of every channel
+    sample = get_sample(0)
+
+    def run():
+        for _ in xrange(0, 100):
+            FrameCache(sample).get(output_format, ALL_CHANNELS)
+
+    return run, 100
+
+
+def bench_handle_read(context):
+    # Read a burst of commands from a client, in two pieces split in the middle of a line
+    server_socket, client_socket = socket.socketpair()
+    handler = BTClientHandler(server_socket, None)
+    context.add_cleanup(client_socket.close)
+    context.add_cleanup(handler.close)
+    data = "".join(command + "\n" for command in COMMANDS)
+    pieces = [data[:len(data) // 2], data[len(data) // 2:]]
+
+    def run():
+        for piece in pieces:
+            client_socket.sendall(piece)
+            handler.handle_read()
+
+    return run, len(COMMANDS)
+
+
+def bench_broadcast(context):
+    # Fan-out of a sample to 32 clients of various subscriptions, a quarter of them in delta mode. The link scheduler is
+    # not started; its queue is emptied after every sample, as if the frames had been sent.
+    scheduler = LinkScheduler()
+    broadcaster = RealtimeBroadcaster(scheduler)
+    clients = []
+    for i in xrange(0, 32):
+        channels = CHANNELS if i % 3 else ALL_CHANNELS
+        clients.append(FakeClient(channels, 0, i % 4 == 3, ("csv", "json", "binary")[i % 3], (1, 1000)[i % 2]))
+    counter = [0]
+
+    def run():
+        counter[0] += 1
+        frame_cache = FrameCache(get_sample(counter[0]))
+        epoch_time = FIRST_TIME + counter[0] * PERIOD
+        for client in clients:
+            broadcaster.send(client, frame_cache, epoch_time)
+        scheduler.realtime.clear()
+
+    return run, len(clients)
+
+
+def bench_fanout(context, n_clients, shared=True):
+    # Frames of a sample for n_clients clients spread over the 3 formats and 3 subscriptions, encoded once per format
+    # and subscription through the FrameCache of the sample, or once per client if not shared
+    scheduler = LinkScheduler()
+    broadcaster = RealtimeBroadcaster(scheduler)
+    subscriptions = [CHANNELS, ALL_CHANNELS, ('PM25', 'AQI')]
+    clients = [FakeClient(subscriptions[i // 3 % 3], 0, False, ("csv", "json", "binary")[i % 3], 1)
+               for i in xrange(0, n_clients)]
+    counter = [0]
+
+    def run():
+        counter[0] += 1
+        sample = get_sample(counter[0])
+        frame_cache = FrameCache(sample)
+        for client in clients:
+            broadcaster.send(client, frame_cache if shared else FrameCache(sample), sample['time'])
+        scheduler.realtime.clear()
+
+    return run, n_clients
+
+
+# Cases of the suite: name, and the function that sets up a case and returns (function to time, operations per call)
+CASES = [
+    ("sensor.read_all", bench_read_all),
+    ("sensor.read_mapped.one_mux", partial(bench_read_mapped, spec=DEFAULT_CHANNEL_MAP)),
+    ("sensor.read_mapped.six_muxes", partial(bench_read_mapped, spec=GROUPED_CHANNEL_MAP)),
+    ("sensor.set_mux_channel", bench_set_mux_channel),
+    ("sensor.gpio_setup", bench_gpio_setup),
+    ("sensor.onboard_setup", bench_onboard_setup),
+    ("sensor.read_onboard", bench_read_onboard),
+    ("sensor.calibrate", bench_calibrate),
+    ("sensor.store_row", bench_store_row),
+    ("sensor.ring", bench_ring),
+    ("sensor.motion_round", bench_motion_round),
+    ("history.insert_commit.sqlite", partial(bench_insert_commit, engine="sqlite")),
+    ("history.insert_commit.segment", partial(bench_insert_commit, engine="segment")),
+    ("history.insert_many.sqlite", partial(bench_insert_many, engine="sqlite")),
+    ("history.query_csv.sqlite", partial(bench_query_csv, engine="sqlite")),
+    ("history.query_csv.segment", partial(bench_query_csv, engine="segment")),
+    ("history.query_csv_downsampled.sqlite", partial(bench_query_csv, engine="sqlite", max_points=500)),
+    ("history.archive_rows", bench_archive_rows),
+    ("history.downsample", bench_downsample),
+    ("history.resume", bench_resume),
+    ("history.query_day.sqlite", partial(bench_query_day, engine="sqlite")),
+    ("history.query_day.segment", partial(bench_query_day, engine="segment")),
+    ("history.scan_day.legacy", partial(bench_scan_day, legacy=True)),
+    ("history.scan_day.rowid", partial(bench_scan_day, legacy=False)),
+    ("history.migrate", bench_migrate),
+    ("realtime.frame.csv", partial(bench_frame, output_format="csv")),
+    ("realtime.frame.json", partial(bench_frame, output_format="json")),
+    ("realtime.frame.binary", partial(bench_frame, output_format="binary")),
+    ("realtime.broadcast", bench_broadcast),
+    ("realtime.fanout.16", partial(bench_fanout, n_clients=16)),
+    ("realtime.fanout.256", partial(bench_fanout, n_clients=256)),
+    ("realtime.fanout_unshared.256", partial(bench_fanout, n_clients=256, shared=False)),
+    ("btserver.handle_read", bench_handle_read),
+]
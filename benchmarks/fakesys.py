@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+
+from sensor.adc import N_CHANNELS
+from sensor.motion import MOTION_DEVICES
+
+# Kernel numbers of the GPIOs of the MUX select lines, pins 24 to 27 of the Neo
+MUX_GPIOS = ["25", "22", "14", "15"]
+
+# Scale of the ADC inputs, in mV per step of the 12-bit output over 0 - 3300 mV
+ADC_SCALE = 3300.0 / 4096
+
+# Files of the onboard temperature sensor and barometer under their i2c device directories, reading 23.5 C and
+# 101.5 kPa
+ONBOARD_FILES = {"1-0048/temp1_input": "23500\n", "1-0060/iio:device0/in_temp_raw": "94\n",
+                 "1-0060/iio:device0/in_temp_scale": "0.25\n", "1-0060/iio:device0/in_pressure_raw": "406000\n",
+                 "1-0060/iio:device0/in_pressure_scale": "0.00025\n"}
+
+# Axes of the onboard accelerometer, magnetometer and gyroscope of a board at rest
+MOTION_DATA = ["12,-40,1020\n", "310,-122,-480\n", "3,-2,1\n"]
+
+
+class FakeSysfs(object):
+    """Temporary directory laid out like the sysfs GPIO, IIO, i2c and motion sensor interfaces of the Neo
+
+    The GPIOs of the MUX select lines are already exported, every ADC input has a raw value and the ADC a shared scale,
+    the drivers of the onboard temperature sensor and barometer are loaded and their devices instantiated, and every
+    motion sensor has its axes, so that a SensorServer, its Gpio, its AdcReader, its onboard sensors and a MotionPoller
+    run against it on any Linux machine. Reads and writes go
+    through the page cache instead of drivers, so the timings measure the Python side of the hot paths.
+    """
+
+    def __init__(self, inputs=N_CHANNELS, raw_value=2048):
+        self.root = tempfile.mkdtemp(prefix="fake-sysfs-")
+        self.gpio_path = os.path.join(self.root, "class", "gpio") + "/"
+        self.iio_path = os.path.join(self.root, "bus", "iio", "devices", "iio:device0") + "/"
+        self.motion_path = os.path.join(self.root, "class", "misc") + "/"
+        self.i2c_path = os.path.join(self.root, "class", "i2c-dev", "i2c-1", "device") + "/"
+        self.module_path = os.path.join(self.root, "module") + "/"
+
+        for gpio in MUX_GPIOS:
+            os.makedirs(os.path.join(self.gpio_path, "gpio" + gpio))
+            self.write(os.path.join(self.gpio_path, "gpio" + gpio, "value"), "0\n")
+            self.write(os.path.join(self.gpio_path, "gpio" + gpio, "direction"), "in\n")
+        self.write(os.path.join(self.gpio_path, "export"), "")
+
+        os.makedirs(self.iio_path)
+        for adc_input in xrange(0, inputs):
+            self.write(os.path.join(self.iio_path, "in_voltage{}_raw".format(adc_input)), "{}\n".format(raw_value))
+        self.write(os.path.join(self.iio_path, "in_voltage_scale"), "{!r}\n".format(ADC_SCALE))
+
+        for module in ["lm75", "mpl3115"]:
+            os.makedirs(os.path.join(self.module_path, module))
+        for name, text in ONBOARD_FILES.items():
+            if not os.path.isdir(os.path.dirname(os.path.join(self.i2c_path, name))):
+                os.makedirs(os.path.dirname(os.path.join(self.i2c_path, name)))
+            self.write(os.path.join(self.i2c_path, name), text)
+        self.write(os.path.join(self.i2c_path, "new_device"), "")
+
+        for device, data in zip(MOTION_DEVICES, MOTION_DATA):
+            os.makedirs(os.path.join(self.motion_path, device))
+            self.write(os.path.join(self.motion_path, device, "enable"), "0\n")
+            self.write(os.path.join(self.motion_path, device, "data"), data)
+
+    @staticmethod
+    def write(path, text):
+        with open(path, "w") as f:
+            f.write(text)
+
+    def close(self):
+        shutil.rmtree(self.root)
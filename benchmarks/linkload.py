@@ -0,0 +1,100 @@
+import argparse
+import logging
+from itertools import repeat
+from time import sleep
+
+from btserver import LinkScheduler
+from sensor import monotonic
+
+logger = logging.getLogger(__name__)
+
+
+class LinkClient(object):
+    """Client handler as the link scheduler sees it: records the latency of every real-time frame it gets, and the bytes
+    of the bulk lines"""
+
+    def __init__(self):
+        self.latencies = []
+        self.bulk_bytes = 0
+
+    def send(self, data):
+        # Real-time frames carry the time they were queued at
+        if data[0] == "r":
+            self.latencies.append(monotonic() - float(data[1:data.index(",")]))
+        else:
+            self.bulk_bytes += len(data)
+        return len(data)
+
+    def handle_close(self):
+        pass
+
+
+def get_fairness(values):
+    # Jain's fairness index: 1 when all the values are equal, 1 / n when a single one gets everything
+    total = float(sum(values))
+    squares = float(sum(value * value for value in values))
+    return 1.0 if squares == 0 else total * total / (len(values) * squares)
+
+
+def run_load(n_clients, duration=6.0, baud_rate=1000000, frame_interval=0.3):
+    """Run n_clients fake clients on a simulated link of baud_rate bps for duration seconds, and get (average real-time
+    latency, maximum real-time latency, number of frames replaced before they were sent, fairness of the bulk
+    throughput, bulk bytes per second)
+
+    Every client gets a real-time frame every frame_interval seconds, and has an endless history transfer whose lines
+    are of a length of its own, between 20 and 119 bytes.
+    """
+    scheduler = LinkScheduler(baud_rate=baud_rate)
+    scheduler.start()
+    clients = [LinkClient() for _ in xrange(0, n_clients)]
+    for i in xrange(0, n_clients):
+        length = 20 + i * 37 % 100
+        scheduler.send_bulk(clients[i], repeat("h" + "0" * (length - 2) + "\n"))
+
+    replaced = 0
+    start = monotonic()
+    next_time = start
+    while next_time < start + duration:
+        for client in clients:
+            frame = "r{!r},22.0,31.5,40.2,380.4,9.7,12.5\n".format(monotonic())
+            if scheduler.send_realtime(client, frame):
+                replaced += 1
+        next_time += frame_interval
+        sleep(max(0, next_time - monotonic()))
+    for client in clients:
+        scheduler.remove(client)
+    elapsed = monotonic() - start
+    # Let the scheduler finish the line it is transmitting, and go back to waiting
+    sleep(0.1)
+
+    latencies = [latency for client in clients for latency in client.latencies]
+    bulk_bytes = [client.bulk_bytes for client in clients]
+    return (sum(latencies) / max(len(latencies), 1), max(latencies or [0]), replaced, get_fairness(bulk_bytes),
+            sum(bulk_bytes) / elapsed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load the link scheduler with fake clients that each get real-time "
+                                                 "frames and an endless history transfer, and report the real-time "
+                                                 "latency and the fairness of the bulk throughput")
+    parser.add_argument("--clients", dest="clients", default="1,4,16",
+                        help="specify comma-separated numbers of clients to run the load with")
+    parser.add_argument("--duration", dest="duration", type=float, default=6.0,
+                        help="specify number of seconds of a load")
+    parser.add_argument("--baud-rate", dest="baud_rate", type=int, default=1000000,
+                        help="specify simulated bit rate of the link")
+    parser.add_argument("--frame-interval", dest="frame_interval", type=float, default=0.3,
+                        help="specify number of seconds between two real-time frames of a client")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARN)
+
+    print "{:>7} {:>12} {:>12} {:>8} {:>9} {:>12}".format("clients", "avg latency", "max latency", "replaced",
+                                                          "fairness", "bulk B/s")
+    for n_clients in [int(n) for n in args.clients.split(",")]:
+        average, maximum, replaced, fairness, throughput = run_load(n_clients, args.duration, args.baud_rate,
+                                                                    args.frame_interval)
+        print "{:>7} {:>9.1f} ms {:>9.1f} ms {:>8} {:>9.4f} {:>12.0f}".format(n_clients, average * 1000,
+                                                                               maximum * 1000, replaced, fairness,
+                                                                               throughput)
@@ -0,0 +1,62 @@
+import argparse
+import logging
+import sys
+from multiprocessing import Process, cpu_count
+
+from sensor import SampleRing, monotonic
+
+logger = logging.getLogger(__name__)
+
+
+def publish_samples(ring, n_samples, n_channels):
+    # Every value of the i-th sample is i, so a torn sample mixes values of different samples
+    for i in xrange(0, n_samples):
+        ring.publish((i,) + (float(i),) * n_channels)
+
+
+def run_stress(n_samples=300000, slots=64, n_channels=6, locked=None):
+    """Publish n_samples samples into a ring of slots slots from a child process while reading the newest one in a loop,
+    and get (number of reads, number of torn samples read, samples published per second)"""
+    ring = SampleRing(n_channels, slots=slots, locked=locked)
+    writer = Process(target=publish_samples, args=(ring, n_samples, n_channels))
+    start = monotonic()
+    writer.start()
+    reads = 0
+    torn = 0
+    while ring.get_count() < n_samples:
+        row = ring.get_latest()
+        if row is None:
+            continue
+        reads += 1
+        if any(value != row[0] for value in row[1:]):
+            torn += 1
+    elapsed = monotonic() - start
+    writer.join()
+    ring.close()
+    return reads, torn, n_samples / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Read the newest sample of a shared-memory sample ring in a loop "
+                                                 "while another process publishes into it, and count the torn samples")
+    parser.add_argument("--samples", dest="samples", type=int, default=300000,
+                        help="specify number of samples published")
+    parser.add_argument("--slots", dest="slots", type=int, default=64, help="specify number of slots of the ring")
+    parser.add_argument("--locked", dest="locked", default="auto",
+                        help="set whether the ring is locked: auto (on more than one core), yes, no")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARN)
+
+    locked = {'auto': None, 'yes': True, 'no': False}.get(args.locked)
+    if args.locked not in ('auto', 'yes', 'no'):
+        parser.error("unknown value {} of --locked".format(args.locked))
+
+    print "INFO: {} cores, ring {}".format(cpu_count(), "locked" if locked or (locked is None and cpu_count() > 1)
+                                           else "not locked")
+    reads, torn, rate = run_stress(args.samples, args.slots, locked=locked)
+    print "INFO: {} reads, {} torn, {:.0f} samples/s published".format(reads, torn, rate)
+    if torn > 0:
+        print "ERROR: {} torn samples read".format(torn)
+        sys.exit(1)
@@ -0,0 +1,94 @@
+import argparse
+import logging
+import shutil
+import sys
+import tempfile
+
+from cases import FakeSensorServer
+from fakesys import FakeSysfs
+from history import HistoryArchive, open_storage
+from sensor import monotonic
+from suite import Quiet
+
+logger = logging.getLogger(__name__)
+
+
+class StressServer(FakeSensorServer):
+    # Sensor server on the fake sysfs trees that stops acquiring after duration seconds
+    def __init__(self, sysfs, database_name, duration, **kwargs):
+        self.duration = duration
+        self.end = None
+        FakeSensorServer.__init__(self, sysfs, database_name, **kwargs)
+
+    def start_acquisition(self):
+        FakeSensorServer.start_acquisition(self)
+        self.end = monotonic() + self.duration
+
+    def acquire(self):
+        if monotonic() >= self.end:
+            return None
+        return FakeSensorServer.acquire(self)
+
+
+def run_sampling_stress(engine, rate, duration, settle_time=0.0):
+    """Sample at rate Hz for duration seconds into a new millisecond database, and get (rows stored, achieved rate in
+    Hz, median interval in ms, maximum interval in ms, errors found in the stored rows)"""
+    directory = tempfile.mkdtemp(prefix="stress-")
+    sysfs = FakeSysfs()
+    try:
+        database_name = "{}/history.{}".format(directory, engine)
+        with Quiet():
+            server = StressServer(sysfs, database_name, duration, storage_engine=engine, resolution=1000,
+                                  period=1.0 / rate, settle_time=settle_time)
+            server.run()
+            server.close()
+
+        storage = open_storage(engine, database_name, server.sensor_names)
+        try:
+            rows = list(storage.query(0, 2 ** 62))
+        finally:
+            storage.close()
+    finally:
+        sysfs.close()
+        shutil.rmtree(directory)
+
+    # Times must be distinct and increasing, and every row must survive the archive encoding
+    errors = []
+    intervals = sorted(rows[k][0] - rows[k - 1][0] for k in xrange(1, len(rows)))
+    if any(interval <= 0 for interval in intervals):
+        errors.append("duplicate or unordered times")
+    if any(HistoryArchive.decode_row(HistoryArchive.encode_row(row)) != tuple(row) for row in rows):
+        errors.append("rows that do not survive the archive encoding")
+    if len(intervals) == 0:
+        return len(rows), 0.0, 0.0, 0.0, errors + ["fewer than two rows"]
+    return (len(rows), len(rows) / float(duration), intervals[len(intervals) // 2], intervals[-1], errors)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the sensor server at sub-second sample periods against fake "
+                                                 "sysfs trees, and check the rows it stores in a millisecond database")
+    parser.add_argument("--rates", dest="rates", default="20,100",
+                        help="specify comma-separated sample rates to run at, in Hz")
+    parser.add_argument("--duration", dest="duration", type=float, default=10.0,
+                        help="specify number of seconds of sampling at each rate")
+    parser.add_argument("--storage", dest="storage_engines", default="sqlite,segment",
+                        help="specify comma-separated history storage engines: sqlite, segment")
+    parser.add_argument("--settle-time", dest="settle_time", type=float, default=0.0,
+                        help="specify number of seconds to wait for the MUX output to settle")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    failed = False
+    print "{:>8} {:>9} {:>7} {:>11} {:>11} {:>11}  {}".format("engine", "target Hz", "rows", "achieved Hz",
+                                                              "median ms", "max ms", "errors")
+    for rate in [float(rate) for rate in args.rates.split(",")]:
+        for engine in args.storage_engines.split(","):
+            n, achieved, median, maximum, errors = run_sampling_stress(engine, rate, args.duration, args.settle_time)
+            print "{:>8} {:>9.1f} {:>7} {:>11.1f} {:>11} {:>11}  {}".format(engine, rate, n, achieved, median, maximum,
+                                                                          ", ".join(errors) or "none")
+            failed = failed or len(errors) > 0
+    if failed:
+        print "ERROR: The stored rows have errors"
+        sys.exit(1)
@@ -0,0 +1,229 @@
+import argparse
+import gc
+import json
+import logging
+import math
+import os
+import platform
+import re
+import sys
+from time import time
+
+from cases import CASES, BenchContext
+from sensor import monotonic
+
+logger = logging.getLogger(__name__)
+
+# Version of the layout of the result files
+RESULTS_VERSION = 1
+
+
+class Quiet(object):
+    # Send the standard output to /dev/null, since some hot paths print every line they handle
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def calibrate_loops(function, min_time=0.2):
+    # Warm up, and get the number of calls of a run of at least min_time seconds
+    start = monotonic()
+    function()
+    elapsed = monotonic() - start
+    return max(1, int(min_time / max(elapsed, 1e-9)))
+
+
+def time_run(function, loops, ops):
+    # Time a run of loops calls, in ns per operation, with the garbage collector off as in timeit, so that its cycles
+    # do not land on some runs only
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = monotonic()
+        for _ in xrange(0, loops):
+            function()
+        return (monotonic() - start) / (loops * ops) * 1e9
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def get_result(runs, loops, ops):
+    # The median time per operation is the one compared, as the least sensitive to the other processes of the machine
+    ns_per_op = sorted(runs)[len(runs) // 2]
+    return {'ns_per_op': ns_per_op,
+            'best_ns_per_op': min(runs),
+            'ops_per_s': 1e9 / ns_per_op,
+            'runs': runs,
+            'loops': loops,
+            'ops_per_call': ops}
+
+
+def measure(function, ops, min_time=0.2, repeat=5):
+    """Time function, which performs ops operations per call, in repeat runs of at least min_time seconds"""
+    loops = calibrate_loops(function, min_time)
+    return get_result([time_run(function, loops, ops) for _ in xrange(0, repeat)], loops, ops)
+
+
+def run_suite(pattern=None, min_time=0.2, repeat=5):
+    """Run the cases whose name matches the regular expression pattern, and get their results by name
+
+    The runs of the cases are interleaved: every round runs each case once, so that a slowdown of the machine for a
+    while spreads over all the cases instead of making the few that ran then look like regressions.
+    """
+    context = BenchContext()
+    try:
+        cases = []
+        with Quiet():
+            for name, setup in CASES:
+                if pattern is None or re.search(pattern, name) is not None:
+                    function, ops = setup(context)
+                    cases.append((name, function, ops, calibrate_loops(function, min_time), []))
+
+        for i in xrange(0, repeat):
+            print "Round {} of {}...".format(i + 1, repeat)
+            sys.stdout.flush()
+            for name, function, ops, loops, runs in cases:
+                with Quiet():
+                    runs.append(time_run(function, loops, ops))
+    finally:
+        with Quiet():
+            context.close()
+
+    results = {}
+    for name, function, ops, loops, runs in cases:
+        results[name] = get_result(runs, loops, ops)
+        print "{:<40} {:>14.0f} ns/op {:>14.0f} ops/s".format(name, results[name]['ns_per_op'],
+                                                               results[name]['ops_per_s'])
+    return results
+
+
+def save_results(path, results, min_time, repeat):
+    # Results are saved with the machine and the Python they were measured on, since they only compare on the same ones
+    with open(path, "w") as f:
+        json.dump({'version': RESULTS_VERSION,
+                   'time': int(time()),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'machine': platform.machine(),
+                   'min_time': min_time,
+                   'repeat': repeat,
+                   'results': results}, f, indent=1, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('version') != RESULTS_VERSION:
+        raise ValueError("{} is not a benchmark result file of version {}".format(path, RESULTS_VERSION))
+    return data
+
+
+def compare_results(baseline, results, threshold=10.0, relative=False):
+    """Compare the results of the cases with a baseline
+
+    Get [(name, baseline ns/op, current ns/op, change in percent, status)] where status is 'regression' for a case
+    slower than the baseline by more than threshold percent, 'improvement' for one faster by more than that, 'ok' for
+    the others, and 'new' or 'missing' for a case that has no baseline or no result.
+
+    If relative is set, the changes are relative to the geometric mean of the changes of all the cases, which cancels
+    a machine that runs everything faster or slower than when the baseline was measured, such as a shared one, but
+    also hides a slowdown of every case alike.
+    """
+    scale = 1.0
+    common = [name for name in baseline if name in results]
+    if relative and len(common) > 0:
+        scale = math.exp(sum(math.log(results[name]['ns_per_op'] / baseline[name]['ns_per_op']) for name in common) /
+                         len(common))
+
+    comparison = []
+    for name in sorted(set(baseline) | set(results)):
+        if name not in baseline:
+            comparison.append((name, None, results[name]['ns_per_op'], None, 'new'))
+            continue
+        if name not in results:
+            comparison.append((name, baseline[name]['ns_per_op'], None, None, 'missing'))
+            continue
+        before = baseline[name]['ns_per_op']
+        after = results[name]['ns_per_op']
+        change = (after / scale - before) / before * 100
+        if change > threshold:
+            status = 'regression'
+        elif change < -threshold:
+            status = 'improvement'
+        else:
+            status = 'ok'
+        comparison.append((name, before, after, change, status))
+    return comparison
+
+
+def format_value(value, fmt):
+    return "-" if value is None else fmt.format(value)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure the hot paths against fake sysfs trees and temporary "
+                                                 "databases, and compare them with a baseline")
+    parser.add_argument("--filter", dest="pattern", default=None,
+                        help="specify regular expression of the names of the cases to run")
+    parser.add_argument("--list", dest="list", action="store_true", help="list the cases and exit")
+    parser.add_argument("--min-time", dest="min_time", type=float, default=0.2,
+                        help="specify minimum number of seconds of a run of a case")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=5,
+                        help="specify number of runs of a case, of which the median is kept")
+    parser.add_argument("--save", dest="save", default="", help="specify file the results are saved to as JSON")
+    parser.add_argument("--results", dest="results", default="",
+                        help="specify file of saved results to compare, instead of running the cases")
+    parser.add_argument("--baseline", dest="baseline", default="",
+                        help="specify file of the baseline results to compare with")
+    parser.add_argument("--threshold", dest="threshold", type=float, default=10.0,
+                        help="specify slowdown in percent over which a case is a regression")
+    parser.add_argument("--relative", dest="relative", action="store_true",
+                        help="compare the changes of the cases relative to the mean change of all of them")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARN)
+
+    if args.list:
+        for name, _ in CASES:
+            print name
+        sys.exit(0)
+
+    try:
+        baseline = load_results(args.baseline) if args.baseline else None
+        if args.results:
+            current = load_results(args.results)
+            results = current['results']
+        else:
+            results = run_suite(args.pattern, args.min_time, args.repeat)
+    except (IOError, ValueError) as e:
+        print "ERROR: {}".format(e)
+        sys.exit(1)
+
+    if args.save:
+        save_results(args.save, results, args.min_time, args.repeat)
+        print "INFO: Results saved to {}".format(args.save)
+
+    if baseline is not None:
+        if baseline['platform'] != platform.platform() or baseline['python'] != platform.python_version():
+            print "WARN: Baseline was measured with Python {} on {}".format(baseline['python'], baseline['platform'])
+        if args.pattern is not None:
+            # Cases left out by the filter are not missing
+            baseline['results'] = dict((name, result) for name, result in baseline['results'].items()
+                                       if re.search(args.pattern, name) is not None)
+        comparison = compare_results(baseline['results'], results, args.threshold, args.relative)
+        print "{:<40} {:>14} {:>14} {:>9}  {}".format("case", "baseline ns/op", "current ns/op", "change", "status")
+        for name, before, after, change, status in comparison:
+            print "{:<40} {:>14} {:>14} {:>9}  {}".format(name, format_value(before, "{:.0f}"),
+                                                          format_value(after, "{:.0f}"),
+                                                          format_value(change, "{:+.1f}%"), status)
+        regressions = [name for name, _, _, _, status in comparison if status == 'regression']
+        if regressions:
+            print "ERROR: {} regressions over {}%: {}".format(len(regressions), args.threshold, ", ".join(regressions))
+            sys.exit(1)
+        print "INFO: No regression over {}%".format(args.threshold)
@@ -1,3 +1,4 @@
 from btserver import BTServer
 from bthandler import BTClientHandler
 from bterror import BTError
+from scheduler import LinkScheduler
@@ -4,11 +4,13 @@ class BTError(object):
     ERR_UNKNOWN_CMD = -3
     ERR_READ = -4
     ERR_WRITE = -5
+    ERR_INVALID_ARG = -6
 
     ERROR_MSG = {
         ERR_UNKNOWN:    "Unknown error",
         ERR_NO_CMD:     "No command given",
-        ERR_UNKNOWN_CMD:   "Unknown command"
+        ERR_UNKNOWN_CMD:   "Unknown command",
+        ERR_INVALID_ARG:   "Invalid argument"
     }
 
     @staticmethod
@@ -2,6 +2,7 @@ import asyncore
 import logging
 import re
 from bterror import BTError
+from realtime import CHANNELS, FORMATS, parse_channels
 
 logger = logging.getLogger(__name__)
 
@@ -13,7 +14,17 @@ class BTClientHandler(asyncore.dispatcher_with_send):
         asyncore.dispatcher_with_send.__init__(self, socket)
         self.server = server
         self.data = ""
-        self.sending_status = {'real-time': False, 'history': [False, -1, -1]}
+        # The real-time subscription is [channels, minimum interval between frames in seconds, time of the last frame,
+        # delta mode]
+        self.sending_status = {'real-time': False,
+                               'subscription': [CHANNELS, 0, -1, False],
+                               'history': [False, -1, -1, 0, None],
+                               'format': None,
+                               'resolution': 1,
+                               'metrics': False,
+                               'aqi': False,
+                               'percentile': [False, None, -1, -1, 0.0],
+                               'sync': [False, -1, -1]}
 
     def handle_read(self):
         try:
@@ -21,20 +32,15 @@ class BTClientHandler(asyncore.dispatcher_with_send):
             if not data:
                 return
 
-            lf_char_index = data.find('\n')
-
-            if lf_char_index == -1:
-                # No new line character in data, so we append all.
-                self.data += data
-            else:
-                # We see a new line character in data, so append rest and handle.
-                self.data += data[:lf_char_index]
-                print "Received [{}]".format(self.data)
-
-                self.handle_command(self.data)
-
-                # Clear the buffer
-                self.data = ""
+            # Handle every complete line, since a client such as the gateway may send several commands at once, and
+            # keep the rest in the buffer until its new line character arrives. Serial terminals end their lines with
+            # CRLF, so the carriage return is dropped before the command is parsed.
+            lines = (self.data + data).split('\n')
+            self.data = lines.pop()
+            for line in lines:
+                line = line.rstrip('\r')
+                print "Received [{}]".format(line)
+                self.handle_command(line)
         except Exception as e:
             BTError.print_error(handler=self, error=BTError.ERR_READ, error_message=repr(e))
             self.data = ""
@@ -42,29 +48,93 @@ class BTClientHandler(asyncore.dispatcher_with_send):
 
     def handle_command(self, command):
         # We should support following commands:
-        # - start
-        #       Start sending real time data by setting 'sending_status' variable to 0
+        # - start [channels] [every N] [delta]
+        #       Start sending real time data by setting 'sending_status' variable to True. channels is a comma-separated
+        #       list such as 'PM25,NO2' (all channels by default), and N the minimum number of seconds between frames.
+        #       In delta mode, only the channels that changed by more than their deadband are sent between keyframes
         # - stop
         #       Stop sending real time data by setting 'sending_status' variable to False
-        # - history start_time end_time
+        # - history start_time end_time [max_points]
         #       Stop sending real time data, and query the history data from the database. Getting history data might
-        #       take some time so we should use a different thread to handle this request
-        if re.match('stop', command) is not None:
+        #       take some time so we should use a different thread to handle this request. If max_points is given, the
+        #       range is downsampled to at most max_points rows
+        # - history resume token
+        #       Continue an interrupted history transfer after the block of the continuation token
+        # - format csv|json|binary
+        #       Set the output format of the real-time frames of this client, instead of the server default
+        # - timestamps s|ms
+        #       Send the times of this client, and read those of its commands, in seconds (the default) or milliseconds
+        # - sync start_time end_time
+        #       Send the row count and checksum of every block of the history between start_time and end_time
+        # - metrics
+        #       Send a snapshot of the server metrics once
+        # - percentile channel start_time end_time q
+        #       Send the q-th percentile, q between 0 and 100, of a history channel between start_time and end_time,
+        #       estimated from the quantile sketches of the hours of the range
+        # - aqi
+        #       Send the rolling means, AQI sub-indices and AQI of the latest sample once
+        # Every command is matched as a whole line, so a command with extra arguments is ignored rather than run with
+        # part of them
+        if re.match('stop$', command) is not None:
             self.sending_status['real-time'] = False
             pass
 
-        if re.match('start', command) is not None:
-            self.sending_status['real-time'] = True
-            pass
+        result = re.match(r"start(?: (?!every |delta)(\S+))?(?: every (\d+))?( delta)?$", command)
+        if result is not None:
+            try:
+                channels = parse_channels(result.group(1))
+            except ValueError as e:
+                BTError.print_error(handler=self, error=BTError.ERR_INVALID_ARG, error_message=repr(e))
+            else:
+                self.sending_status['subscription'] = [channels, int(result.group(2) or 0), -1,
+                                                       result.group(3) is not None]
+                self.sending_status['real-time'] = True
+
+        result = re.match(r"history (\d+) (\d+)(?: (\d+))?$", command)
+        if result is not None:
+            self.sending_status['history'] = [True, int(result.group(1)), int(result.group(2)),
+                                              int(result.group(3) or 0), None]
+
+        result = re.match(r"history resume (\S+)$", command)
+        if result is not None:
+            self.sending_status['history'] = [True, -1, -1, 0, result.group(1)]
 
-        result = re.match(r"history (\d+) (\d+)", command)
+        result = re.match(r"format (\S+)$", command)
         if result is not None:
-            self.sending_status['history'] = [True, int(result.group(1)), int(result.group(2))]
+            if result.group(1) in FORMATS:
+                self.sending_status['format'] = result.group(1)
+            else:
+                BTError.print_error(handler=self, error=BTError.ERR_INVALID_ARG,
+                                    error_message="Unknown format {}".format(result.group(1)))
+
+        result = re.match(r"timestamps (s|ms)$", command)
+        if result is not None:
+            self.sending_status['resolution'] = 1000 if result.group(1) == "ms" else 1
+
+        result = re.match(r"sync (\d+) (\d+)$", command)
+        if result is not None:
+            self.sending_status['sync'] = [True, int(result.group(1)), int(result.group(2))]
+
+        if re.match('metrics$', command) is not None:
+            self.sending_status['metrics'] = True
+
+        result = re.match(r"percentile (\S+) (\d+) (\d+) (\d+(?:\.\d*)?)$", command)
+        if result is not None:
+            if float(result.group(4)) <= 100:
+                self.sending_status['percentile'] = [True, result.group(1), int(result.group(2)),
+                                                     int(result.group(3)), float(result.group(4))]
+            else:
+                BTError.print_error(handler=self, error=BTError.ERR_INVALID_ARG,
+                                    error_message="Percentile {} is over 100".format(result.group(4)))
+
+        if re.match('aqi$', command) is not None:
+            self.sending_status['aqi'] = True
 
     def handle_close(self):
         # flush the buffer
         while self.writable():
             self.handle_write()
 
-        self.server.active_client_handlers.remove(self)
+        self.server.scheduler.remove(self)
+        self.server.active_client_handlers.discard(self)
         self.close()
@@ -1,7 +1,14 @@
 import asyncore
 import logging
-from bluetooth import *
+try:
+    from bluetooth import *
+except ImportError:
+    # The client handler and the link scheduler do not need the Bluetooth stack, so that they can be used, for example
+    # by the benchmarks, on a machine without it; only a BTServer cannot be created there
+    BluetoothSocket = None
+    PORT_ANY = 0
 from bthandler import BTClientHandler
+from scheduler import LinkScheduler
 
 logger = logging.getLogger(__name__)
 
@@ -9,7 +16,9 @@ logger = logging.getLogger(__name__)
 class BTServer(asyncore.dispatcher):
     """Asynchronous Bluetooth  Server"""
 
-    def __init__(self, uuid, service_name, port=PORT_ANY):
+    def __init__(self, uuid, service_name, port=PORT_ANY, backlog=1, max_clients=0, baud_rate=115200, metrics=None):
+        if BluetoothSocket is None:
+            raise ImportError("No module named bluetooth")
         asyncore.dispatcher.__init__(self)
 
         self._cmds = {}
@@ -20,15 +29,21 @@ class BTServer(asyncore.dispatcher):
         self.uuid = uuid
         self.service_name = service_name
         self.port = port
+        self.backlog = backlog
+        # Maximum number of connected clients, 0 for no limit
+        self.max_clients = max_clients
 
         # Create the server-side BT socket
         self.set_socket(BluetoothSocket(RFCOMM))
         self.bind(("", self.port))
-        self.listen(1)
+        self.listen(self.backlog)
 
         # Track the client-side handlers with a set
         self.active_client_handlers = set()
 
+        # All clients share the outbound link through the scheduler, which has to be started by the user
+        self.scheduler = LinkScheduler(baud_rate=baud_rate, metrics=metrics)
+
         advertise_service(self.socket,
                           self.service_name,
                           service_id=self.uuid,
@@ -50,6 +65,15 @@ class BTServer(asyncore.dispatcher):
 
         if pair is not None:
             client_sock, client_addr = pair
+
+            if 0 < self.max_clients <= len(self.active_client_handlers):
+                logger.warn("Rejected connection from {}, number of active connections is {}"
+                            .format(repr(client_addr[0]), len(self.active_client_handlers)))
+                print "Rejected connection from {}, number of active connections is {}"\
+                    .format(repr(client_addr[0]), len(self.active_client_handlers))
+                client_sock.close()
+                return
+
             client_handler = BTClientHandler(socket=client_sock, server=self)
             self.active_client_handlers.add(client_handler)
 
@@ -72,4 +96,5 @@ if __name__ == '__main__':
     service_name = "AsynchronousBTServer"
 
     server = BTServer(uuid, service_name)
+    server.scheduler.start()
     asyncore.loop()
@@ -0,0 +1,172 @@
+import logging
+from collections import deque, OrderedDict
+from threading import Condition, Thread
+from time import sleep, time
+
+from bterror import BTError
+
+logger = logging.getLogger(__name__)
+
+
+class LinkScheduler(Thread):
+    """Share the outbound Bluetooth link between the connected clients
+
+    All clients share the capacity of one Bluetooth link, so every write is followed by the time the link needs to
+    transmit it. Real-time frames have strict priority: each client has a single real-time slot, and a frame that is
+    still waiting when the next one arrives is replaced by it, so a real-time frame never waits for more than the line
+    being transmitted plus the frames of the other clients. Bulk data (history transfers, sync summaries) is shared
+    between clients with deficit round robin: each visit gives a client 'quantum' bytes, so clients get the same
+    throughput whatever the length of their lines.
+    """
+
+    def __init__(self, baud_rate=115200, quantum=512, metrics=None):
+        # Parent class constructor
+        Thread.__init__(self, name="Link Scheduler Thread")
+        self.daemon = True
+
+        self.baud_rate = baud_rate
+        self.quantum = quantum
+        self.metrics = metrics
+
+        self.condition = Condition()
+        # Pending real-time frame of each client: handler -> (frame, time it was queued)
+        self.realtime = OrderedDict()
+        # Bulk sources of each client, in round robin order: handler -> deque of iterators over lines
+        self.bulk = OrderedDict()
+        # Deficit counter of each client, and the line that did not fit in its last visit
+        self.deficits = {}
+        self.heads = {}
+
+    def send_realtime(self, handler, frame):
+        # Queue a real-time frame. Returns True if it replaced a frame that had not been sent yet.
+        with self.condition:
+            replaced = handler in self.realtime
+            if replaced:
+                self.increment('realtime_frames_replaced')
+            self.realtime[handler] = (frame, time())
+            self.condition.notify()
+        return replaced
+
+    def send_bulk(self, handler, lines):
+        # Queue an iterable of lines; it is consumed lazily by the scheduler thread
+        with self.condition:
+            if handler not in self.bulk:
+                self.bulk[handler] = deque()
+                self.deficits[handler] = 0
+            self.bulk[handler].append(iter(lines))
+            self.condition.notify()
+
+    def is_sending_realtime(self, handler):
+        # Whether a real-time frame of the client is still waiting to be sent
+        with self.condition:
+            return handler in self.realtime
+
+    def is_sending_bulk(self, handler):
+        with self.condition:
+            return handler in self.bulk
+
+    def remove(self, handler):
+        # Forget everything queued for a client, for example when it disconnects
+        with self.condition:
+            self.realtime.pop(handler, None)
+            self.bulk.pop(handler, None)
+            self.deficits.pop(handler, None)
+            self.heads.pop(handler, None)
+
+    def increment(self, name, value=1):
+        if self.metrics is not None:
+            self.metrics.increment(name, value)
+
+    def transmit(self, handler, data):
+        try:
+            handler.send(data)
+        except Exception as e:
+            BTError.print_error(handler=handler, error=BTError.ERR_WRITE, error_message=repr(e))
+            self.remove(handler)
+            handler.handle_close()
+            return False
+
+        # A character is 8-bit long, so the data has len(data) * 8 bits and the link needs len(data) * 8 / baud_rate
+        # seconds to transmit it; we add 10% margin to this time and wait for such a long time before the next write.
+        sleep(len(data) * 8 * 1.1 / self.baud_rate)
+        return True
+
+    def next_line(self, handler):
+        # Get the next bulk line of a client, or None if all its sources are exhausted. The caller must not hold the
+        # lock: sources are generated outside of it, since a history transfer queries, downsamples and encodes its rows
+        # as it goes, and send_realtime() must not wait for that. Only the scheduler thread consumes the sources.
+        while True:
+            with self.condition:
+                line = self.heads.pop(handler, None)
+                if line is not None:
+                    return line
+                sources = self.bulk.get(handler)
+                if not sources:
+                    return None
+                source = sources[0]
+
+            try:
+                return next(source)
+            except StopIteration:
+                with self.condition:
+                    if sources and sources[0] is source:
+                        sources.popleft()
+
+    def serve_realtime(self):
+        with self.condition:
+            handler, (frame, queued_time) = self.realtime.popitem(last=False)
+        if self.transmit(handler, frame):
+            self.increment('link_bytes_realtime', len(frame))
+            if self.metrics is not None:
+                self.metrics.set_gauge('realtime_latency', time() - queued_time)
+
+    def serve_bulk(self):
+        # Visit the client at the head of the round robin, and move it to the tail
+        with self.condition:
+            handler, sources = self.bulk.popitem(last=False)
+            self.bulk[handler] = sources
+            self.deficits[handler] += self.quantum
+
+        while True:
+            with self.condition:
+                if handler not in self.bulk:
+                    # The client was removed in the meantime
+                    return
+                if len(self.realtime) > 0:
+                    # Serve the real-time frames first; the client keeps its remaining deficit
+                    return
+
+            line = self.next_line(handler)
+
+            with self.condition:
+                if handler not in self.bulk:
+                    return
+                if line is None:
+                    if self.bulk[handler]:
+                        # A new source was queued while the last one was finishing
+                        continue
+                    # Done with this client
+                    self.bulk.pop(handler)
+                    self.deficits.pop(handler)
+                    return
+                if len(self.realtime) > 0 or len(line) > self.deficits[handler]:
+                    # Keep the line for the next visit
+                    self.heads[handler] = line
+                    return
+                self.deficits[handler] -= len(line)
+
+            if not self.transmit(handler, line):
+                return
+            self.increment('link_bytes_bulk', len(line))
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.realtime) == 0 and len(self.bulk) == 0:
+                    self.condition.wait()
+                has_realtime = len(self.realtime) > 0
+
+            if has_realtime:
+                self.serve_realtime()
+            else:
+                self.serve_bulk()
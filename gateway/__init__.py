@@ -0,0 +1,4 @@
+from store import STREAMS, StationStore, StationWriter, get_history_columns
+from board import BoardClient, parse_board_address, parse_boards
+from gateway import Gateway
+from simulator import SimulatedBoard, run_boards
@@ -0,0 +1,121 @@
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+from multiprocessing import Process
+from time import sleep, time
+
+from gateway import Gateway
+from history import open_storage
+from metrics import Metrics
+from simulator import run_boards
+from store import StationStore
+
+logger = logging.getLogger(__name__)
+
+
+def count_rows(store, station, stream):
+    # Count the rows written to a partition
+    path = store.get_partition_path(station, stream)
+    if not os.path.exists(path):
+        return 0
+    partition = open_storage(store.engine, path, [], resolution=store.resolution)
+    try:
+        return sum(1 for _ in partition.query(0, 2 ** 62))
+    finally:
+        partition.close()
+
+
+def wait_written(gateway, metrics, timeout):
+    # Wait until the rows queued by the board connections are written, going on serving them
+    end_time = time() + timeout
+    while time() < end_time:
+        gateway.run_once(0.01)
+        if metrics.get('gateway_rows_written') >= metrics.get('gateway_rows') + metrics.get('gateway_frames'):
+            return True
+    return False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure the ingest throughput of the gateway with simulated boards")
+    parser.add_argument("--stations", dest="stations", type=int, default=200, help="specify number of boards")
+    parser.add_argument("--processes", dest="processes", type=int, default=4,
+                        help="specify number of processes serving the simulated boards")
+    parser.add_argument("--first-port", dest="first_port", type=int, default=19000,
+                        help="specify port of the first simulated board")
+    parser.add_argument("--backlog-hours", dest="backlog_hours", type=float, default=6,
+                        help="specify number of hours of history every board has when the gateway connects")
+    parser.add_argument("--tick", dest="tick", type=float, default=3.0,
+                        help="specify time between two real-time frames of a board in seconds")
+    parser.add_argument("--steady-seconds", dest="steady_seconds", type=float, default=10,
+                        help="specify number of seconds the real-time frames are measured for after the catch-up")
+    parser.add_argument("--storage", dest="storage_engine", default="sqlite",
+                        help="set storage engine of the partitions: sqlite, segment")
+    parser.add_argument("--writers", dest="writers", type=int, default=4,
+                        help="specify number of writer threads of the store")
+    parser.add_argument("--batch-rows", dest="batch_rows", type=int, default=2000,
+                        help="specify number of pending rows that triggers a write")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARN)
+
+    # The boards are served by other processes, so that the gateway has this one for itself
+    stations = ["station-{:03d}".format(i) for i in xrange(0, args.stations)]
+    backlog_rows = int(args.backlog_hours * 3600 / 2.4)
+    simulators = []
+    per_process = (args.stations + args.processes - 1) // args.processes
+    for first in xrange(0, args.stations, per_process):
+        # Every process serves a range of boards on consecutive ports
+        simulator = Process(target=run_boards, args=(stations[first:first + per_process], args.first_port + first,
+                                                     backlog_rows, 2.4, args.tick))
+        simulator.daemon = True
+        simulator.start()
+        simulators.append(simulator)
+    sleep(1)
+
+    directory = tempfile.mkdtemp(prefix="gateway-benchmark-")
+    try:
+        metrics = Metrics()
+        store = StationStore(directory, engine=args.storage_engine, writers=args.writers, batch_rows=args.batch_rows,
+                             metrics=metrics)
+        gateway = Gateway([(station, "127.0.0.1:{}".format(args.first_port + i)) for i, station in enumerate(stations)],
+                          store, metrics=metrics)
+
+        # Catch-up: every board sends its backlog at once
+        start = time()
+        gateway.start()
+        while not gateway.is_caught_up():
+            gateway.run_once(0.01)
+        received = time() - start
+        wait_written(gateway, metrics, 60)
+        elapsed = time() - start
+        rows = metrics.get('gateway_rows')
+        print "Catch-up of {} stations: {} rows received in {:.2f} s, written in {:.2f} s, {:.0f} rows/s"\
+            .format(args.stations, rows, received, elapsed, rows / elapsed)
+
+        # Steady state: real-time frames of every board, and the history polls
+        frames = metrics.get('gateway_frames')
+        written = metrics.get('gateway_rows_written')
+        start = time()
+        gateway.run(args.steady_seconds)
+        wait_written(gateway, metrics, 10)
+        elapsed = time() - start
+        print "Steady state: {:.0f} frames/s received, {:.0f} rows/s written"\
+            .format((metrics.get('gateway_frames') - frames) / elapsed,
+                    (metrics.get('gateway_rows_written') - written) / elapsed)
+
+        snapshot = metrics.snapshot()
+        flush = snapshot.get('gateway_flush_seconds')
+        if flush is not None:
+            print "Batches: {}, mean write time {:.1f} ms".format(flush['count'], flush['sum'] / flush['count'] * 1000)
+        gateway.close()
+
+        # Check that every row the boards sent was written once
+        stored = sum(count_rows(store, station, 'history') for station in stations)
+        print "Rows in the store: {}, received: {}".format(stored, metrics.get('gateway_rows'))
+    finally:
+        shutil.rmtree(directory)
+        for simulator in simulators:
+            simulator.terminate()
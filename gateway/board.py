@@ -0,0 +1,191 @@
+import asyncore
+import logging
+import re
+import socket
+import sys
+from time import time
+
+logger = logging.getLogger(__name__)
+
+# Bluetooth address of a board and its RFCOMM channel, such as '00:11:22:33:44:55/1'; anything else is a TCP host:port
+BT_ADDRESS_PATTERN = re.compile(r"^((?:[0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2})/(\d+)$")
+
+# Number of history rows handed to the store at a time
+CHUNK_ROWS = 256
+
+
+def parse_board_address(text):
+    """Get ('bt', (address, channel)) or ('tcp', (host, port)) of a board address"""
+    result = BT_ADDRESS_PATTERN.match(text)
+    if result is not None:
+        return 'bt', (result.group(1), int(result.group(2)))
+    host, _, port = text.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError("Invalid board address {}".format(text))
+    return 'tcp', (host, int(port))
+
+
+def parse_boards(text):
+    """Get the [(station, address)] of a list of boards, one 'station address' per line or 'station=address' per
+    comma-separated item"""
+    boards = []
+    for item in re.split(r"[,\n]", text):
+        item = item.split("#")[0].strip()
+        if not item:
+            continue
+        fields = re.split(r"\s*=\s*|\s+", item)
+        if len(fields) != 2:
+            raise ValueError("Invalid board {}".format(item))
+        parse_board_address(fields[1])
+        boards.append((fields[0], fields[1]))
+    return boards
+
+
+def parse_value(text):
+    # Values of the history are 'None' for missing ones, and may be 'nan'
+    return None if text == "None" else float(text)
+
+
+class BoardClient(asyncore.dispatcher):
+    """Connection of the gateway to one board, over the client protocol of the board
+
+    On every connection the client asks for CSV frames with times in the resolution of the store, requests the history
+    rows newer than the last one it got, and subscribes to the real-time frames. The history is polled again every
+    poll_interval seconds, so the rows of the board reach the store even when real-time frames are lost. History rows
+    and frames are parsed as they arrive and queued to the store, which writes them from its own threads.
+
+    Boards are reached over Bluetooth RFCOMM, or over TCP for stand-ins such as the simulated boards.
+    """
+
+    def __init__(self, station, address, store, poll_interval=60, metrics=None, map=None):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.station = station
+        self.address = address
+        self.family, self.endpoint = parse_board_address(address)
+        self.store = store
+        self.poll_interval = poll_interval
+        self.metrics = metrics
+
+        # Time of the newest history row received, in the resolution of the store, which the next history request
+        # starts after
+        self.cursor = store.get_last_time(station)
+        # Time of the newest real-time frame received
+        self.frame_time = store.get_last_time(station, 'realtime')
+
+        self.data = ""
+        self.out_data = ""
+        self.rows = []
+        self.history_pending = False
+        self.last_poll_time = 0
+        # Time the connection was closed, to reconnect after a while, and whether the first history response came
+        self.closed_time = None
+        self.caught_up = False
+
+    def open(self):
+        # Connect, or reconnect after the connection was closed
+        if self.family == 'bt':
+            # Imported here so that a gateway of TCP stand-ins does not need the Bluetooth stack
+            from bluetooth import BluetoothSocket, RFCOMM
+            self.set_socket(BluetoothSocket(RFCOMM))
+            self.socket.setblocking(0)
+        else:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.data = ""
+        self.out_data = ""
+        self.rows = []
+        self.history_pending = False
+        self.closed_time = None
+        try:
+            self.connect(self.endpoint)
+        except IOError as e:
+            # Refused right away, a socket or Bluetooth error; otherwise the connection completes, or fails, in the
+            # asyncore loop
+            logger.warn("Error connecting to station {} at {}, reason: {}".format(self.station, self.address, repr(e)))
+            self.handle_close()
+
+    def send_command(self, command):
+        self.out_data += command + "\n"
+
+    def request_history(self):
+        # Rows are requested up to a day ahead of the clock of the gateway, in case the clock of the board is ahead
+        start_time = 0 if self.cursor is None else self.cursor + 1
+        self.send_command("history {} {}".format(start_time, int((time() + 86400) * self.store.resolution)))
+        self.history_pending = True
+        self.last_poll_time = time()
+
+    def poll(self):
+        # Called periodically by the gateway
+        if self.connected and not self.history_pending and time() - self.last_poll_time >= self.poll_interval:
+            self.request_history()
+
+    def handle_connect(self):
+        logger.info("Connected to station {} at {}".format(self.station, self.address))
+        self.increment('gateway_connections')
+        self.send_command("format csv")
+        self.send_command("timestamps ms" if self.store.resolution == 1000 else "timestamps s")
+        self.request_history()
+        self.send_command("start")
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+        lines = (self.data + data).split("\n")
+        self.data = lines.pop()
+
+        for line in lines:
+            if line.startswith("h"):
+                if len(line) == 1:
+                    # End of the history response
+                    self.flush_rows()
+                    self.history_pending = False
+                    self.caught_up = True
+                    continue
+                fields = line[1:].split(",")
+                t = int(fields[0])
+                if self.cursor is None or t > self.cursor:
+                    self.rows.append(tuple([t] + [parse_value(field) for field in fields[1:]]))
+                    self.cursor = t
+                    if len(self.rows) >= CHUNK_ROWS:
+                        self.flush_rows()
+            elif line.startswith("r"):
+                fields = line[1:].split(",")
+                t = int(fields[0])
+                # The board sends the latest sample on every tick, which may be the one it already sent
+                if self.frame_time is None or t > self.frame_time:
+                    self.store.add_frame(self.station, tuple([t] + [float(field) for field in fields[1:]]))
+                    self.frame_time = t
+                    self.increment('gateway_frames')
+            # Continuation tokens and the answers to other commands are not used
+
+    def flush_rows(self):
+        if len(self.rows) > 0:
+            self.store.add_rows(self.station, self.rows)
+            self.increment('gateway_rows', len(self.rows))
+            self.rows = []
+
+    def writable(self):
+        return not self.connected or len(self.out_data) > 0
+
+    def handle_write(self):
+        sent = self.send(self.out_data)
+        self.out_data = self.out_data[sent:]
+
+    def handle_error(self):
+        # Boards that are off refuse the connection until they are back, so only log the error itself
+        logger.warn("Error on the connection to station {} at {}, reason: {}"
+                    .format(self.station, self.address, repr(sys.exc_info()[1])))
+        self.handle_close()
+
+    def handle_close(self):
+        # Rows of an interrupted history response are kept; the next request starts after the last of them
+        self.flush_rows()
+        if self.connected:
+            logger.info("Disconnected from station {}".format(self.station))
+            self.increment('gateway_disconnections')
+        self.close()
+        self.closed_time = time()
+
+    def increment(self, name, value=1):
+        if self.metrics is not None:
+            self.metrics.increment(name, value)
@@ -0,0 +1,115 @@
+import argparse
+import asyncore
+import json
+import logging
+from time import time
+
+from board import BoardClient, parse_boards
+from metrics import Metrics
+from store import StationStore
+
+logger = logging.getLogger(__name__)
+
+
+class Gateway(object):
+    """Aggregation gateway of many boards
+
+    All the board connections are served by a single asyncore loop, which only parses; the rows are written by the
+    writer threads of the store. Between two rounds of the loop, the gateway polls the history of the connected boards
+    and reconnects the others.
+    """
+
+    def __init__(self, boards, store, poll_interval=60, reconnect_interval=10, metrics=None):
+        self.store = store
+        self.reconnect_interval = reconnect_interval
+        self.metrics = metrics
+        # Socket map of the board connections, apart from any other asyncore server of the process
+        self.map = {}
+        self.clients = [BoardClient(station, address, store, poll_interval, metrics=metrics, map=self.map)
+                        for station, address in boards]
+
+    def start(self):
+        self.store.start()
+        for client in self.clients:
+            client.open()
+
+    def run_once(self, timeout=1.0):
+        asyncore.loop(timeout=timeout, map=self.map, count=1)
+
+        now = time()
+        connected = 0
+        for client in self.clients:
+            if client.closed_time is not None:
+                if now - client.closed_time >= self.reconnect_interval:
+                    client.open()
+            else:
+                client.poll()
+                connected += client.connected
+        if self.metrics is not None:
+            self.metrics.set_gauge('gateway_connected', connected)
+
+    def run(self, duration=None):
+        end_time = None if duration is None else time() + duration
+        while end_time is None or time() < end_time:
+            self.run_once()
+
+    def is_caught_up(self):
+        # Whether every board has answered its first history request
+        return all(client.caught_up for client in self.clients)
+
+    def close(self):
+        for client in self.clients:
+            client.flush_rows()
+            client.close()
+        self.store.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Collect the history and real-time frames of many boards")
+    parser.add_argument("--boards", dest="boards", required=True,
+                        help="specify file of the boards, one 'station address' per line, or a list such as "
+                             "'north=00:11:22:33:44:55/1,south=192.168.1.20:9000'")
+    parser.add_argument("--directory", dest="directory", default="gateway_data",
+                        help="specify directory of the station partitions")
+    parser.add_argument("--storage", dest="storage_engine", default="sqlite",
+                        help="set storage engine of the partitions: sqlite, segment")
+    parser.add_argument("--writers", dest="writers", type=int, default=4,
+                        help="specify number of writer threads the stations are sharded between")
+    parser.add_argument("--batch-rows", dest="batch_rows", type=int, default=2000,
+                        help="specify number of pending rows that triggers a write")
+    parser.add_argument("--flush-interval", dest="flush_interval", type=float, default=1.0,
+                        help="specify maximum number of seconds rows wait before being written")
+    parser.add_argument("--poll-interval", dest="poll_interval", type=float, default=60,
+                        help="specify number of seconds between two history requests to a board")
+    parser.add_argument("--reconnect-interval", dest="reconnect_interval", type=float, default=10,
+                        help="specify number of seconds before reconnecting to a board")
+    parser.add_argument("--status-interval", dest="status_interval", type=float, default=60,
+                        help="specify number of seconds between two status lines")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        with open(args.boards) as f:
+            boards = parse_boards(f.read())
+    except IOError:
+        boards = parse_boards(args.boards)
+
+    metrics = Metrics()
+    store = StationStore(args.directory, engine=args.storage_engine, writers=args.writers, batch_rows=args.batch_rows,
+                         flush_interval=args.flush_interval, metrics=metrics)
+    gateway = Gateway(boards, store, poll_interval=args.poll_interval, reconnect_interval=args.reconnect_interval,
+                      metrics=metrics)
+    gateway.start()
+    print "Collecting {} stations into {}".format(len(boards), args.directory)
+
+    status_time = time()
+    try:
+        while True:
+            gateway.run_once()
+            if time() - status_time >= args.status_interval:
+                print json.dumps(metrics.snapshot())
+                status_time = time()
+    except KeyboardInterrupt:
+        gateway.close()
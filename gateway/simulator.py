@@ -0,0 +1,184 @@
+import argparse
+import asynchat
+import asyncore
+import logging
+import math
+import re
+import socket
+import sys
+from itertools import chain
+from time import time
+
+from history import encode_history, scale_range
+from realtime import CHANNELS, FrameCache
+
+logger = logging.getLogger(__name__)
+
+# Typical level and swing of every channel of the history, which are also the channels of the real-time frames
+LEVELS = [(22.0, 5.0), (40.0, 20.0), (30.0, 15.0), (400.0, 200.0), (10.0, 5.0), (12.0, 8.0)]
+
+
+class LineProducer(object):
+    # Producer of an async_chat that joins lines into chunks, so that a long history is encoded as it is sent
+    def __init__(self, lines, chunk_bytes=65536):
+        self.lines = iter(lines)
+        self.chunk_bytes = chunk_bytes
+
+    def more(self):
+        chunk = []
+        size = 0
+        for line in self.lines:
+            chunk.append(line)
+            size += len(line)
+            if size >= self.chunk_bytes:
+                break
+        return "".join(chunk)
+
+
+class SimulatedClientHandler(asynchat.async_chat):
+    """Client connection of a simulated board, with the commands a gateway uses: format, timestamps, history, start and
+    stop"""
+
+    def __init__(self, sock, board, map=None):
+        asynchat.async_chat.__init__(self, sock, map=map)
+        self.set_terminator("\n")
+        self.board = board
+        self.data = []
+        self.realtime = False
+        self.client_resolution = 1
+        self.last_frame_time = 0
+
+    def collect_incoming_data(self, data):
+        self.data.append(data)
+
+    def found_terminator(self):
+        command = "".join(self.data).strip()
+        self.data = []
+
+        result = re.match(r"history (\d+) (\d+)$", command)
+        if result is not None:
+            start_time, end_time = scale_range(int(result.group(1)), int(result.group(2)), self.client_resolution,
+                                               self.board.resolution)
+            rows = self.board.get_rows(start_time, end_time)
+            lines = encode_history(rows, start_time, end_time, resolution=self.board.resolution,
+                                   client_resolution=self.client_resolution)
+            self.push_with_producer(LineProducer(chain(lines, ["h\n"])))
+        elif re.match(r"timestamps (s|ms)$", command) is not None:
+            self.client_resolution = 1000 if command.endswith("ms") else 1
+        elif command.startswith("start"):
+            self.realtime = True
+        elif command == "stop":
+            self.realtime = False
+        # Only CSV frames are simulated, and other commands are ignored
+
+    def handle_close(self):
+        self.board.handlers.discard(self)
+        self.close()
+
+
+class SimulatedBoard(asyncore.dispatcher):
+    """Stand-in for a board, serving its client protocol over TCP
+
+    The board has a synthetic history of backlog_rows rows sampled every period seconds up to the time of its creation,
+    and goes on sampling as time passes. History responses are sent as fast as the connection allows, and real-time
+    frames of the latest sample every tick seconds, like the main loop of a board.
+    """
+
+    def __init__(self, station, port, backlog_rows=0, period=2.4, tick=3.0, resolution=1, host="127.0.0.1", map=None):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.station = station
+        self.period = period
+        self.tick = tick
+        self.resolution = resolution
+        self.socket_map = map
+        self.handlers = set()
+
+        # Time of the first sample, and time between two samples, in time units
+        self.sample_period = period * resolution
+        self.first_time = int((time() - backlog_rows * period) * resolution)
+        # Phase of the synthetic signals, so that stations differ
+        self.phase = sum(ord(c) for c in station)
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(5)
+
+    def get_row(self, k):
+        # Get the k-th sample of the history
+        x = (k + self.phase) * 0.01
+        return tuple([self.first_time + int(k * self.sample_period)] +
+                     [level + swing * math.sin(x + i) for i, (level, swing) in enumerate(LEVELS)])
+
+    def get_rows(self, start_time, end_time):
+        """Yield the rows sampled so far between start_time and end_time, both inclusive"""
+        end_time = min(end_time, int(time() * self.resolution))
+        k = max(0, int((start_time - self.first_time) / self.sample_period) - 1)
+        while True:
+            t = self.first_time + int(k * self.sample_period)
+            if t > end_time:
+                return
+            if t >= start_time:
+                yield self.get_row(k)
+            k += 1
+
+    def get_sample(self):
+        # Get the latest sample as the sample of a real-time frame
+        k = int((time() * self.resolution - self.first_time) / self.sample_period)
+        row = self.get_row(k)
+        sample = dict(zip(CHANNELS, row[1:]))
+        sample['time'] = row[0]
+        return sample
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            self.handlers.add(SimulatedClientHandler(pair[0], self, map=self.socket_map))
+
+    def send_frames(self):
+        # Send the frame of the latest sample to the subscribed clients whose tick has come
+        now = time()
+        frame_cache = None
+        for handler in list(self.handlers):
+            if handler.realtime and now - handler.last_frame_time >= self.tick:
+                if frame_cache is None:
+                    frame_cache = FrameCache(self.get_sample(), resolution=self.resolution)
+                handler.push(frame_cache.get("csv", CHANNELS, handler.client_resolution))
+                handler.last_frame_time = now
+
+
+def run_boards(stations, first_port, backlog_rows=0, period=2.4, tick=3.0, resolution=1, duration=None):
+    """Serve simulated boards on consecutive ports, in one asyncore loop"""
+    socket_map = {}
+    boards = [SimulatedBoard(station, first_port + i, backlog_rows, period, tick, resolution, map=socket_map)
+              for i, station in enumerate(stations)]
+    end_time = None if duration is None else time() + duration
+    while end_time is None or time() < end_time:
+        asyncore.loop(timeout=min(0.1, tick), map=socket_map, count=1)
+        for board in boards:
+            board.send_frames()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve simulated boards over TCP, for trying the gateway")
+    parser.add_argument("--stations", dest="stations", type=int, default=10, help="specify number of boards")
+    parser.add_argument("--first-port", dest="first_port", type=int, default=9000,
+                        help="specify port of the first board; the others listen on the next ports")
+    parser.add_argument("--backlog-hours", dest="backlog_hours", type=float, default=24,
+                        help="specify number of hours of history the boards have when they start")
+    parser.add_argument("--sample-period", dest="sample_period", type=float, default=2.4,
+                        help="specify time between two samples in seconds")
+    parser.add_argument("--tick", dest="tick", type=float, default=3.0,
+                        help="specify time between two real-time frames in seconds")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    stations = ["station-{:03d}".format(i) for i in xrange(0, args.stations)]
+    for i, station in enumerate(stations):
+        # Boards file of the gateway
+        print "{} 127.0.0.1:{}".format(station, args.first_port + i)
+    sys.stdout.flush()
+    run_boards(stations, args.first_port, int(args.backlog_hours * 3600 / args.sample_period), args.sample_period,
+               args.tick)
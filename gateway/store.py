@@ -0,0 +1,209 @@
+import logging
+import os
+import re
+import zlib
+from Queue import Empty, Queue
+from threading import Lock, Thread
+from time import time
+
+from history import open_storage
+from realtime import CHANNELS
+from sensor import get_channel_names
+
+logger = logging.getLogger(__name__)
+
+# Streams of a station, each kept in a partition of its own: the history rows of the board and its real-time frames
+STREAMS = ('history', 'realtime')
+
+# Station names are used in file names
+STATION_PATTERN = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+
+def get_history_columns(n_values):
+    """Get the history channels of a board from the number of values of its rows, which tells whether it records the
+    motion and onboard channels"""
+    for motion in (False, True):
+        for onboard in (False, True):
+            value_columns = get_channel_names(motion, onboard)
+            if len(value_columns) == n_values:
+                return value_columns
+    raise ValueError("No history layout has {} channels".format(n_values))
+
+
+class StationWriter(Thread):
+    """Writer thread of one shard of the stations
+
+    Rows are queued by the network thread and written in batches: the writer collects them until batch_rows rows are
+    pending, or the oldest of them has waited flush_interval seconds, then inserts the rows of each partition with one
+    statement and commits each partition once. Every partition belongs to a single writer, so writers never contend for
+    a database.
+    """
+
+    def __init__(self, store, shard):
+        # Parent class constructor
+        Thread.__init__(self, name="Station Writer {}".format(shard))
+        self.daemon = True
+
+        self.store = store
+        # The queue is bounded, so a gateway that cannot keep up stops reading the boards instead of filling the memory
+        self.queue = Queue(maxsize=store.queue_size)
+        # Open partitions: (station, stream) -> storage
+        self.partitions = {}
+        # Rows waiting for the next flush: (station, stream) -> list of rows
+        self.pending = {}
+        self.pending_rows = 0
+        self.pending_since = None
+
+    def get_partition(self, station, stream, n_values):
+        # Open the partition of a stream, reopening it with more channels if the board started recording new ones
+        key = (station, stream)
+        partition = self.partitions.get(key)
+        if partition is None or len(partition.value_columns) < n_values:
+            if partition is not None:
+                partition.close()
+            value_columns = get_history_columns(n_values) if stream == 'history' else list(CHANNELS)
+            partition = open_storage(self.store.engine, self.store.get_partition_path(station, stream), value_columns,
+                                     writable=True, resolution=self.store.resolution)
+            self.partitions[key] = partition
+        return partition
+
+    def flush(self):
+        if self.pending_rows == 0:
+            return
+        start = time()
+        for (station, stream), rows in self.pending.iteritems():
+            try:
+                partition = self.get_partition(station, stream, max(len(row) for row in rows) - 1)
+                # Rows of a board that stopped recording some channels get no value for them
+                width = len(partition.value_columns) + 1
+                partition.insert_many([row if len(row) == width else tuple(row) + (None,) * (width - len(row))
+                                       for row in rows])
+                partition.commit()
+                self.store.increment('gateway_rows_written', len(rows))
+            except Exception as e:
+                # Drop the batch of this partition only; the board sends the history rows again after a reconnection
+                logger.error("Error writing {} rows of station {}, reason: {}".format(len(rows), station, repr(e)))
+                self.store.increment('gateway_write_errors')
+        self.store.increment('gateway_batches')
+        self.store.observe('gateway_flush_seconds', time() - start)
+        self.pending = {}
+        self.pending_rows = 0
+        self.pending_since = None
+
+    def run(self):
+        while True:
+            timeout = self.store.flush_interval
+            if self.pending_since is not None:
+                timeout = max(0.0, self.pending_since + self.store.flush_interval - time())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except Empty:
+                item = ()
+
+            if item is None:
+                # Closing
+                self.flush()
+                for partition in self.partitions.itervalues():
+                    partition.close()
+                self.queue.task_done()
+                return
+
+            if len(item) > 0:
+                station, stream, rows = item
+                self.pending.setdefault((station, stream), []).extend(rows)
+                self.pending_rows += len(rows)
+                if self.pending_since is None:
+                    self.pending_since = time()
+                self.queue.task_done()
+
+            if self.pending_rows >= self.store.batch_rows or \
+                    (self.pending_since is not None and time() - self.pending_since >= self.store.flush_interval):
+                self.flush()
+
+
+class StationStore(object):
+    """History and real-time frames of many stations, one partition per station and stream
+
+    Each partition is a history storage of its own, in a directory shared by all the stations, so stations are added
+    without schema changes, boards with different channels live side by side, and a station can be copied or dropped
+    as a file. Stations are sharded between writer threads by a hash of their name. Times are in units of
+    1 / resolution seconds, milliseconds by default, whatever the resolution of the boards.
+    """
+
+    def __init__(self, directory, engine="sqlite", writers=4, batch_rows=2000, flush_interval=1.0, queue_size=1024,
+                 resolution=1000, metrics=None):
+        self.directory = directory
+        self.engine = engine
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.resolution = resolution
+        self.metrics = metrics
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        self.writers = [StationWriter(self, shard) for shard in xrange(0, writers)]
+        # Latest real-time frame of each station
+        self.latest = {}
+        self.lock = Lock()
+
+    def start(self):
+        for writer in self.writers:
+            writer.start()
+
+    def get_partition_path(self, station, stream):
+        if STATION_PATTERN.match(station) is None:
+            raise ValueError("Invalid station name {}".format(station))
+        name = "{}.{}".format(station, stream)
+        return os.path.join(self.directory, name + ".db" if self.engine == "sqlite" else name)
+
+    def get_writer(self, station):
+        return self.writers[zlib.crc32(station) % len(self.writers)]
+
+    def get_last_time(self, station, stream='history'):
+        """Get the time of the newest row written to a partition, or None if it has none"""
+        path = self.get_partition_path(station, stream)
+        if not os.path.exists(path):
+            return None
+        partition = open_storage(self.engine, path, [], resolution=self.resolution)
+        try:
+            return partition.get_last_time()
+        finally:
+            partition.close()
+
+    def add_rows(self, station, rows, stream='history'):
+        # Queue rows, in time order, to be written by the writer of the station. Blocks while its queue is full.
+        if len(rows) == 0:
+            return
+        self.get_writer(station).queue.put((station, stream, rows))
+        self.increment('gateway_rows_queued', len(rows))
+
+    def add_frame(self, station, row):
+        # Keep the latest real-time frame of a station, and queue it to be written
+        with self.lock:
+            self.latest[station] = row
+        self.add_rows(station, [row], 'realtime')
+
+    def get_latest(self, station):
+        with self.lock:
+            return self.latest.get(station)
+
+    def get_queued(self):
+        # Get the number of batches waiting in the writer queues
+        return sum(writer.queue.qsize() for writer in self.writers)
+
+    def close(self):
+        # Write the pending rows and close the partitions
+        for writer in self.writers:
+            writer.queue.put(None)
+        for writer in self.writers:
+            writer.join()
+
+    def increment(self, name, value=1):
+        if self.metrics is not None:
+            self.metrics.increment(name, value)
+
+    def observe(self, name, value):
+        if self.metrics is not None:
+            self.metrics.observe(name, value, [0.001, 0.01, 0.1, 1.0])
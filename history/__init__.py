@@ -0,0 +1,10 @@
+from cache import HistoryCache
+from migrate import migrate, needs_migration
+from archive import HistoryArchive, HistoryArchiver
+from storage import CONFLICT_POLICIES, HistoryStorage, SQLiteStorage, StorageLockedError, open_storage
+from segment import SegmentStorage
+from downsample import LTTBDownsampler, downsample
+from transfer import decode_token, encode_history, encode_row, encode_token, scale_range, scale_time
+from sync import BlockSummaries
+from sketch import HourlySketches, TDigest
+from bulk import export_history, import_history
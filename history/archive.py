@@ -0,0 +1,160 @@
+import gzip
+import logging
+import os
+from threading import Thread
+from time import gmtime, sleep, strftime, time
+
+from storage import open_storage
+
+logger = logging.getLogger(__name__)
+
+SECONDS_PER_DAY = 86400
+
+
+class HistoryArchive(object):
+    """Cold archive of history rows, stored as one gzip-compressed CSV file per UTC day
+
+    Times are in the resolution of the storage the rows come from, in units of 1 / resolution seconds.
+    """
+
+    def __init__(self, archive_dir="archive", resolution=1):
+        self.archive_dir = archive_dir
+        self.resolution = resolution
+        # Length of a day in time units
+        self.day = SECONDS_PER_DAY * self.resolution
+        if not os.path.isdir(self.archive_dir):
+            os.makedirs(self.archive_dir)
+
+    def get_day_path(self, day_start):
+        return os.path.join(self.archive_dir, strftime("%Y-%m-%d", gmtime(day_start // self.resolution)) + ".csv.gz")
+
+    @staticmethod
+    def encode_row(row):
+        # Format the time with %d, since repr() of the long integers that millisecond times are on a 32-bit board ends
+        # with an 'L'. Use repr() so that the values survive the round trip, and an empty field for NULL.
+        return "%d" % row[0] + "".join("," if value is None else "," + repr(float(value)) for value in row[1:]) + "\n"
+
+    @staticmethod
+    def decode_row(line):
+        # Archives written before the time was formatted with %d may have times with a trailing 'L'
+        fields = line.rstrip("\n").split(",")
+        return tuple([int(fields[0].rstrip("L"))] + [None if field == "" else float(field) for field in fields[1:]])
+
+    def read_day(self, day_start):
+        # Get the rows of the day starting at day_start, or an empty list if the day has not been archived
+        path = self.get_day_path(day_start)
+        if not os.path.exists(path):
+            return []
+
+        with gzip.open(path, "rb") as reader:
+            return [self.decode_row(line) for line in reader]
+
+    def write_day(self, day_start, rows):
+        # Merge rows into the file of the day. The file is written aside and renamed over the old one, so a crash
+        # never leaves a truncated archive behind.
+        merged = dict((row[0], row) for row in self.read_day(day_start))
+        for row in rows:
+            merged[row[0]] = row
+
+        path = self.get_day_path(day_start)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as writer:
+                for t in sorted(merged):
+                    writer.write(self.encode_row(merged[t]))
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.rename(tmp_path, path)
+
+        return os.path.getsize(path)
+
+    def read_range(self, start_time, end_time):
+        # Yield the archived rows between start_time and end_time in time order
+        day_start = start_time - start_time % self.day
+        while day_start <= end_time:
+            for row in self.read_day(day_start):
+                if start_time <= row[0] <= end_time:
+                    yield row
+            day_start += self.day
+
+    def get_size(self):
+        # Get the total size of the archive files in bytes
+        return sum(os.path.getsize(os.path.join(self.archive_dir, name))
+                   for name in os.listdir(self.archive_dir) if name.endswith(".csv.gz"))
+
+
+class HistoryArchiver(Thread):
+    """Background thread that moves rows older than the retention period from the storage into the archive"""
+
+    def __init__(self, engine, database_name, value_columns, archive, retention_days, interval=3600, max_days=7,
+                 metrics=None):
+        # Parent class constructor
+        Thread.__init__(self)
+
+        self.engine = engine
+        self.database_name = database_name
+        self.value_columns = value_columns
+        self.archive = archive
+        self.retention_days = retention_days
+        self.interval = interval
+        # Number of days moved per run, so that a board that has been collecting for months without a retention
+        # policy catches up over several runs instead of holding the database for a long time.
+        self.max_days = max_days
+        self.metrics = metrics
+
+    def archive_once(self, storage, now=None):
+        # Move whole days older than the retention period, one day per transaction. Returns the number of moved rows.
+        # now is in seconds, and the days in the resolution of the storage and the archive.
+        if now is None:
+            now = int(time())
+        now *= self.archive.resolution
+        day = self.archive.day
+        cutoff = now - now % day - self.retention_days * day
+
+        oldest = storage.get_first_time()
+        if oldest is None or oldest >= cutoff:
+            return 0
+
+        n = 0
+        day_start = oldest - oldest % day
+        for i in xrange(0, self.max_days):
+            if day_start >= cutoff:
+                break
+
+            day_end = day_start + day
+            rows = list(storage.query(day_start, day_end - 1))
+            if len(rows) > 0:
+                # The rows are only deleted once the day file is safely on disk. If we crash in between, the rows are
+                # merged into the file again on the next run.
+                self.archive.write_day(day_start, rows)
+                storage.delete_before(day_end)
+                storage.commit()
+                n += len(rows)
+
+                logger.info("Archived {} rows into {}".format(len(rows), self.archive.get_day_path(day_start)))
+            day_start = day_end
+
+        storage.reclaim()
+
+        if self.metrics is not None:
+            self.metrics.increment('archived_rows', n)
+            self.metrics.set_gauge('archive_bytes', self.archive.get_size())
+        return n
+
+    def run(self):
+        try:
+            storage = open_storage(self.engine, self.database_name, self.value_columns)
+        except Exception as e:
+            logger.error("Error opening the history storage {}, reason: {}".format(self.database_name, repr(e)))
+            return
+
+        if self.engine == "sqlite" and storage.db_conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            logger.warn("Database {} does not use incremental vacuum, archived rows will not shrink the file until "
+                        "'python -m history.migrate {} --vacuum' is run".format(self.database_name, self.database_name))
+
+        while True:
+            try:
+                self.archive_once(storage)
+            except Exception as e:
+                logger.error("Error archiving history, reason: {}".format(repr(e)))
+            sleep(self.interval)
@@ -0,0 +1,423 @@
+import argparse
+import ast
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import zipfile
+from array import array
+from itertools import islice
+from time import time
+
+from archive import HistoryArchive
+from migrate import get_columns
+from segment import SEGMENT_HEADER, SEGMENT_MAGIC, encode_segment, from_bytes, to_bytes
+from sketch import HourlySketches
+from storage import CONFLICT_POLICIES, open_storage
+from sync import BlockSummaries
+from transfer import scale_time
+
+logger = logging.getLogger(__name__)
+
+# Formats of the files: CSV, optionally gzip-compressed, NumPy .npz with one array per column, and a columnar binary
+# file made of segments
+FORMATS = ('csv', 'npz', 'col')
+
+# Number of rows of a block of the columnar format, and of the chunks the other formats are read and written in
+BLOCK_ROWS = 65536
+
+# Header of a columnar file: magic, time resolution, length of the comma-separated channel names that follow. Blocks
+# of up to BLOCK_ROWS rows come next, each encoded as a sealed segment of the segment storage engine.
+COLUMNAR_HEADER = struct.Struct("<4sII")
+COLUMNAR_MAGIC = "APSC"
+
+# The .npy members of an .npz file are written without NumPy, with headers of a fixed length so that the number of rows
+# can be filled in once it is known
+NPY_MAGIC = "\x93NUMPY"
+NPY_HEADER_BYTES = 128
+# struct codes of the .npy types that are read
+NPY_TYPES = {'<i8': 'q', '<i4': 'i', '<f8': 'd', '<f4': 'f'}
+
+
+def get_format(path, fmt=None):
+    # Get the format of a file from its extension, unless given
+    if fmt is not None:
+        if fmt not in FORMATS:
+            raise ValueError("Unknown format {}".format(fmt))
+        return fmt
+    for extension, fmt in (('.csv', 'csv'), ('.csv.gz', 'csv'), ('.npz', 'npz'), ('.col', 'col')):
+        if path.endswith(extension):
+            return fmt
+    raise ValueError("Unknown format of {}, use --format".format(path))
+
+
+def get_time_name(resolution):
+    # Name of the time column of the CSV files, which tells their resolution
+    return "time" if resolution == 1 else "time_ms"
+
+
+def get_value_columns(engine, database_name):
+    """Get the channels of an existing history storage"""
+    if engine == "sqlite":
+        db_conn = sqlite3.connect(database_name)
+        try:
+            columns = get_columns(db_conn.cursor())
+        finally:
+            db_conn.close()
+        if len(columns) == 0:
+            raise ValueError("Database {} has no history".format(database_name))
+        return [name for name, _, pk in columns if not pk]
+
+    columns_path = os.path.join(database_name, "columns")
+    if not os.path.exists(columns_path):
+        raise ValueError("Storage {} does not record its channels".format(database_name))
+    with open(columns_path) as f:
+        return f.readline().strip().split(",")
+
+
+def iter_chunks(rows, chunk_rows=BLOCK_ROWS):
+    # Group an iterable of rows into lists of at most chunk_rows rows
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_rows))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def encode_npy_header(descr, shape):
+    # Header of a .npy file of version 1.0, padded with spaces to NPY_HEADER_BYTES
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': {}, }}".format(
+        descr, "({},)".format(shape[0]) if len(shape) > 0 else "()")
+    header = header.ljust(NPY_HEADER_BYTES - len(NPY_MAGIC) - 4 - 1) + "\n"
+    return NPY_MAGIC + "\x01\x00" + struct.pack("<H", len(header)) + header
+
+
+def read_npy_header(reader):
+    # Get (struct code, number of values) of a .npy file, leaving the reader at the start of the data
+    magic = reader.read(len(NPY_MAGIC) + 2)
+    if magic[:len(NPY_MAGIC)] != NPY_MAGIC:
+        raise ValueError("Not a .npy file")
+    if ord(magic[len(NPY_MAGIC)]) == 1:
+        length = struct.unpack("<H", reader.read(2))[0]
+    else:
+        length = struct.unpack("<I", reader.read(4))[0]
+    header = ast.literal_eval(reader.read(length))
+    if header['descr'] not in NPY_TYPES or len(header['shape']) > 1:
+        raise ValueError("Unsupported array {} of shape {}".format(header['descr'], header['shape']))
+    return NPY_TYPES[header['descr']], header['shape'][0] if len(header['shape']) > 0 else 1
+
+
+class CsvWriter(object):
+    # Rows as CSV lines with a header line, in the encoding of the archive
+    def __init__(self, path, value_columns, resolution):
+        self.file = gzip.open(path, "wb", 6) if path.endswith(".gz") else open(path, "wb")
+        self.file.write(",".join([get_time_name(resolution)] + list(value_columns)) + "\n")
+        # Rows without missing values are formatted at once, repr() being what %r gives
+        self.row_format = "%d" + ",%r" * len(value_columns) + "\n"
+
+    def write(self, rows):
+        row_format = self.row_format
+        encode_row = HistoryArchive.encode_row
+        self.file.write("".join(encode_row(row) if None in row else row_format % tuple(row) for row in rows))
+
+    def close(self):
+        self.file.close()
+
+
+class NpzWriter(object):
+    # One array per column, 'time' first, and a 'resolution' scalar. The columns are written to .npy files of their
+    # own as the rows come, then stored in the archive.
+    def __init__(self, path, value_columns, resolution, compress=False):
+        self.path = path
+        self.names = ["time"] + list(value_columns)
+        self.resolution = resolution
+        self.compress = compress
+        self.n = 0
+        self.tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+        self.files = [open(os.path.join(self.tmp_dir, "{}.npy".format(i)), "wb") for i in xrange(0, len(self.names))]
+        for i in xrange(0, len(self.names)):
+            self.files[i].write(encode_npy_header("<i8" if i == 0 else "<f8", (0,)))
+
+    def write(self, rows):
+        columns = zip(*rows)
+        self.files[0].write(struct.pack("<{}q".format(len(rows)), *columns[0]))
+        for i in xrange(1, len(columns)):
+            column = columns[i]
+            if None in column:
+                column = [float("nan") if value is None else value for value in column]
+            self.files[i].write(to_bytes(array("d", column)))
+        self.n += len(rows)
+
+    def close(self):
+        try:
+            with zipfile.ZipFile(self.path, "w", zipfile.ZIP_DEFLATED if self.compress else zipfile.ZIP_STORED,
+                                 allowZip64=True) as archive:
+                for i in xrange(0, len(self.names)):
+                    self.files[i].seek(0)
+                    self.files[i].write(encode_npy_header("<i8" if i == 0 else "<f8", (self.n,)))
+                    self.files[i].close()
+                    archive.write(self.files[i].name, self.names[i] + ".npy")
+                archive.writestr("resolution.npy", encode_npy_header("<i8", ()) + struct.pack("<q", self.resolution))
+        finally:
+            shutil.rmtree(self.tmp_dir)
+
+
+class ColumnarWriter(object):
+    # The header, then every chunk of rows as a segment
+    def __init__(self, path, value_columns, resolution):
+        self.file = open(path, "wb")
+        names = ",".join(value_columns)
+        self.file.write(COLUMNAR_HEADER.pack(COLUMNAR_MAGIC, resolution, len(names)) + names)
+
+    def write(self, rows):
+        self.file.write(encode_segment(rows))
+
+    def close(self):
+        self.file.close()
+
+
+def read_csv(path):
+    reader = gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+    names = reader.readline().strip().split(",")
+    if names[0] not in ("time", "time_ms"):
+        raise ValueError("{} has no time column".format(path))
+
+    def read_chunks():
+        try:
+            decode_row = HistoryArchive.decode_row
+            for lines in iter_chunks(reader):
+                yield [decode_row(line) for line in lines]
+        finally:
+            reader.close()
+
+    return names[1:], 1 if names[0] == "time" else 1000, read_chunks()
+
+
+def read_npz(path):
+    archive = zipfile.ZipFile(path)
+    names = [name[:-4] for name in archive.namelist() if name.endswith(".npy")]
+    if "time" not in names:
+        raise ValueError("{} has no time array".format(path))
+
+    resolution = 1
+    if "resolution" in names:
+        with archive.open("resolution.npy") as reader:
+            code, _ = read_npy_header(reader)
+            resolution = int(struct.unpack("<" + code, reader.read(struct.calcsize(code)))[0])
+    value_columns = [name for name in names if name not in ("time", "resolution")]
+
+    # Read the arrays side by side, a chunk at a time
+    readers = [archive.open(name + ".npy") for name in ["time"] + value_columns]
+    headers = [read_npy_header(reader) for reader in readers]
+    n = headers[0][1]
+    if any(length != n for _, length in headers):
+        raise ValueError("Arrays of {} differ in length".format(path))
+
+    def read_chunks():
+        try:
+            for offset in xrange(0, n, BLOCK_ROWS):
+                k = min(BLOCK_ROWS, n - offset)
+                columns = [struct.unpack("<{}{}".format(k, code), reader.read(k * struct.calcsize(code)))
+                           for reader, (code, _) in zip(readers, headers)]
+                if headers[0][0] != "q":
+                    columns[0] = [int(t) for t in columns[0]]
+                yield zip(*columns)
+        finally:
+            for reader in readers:
+                reader.close()
+            archive.close()
+
+    return value_columns, resolution, read_chunks()
+
+
+def read_columnar(path):
+    reader = open(path, "rb")
+    magic, resolution, length = COLUMNAR_HEADER.unpack(reader.read(COLUMNAR_HEADER.size))
+    if magic != COLUMNAR_MAGIC:
+        reader.close()
+        raise ValueError("{} is not a columnar history file".format(path))
+    value_columns = reader.read(length).split(",")
+
+    def read_chunks():
+        try:
+            while True:
+                header = reader.read(SEGMENT_HEADER.size)
+                if len(header) < SEGMENT_HEADER.size:
+                    return
+                magic, n, n_columns, _, _ = SEGMENT_HEADER.unpack(header)
+                if magic != SEGMENT_MAGIC:
+                    raise ValueError("Corrupted block in {}".format(path))
+                columns = [struct.unpack("<{}q".format(n), reader.read(n * 8))]
+                for _ in xrange(0, n_columns):
+                    columns.append(from_bytes("d", reader.read(n * 8)))
+                yield zip(*columns)
+        finally:
+            reader.close()
+
+    return value_columns, resolution, read_chunks()
+
+
+def export_history(engine, database_name, path, fmt=None, start_time=0, end_time=2 ** 62, compress=False):
+    """Write the history rows between start_time and end_time, in the resolution of the storage, to a file, and get the
+    number of rows written
+
+    Rows are streamed from the storage a chunk at a time, so the memory used does not depend on the length of the range.
+    The file is written aside and renamed once complete.
+    """
+    fmt = get_format(path, fmt)
+    value_columns = get_value_columns(engine, database_name)
+    storage = open_storage(engine, database_name, value_columns)
+    tmp_path = path + ".tmp" + (".gz" if path.endswith(".gz") else "")
+    try:
+        if fmt == "csv":
+            writer = CsvWriter(tmp_path, value_columns, storage.resolution)
+        elif fmt == "npz":
+            writer = NpzWriter(tmp_path, value_columns, storage.resolution, compress)
+        else:
+            writer = ColumnarWriter(tmp_path, value_columns, storage.resolution)
+
+        n = 0
+        try:
+            for rows in iter_chunks(storage.query(start_time, end_time)):
+                writer.write(rows)
+                n += len(rows)
+        finally:
+            writer.close()
+        os.rename(tmp_path, path)
+        return n
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        storage.close()
+
+
+def invalidate_summaries(database_name, value_columns, resolution, start_time):
+    # Drop the block summaries and quantile sketches saved next to the history from the block of start_time on, with
+    # the blocks of an hour of the sensor server, so that its next startup rebuilds them with the imported rows
+    block_seconds = 3600 * resolution
+    base_name = database_name.rstrip("/")
+    if os.path.exists(base_name + ".blocks"):
+        block_summaries = BlockSummaries(base_name + ".blocks", block_seconds=block_seconds, resolution=resolution)
+        block_summaries.invalidate(start_time)
+        block_summaries.close()
+    if os.path.exists(base_name + ".sketches"):
+        sketches = HourlySketches(base_name + ".sketches", value_columns, block_seconds=block_seconds)
+        sketches.invalidate(start_time)
+        sketches.close()
+
+
+def import_history(engine, database_name, path, fmt=None, conflict="ignore", batch_rows=100000):
+    """Insert the rows of a file into a history storage, created if it does not exist, and get the number of rows read
+    and inserted
+
+    Channels of the file the storage does not have yet are added to it, and times are converted into the resolution of
+    the storage. Rows are inserted with one statement per chunk and committed every batch_rows rows. Rows whose time
+    is already in the storage are skipped with conflict 'ignore', overwrite the stored ones with 'replace', or stop the
+    import with 'abort'. An import that stops rolls back the rows of the batch being inserted; the batches committed
+    before stay, and so do the rows of the segment engine that were sealed into a segment during the batch.
+
+    The storage is opened for writing, so the import raises StorageLockedError while the sensor server, or any other
+    writer, has the history open: stop it first. The saved block summaries and quantile sketches from the first
+    imported row on are dropped, and rebuilt with the imported rows when the sensor server starts again.
+    """
+    if conflict not in CONFLICT_POLICIES:
+        raise ValueError("Unknown conflict policy {}".format(conflict))
+    fmt = get_format(path, fmt)
+    if fmt == "csv":
+        value_columns, resolution, chunks = read_csv(path)
+    elif fmt == "npz":
+        value_columns, resolution, chunks = read_npz(path)
+    else:
+        value_columns, resolution, chunks = read_columnar(path)
+
+    storage = open_storage(engine, database_name, value_columns, writable=True, resolution=resolution)
+    n_read = 0
+    n_inserted = 0
+    pending = 0
+    # Time of the oldest row of the file, from which the saved summaries miss rows
+    first_time = None
+    try:
+        for rows in chunks:
+            if resolution != storage.resolution:
+                rows = [(scale_time(row[0], resolution, storage.resolution),) + tuple(row[1:]) for row in rows]
+            if len(rows) > 0:
+                chunk_first_time = min(row[0] for row in rows)
+                first_time = chunk_first_time if first_time is None else min(first_time, chunk_first_time)
+            n_inserted += storage.insert_many(rows, conflict)
+            n_read += len(rows)
+            pending += len(rows)
+            if pending >= batch_rows:
+                storage.commit()
+                pending = 0
+        storage.commit()
+    except:
+        storage.rollback()
+        raise
+    finally:
+        # Batches committed before an error are in the history as well. The summaries are dropped while the storage is
+        # still locked, so that a sensor server cannot start in between and keep them.
+        try:
+            if first_time is not None:
+                invalidate_summaries(database_name, storage.value_columns, storage.resolution, first_time)
+        finally:
+            storage.close()
+    return n_read, n_inserted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export history ranges to files, or import files into a history")
+    subparsers = parser.add_subparsers(dest="command")
+
+    export_parser = subparsers.add_parser("export", help="write the history rows of a range to a file")
+    export_parser.add_argument("database_name", help="specify database file, or directory of a segment storage")
+    export_parser.add_argument("path", help="specify file to write: .csv, .csv.gz, .npz or .col")
+    export_parser.add_argument("--start", dest="start_time", type=int, default=0,
+                               help="specify start time of the range, in the resolution of the history")
+    export_parser.add_argument("--end", dest="end_time", type=int, default=2 ** 62,
+                               help="specify end time of the range, in the resolution of the history")
+    export_parser.add_argument("--compress", dest="compress", action="store_true",
+                               help="compress the arrays of an .npz file")
+
+    import_parser = subparsers.add_parser("import", help="insert the rows of a file into a history")
+    import_parser.add_argument("database_name", help="specify database file, or directory of a segment storage")
+    import_parser.add_argument("path", help="specify file to read: .csv, .csv.gz, .npz or .col")
+    import_parser.add_argument("--on-conflict", dest="conflict", default="ignore",
+                               help="set what to do with rows whose time is already in the history: ignore them, "
+                                    "replace the stored ones, or abort")
+    import_parser.add_argument("--batch-rows", dest="batch_rows", type=int, default=100000,
+                               help="specify number of rows inserted per transaction")
+
+    for subparser in (export_parser, import_parser):
+        subparser.add_argument("--storage", dest="storage_engine", default="sqlite",
+                               help="set history storage engine: sqlite, segment")
+        subparser.add_argument("--format", dest="format", default=None,
+                               help="set file format instead of guessing it from the extension: csv, npz, col")
+
+    args = parser.parse_args()
+
+    if args.command == "export" and not os.path.exists(args.database_name):
+        parser.error("database {} does not exist".format(args.database_name))
+
+    start = time()
+    try:
+        if args.command == "export":
+            n = export_history(args.storage_engine, args.database_name, args.path, args.format, args.start_time,
+                               args.end_time, args.compress)
+            elapsed = time() - start
+            print "INFO: Exported {} rows to {} in {:.1f} s ({:.0f} rows/s)"\
+                .format(n, args.path, elapsed, n / max(elapsed, 1e-6))
+        else:
+            n, inserted = import_history(args.storage_engine, args.database_name, args.path, args.format,
+                                         args.conflict, args.batch_rows)
+            elapsed = time() - start
+            print "INFO: Imported {} of {} rows from {} in {:.1f} s ({:.0f} rows/s)"\
+                .format(inserted, n, args.path, elapsed, n / max(elapsed, 1e-6))
+    except (ValueError, IOError, sqlite3.Error) as e:
+        # Conflicts of an aborted import, files or storages that cannot be read, and histories open for writing
+        print "ERROR: {}".format(e)
+        sys.exit(1)
@@ -0,0 +1,77 @@
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryCache(object):
+    """Byte-bounded LRU cache of encoded history responses"""
+
+    def __init__(self, max_bytes=1048576, metrics=None):
+        # Rows older than the newest committed sample never change, so the encoded response of a closed range can be
+        # reused as is. Entries are keyed by (start time, end time, output format) and evicted in least-recently-used
+        # order once the total payload size exceeds max_bytes.
+        self.max_bytes = max_bytes
+        self.metrics = metrics
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.lock = Lock()
+
+    def get(self, start_time, end_time, output_format):
+        # Return the cached payload of the range, or None if it is not cached
+        key = (start_time, end_time, output_format)
+        with self.lock:
+            payload = self.entries.pop(key, None)
+            if payload is None:
+                self.misses += 1
+            else:
+                # Re-insert the entry to mark it as the most recently used one
+                self.entries[key] = payload
+                self.hits += 1
+                self.bytes_saved += len(payload)
+            self.update_metrics()
+        return payload
+
+    def put(self, start_time, end_time, output_format, payload):
+        # Cache the payload of the range. A payload that is larger than the whole cache is not stored at all.
+        key = (start_time, end_time, output_format)
+        with self.lock:
+            old_payload = self.entries.pop(key, None)
+            if old_payload is not None:
+                self.size -= len(old_payload)
+
+            if len(payload) <= self.max_bytes:
+                self.entries[key] = payload
+                self.size += len(payload)
+
+                # Evict the least recently used entries until the cache fits in its budget again
+                while self.size > self.max_bytes:
+                    _, evicted = self.entries.popitem(last=False)
+                    self.size -= len(evicted)
+            self.update_metrics()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.update_metrics()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups > 0 else 0.0
+
+    def update_metrics(self):
+        # Publish the cache statistics; the caller must hold the lock
+        if self.metrics is None:
+            return
+
+        self.metrics.set_gauge('history_cache_hits', self.hits)
+        self.metrics.set_gauge('history_cache_misses', self.misses)
+        self.metrics.set_gauge('history_cache_hit_rate', self.hit_rate())
+        self.metrics.set_gauge('history_cache_bytes_saved', self.bytes_saved)
+        self.metrics.set_gauge('history_cache_bytes', self.size)
+        self.metrics.set_gauge('history_cache_entries', len(self.entries))
@@ -0,0 +1,178 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class LTTBDownsampler(object):
+    """Single-pass Largest-Triangle-Three-Buckets downsampler for history rows
+
+    The range [start_time, end_time] is split into max_points - 2 buckets of equal duration, so rows can be assigned to
+    their bucket as they stream in without knowing how many there are. For each channel, a bucket only keeps the
+    minimum and the maximum of each of its 'ratio' sub-buckets as candidates (MinMaxLTTB preselection), plus the sums
+    needed for its average. The candidate with the largest triangle against the point selected in the previous bucket
+    and the average of the next bucket is sent, so spikes survive while memory stays bounded whatever the range.
+
+    Each output row holds the value selected for every channel, and the mean time of the selected points. The first
+    and the last rows of the range are sent as is.
+    """
+
+    def __init__(self, start_time, end_time, max_points, ratio=4):
+        self.start_time = start_time
+        self.max_points = max_points
+        self.n_buckets = max(max_points - 2, 1)
+        self.bucket_width = float(end_time - start_time + 1) / self.n_buckets
+        self.ratio = ratio
+
+        self.first = None
+        self.last = None
+        # Point selected in the previous bucket, for each channel: [time, value]
+        self.selected = None
+        # Complete buckets that have not been moved to pending yet, the bucket waiting for the average of the next one,
+        # and the bucket being filled
+        self.ready = []
+        self.pending = None
+        self.current = None
+        self.n_sent = 0
+
+    def new_bucket(self, index, n_channels):
+        # A bucket is [index, candidates, sums] where candidates[channel][sub-bucket] is [min time, min value, max time,
+        # max value] and sums[channel] is [sum of times, sum of values, count].
+        return [index,
+                [[None] * self.ratio for i in xrange(0, n_channels)],
+                [[0.0, 0.0, 0] for i in xrange(0, n_channels)]]
+
+    def add(self, row):
+        # Feed a row in time order. Returns the list of rows that are ready to be sent.
+        output = []
+        if self.first is None:
+            self.first = row
+            self.selected = [[row[0], v] for v in row[1:]]
+            output.append(row)
+            self.n_sent += 1
+            return output
+
+        if self.last is not None:
+            self.add_to_bucket(self.last)
+        self.last = row
+        return self.drain()
+
+    def add_to_bucket(self, row):
+        position = (row[0] - self.start_time) / self.bucket_width
+        index = min(int(position), self.n_buckets - 1)
+        sub_index = min(int((position - index) * self.ratio), self.ratio - 1)
+
+        if self.current is None or self.current[0] != index:
+            if self.current is not None:
+                self.ready.append(self.current)
+            self.current = self.new_bucket(index, len(row) - 1)
+
+        candidates = self.current[1]
+        sums = self.current[2]
+        t = row[0]
+        for i in xrange(0, len(row) - 1):
+            v = row[i + 1]
+            if v is None or v != v:
+                # Skip missing values
+                continue
+            sums[i][0] += t
+            sums[i][1] += v
+            sums[i][2] += 1
+            candidate = candidates[i][sub_index]
+            if candidate is None:
+                candidates[i][sub_index] = [t, v, t, v]
+            elif v < candidate[1]:
+                candidate[0] = t
+                candidate[1] = v
+            elif v > candidate[3]:
+                candidate[2] = t
+                candidate[3] = v
+
+    def drain(self):
+        output = []
+        for bucket in self.ready:
+            if self.pending is not None:
+                output.append(self.select(self.pending, self.get_average(bucket)))
+            self.pending = bucket
+        del self.ready[:]
+        return output
+
+    def get_average(self, bucket):
+        return [[s[0] / s[2], s[1] / s[2]] if s[2] > 0 else None for s in bucket[2]]
+
+    def select(self, bucket, next_points):
+        # Select, for each channel, the candidate with the largest triangle between the point selected in the previous
+        # bucket and the next point (the average of the next bucket, or the last row)
+        times = []
+        values = []
+        for i in xrange(0, len(bucket[1])):
+            a = self.selected[i]
+            c = next_points[i]
+            best = None
+            best_area = -1.0
+            for candidate in bucket[1][i]:
+                if candidate is None:
+                    continue
+                for p in ((candidate[0], candidate[1]), (candidate[2], candidate[3])):
+                    if a[1] is None or c is None:
+                        # Without a neighbour on both sides, fall back to the largest excursion
+                        area = abs(p[1])
+                    else:
+                        area = abs((a[0] - c[0]) * (p[1] - a[1]) - (a[0] - p[0]) * (c[1] - a[1]))
+                    if area > best_area:
+                        best_area = area
+                        best = p
+            if best is None:
+                values.append(None)
+            else:
+                times.append(best[0])
+                values.append(best[1])
+                self.selected[i] = [best[0], best[1]]
+
+        self.n_sent += 1
+        if len(times) == 0:
+            t = int(self.start_time + (bucket[0] + 0.5) * self.bucket_width)
+        else:
+            t = int(round(float(sum(times)) / len(times)))
+        return tuple([t] + values)
+
+    def flush(self):
+        # Call at the end of the range. Returns the remaining rows to be sent.
+        output = []
+        if self.last is None:
+            return output
+
+        if self.current is not None:
+            self.ready.append(self.current)
+            self.current = None
+        output += self.drain()
+        if self.pending is not None:
+            output.append(self.select(self.pending, [[self.last[0], v] for v in self.last[1:]]))
+            self.pending = None
+        output.append(self.last)
+        self.n_sent += 1
+        self.last = None
+        return output
+
+
+def downsample(rows, start_time, end_time, max_points):
+    """Stream rows through a LTTBDownsampler, yielding at most max_points rows"""
+    if max_points < 3:
+        # Only room for the first and the last rows
+        first = None
+        last = None
+        for row in rows:
+            if first is None:
+                first = row
+            else:
+                last = row
+        for row in (first, last)[:max(max_points, 0)]:
+            if row is not None:
+                yield row
+        return
+
+    downsampler = LTTBDownsampler(start_time, end_time, max_points)
+    for row in rows:
+        for output in downsampler.add(row):
+            yield output
+    for output in downsampler.flush():
+        yield output
@@ -0,0 +1,110 @@
+import argparse
+import logging
+import os
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+
+def get_columns(db_cur, table="history"):
+    # Get [(name, declared type, primary key flag), ...] of a table
+    db_cur.execute("PRAGMA table_info({})".format(table))
+    return [(row[1], row[2], row[5]) for row in db_cur.fetchall()]
+
+
+def needs_migration(db_cur, table="history"):
+    # A table created as 'time int PRIMARY KEY' does not alias the time key to the rowid, because SQLite only does so
+    # when the declared type is exactly 'INTEGER'. Instead it keeps a separate autoindex on the key.
+    for name, declared_type, pk in get_columns(db_cur, table):
+        if pk:
+            return declared_type.upper() != "INTEGER"
+    return False
+
+
+def vacuum_database(db_cur):
+    # Give the free space back to the file system, and switch the database to incremental vacuum so that the archiver
+    # can reclaim the space of archived rows without rebuilding the whole file again.
+    db_cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    db_cur.execute("VACUUM")
+
+
+def migrate(database_name, chunk_size=10000, vacuum=False):
+    """Convert the history table to an 'INTEGER PRIMARY KEY' layout while the sensor server keeps writing to it"""
+    # Use autocommit mode and issue transactions ourselves, because the sqlite3 module commits implicitly before DDL
+    # statements and we need DROP and RENAME to happen in the same transaction as the last chunk.
+    db_conn = sqlite3.connect(database_name, isolation_level=None, timeout=30.0)
+    db_cur = db_conn.cursor()
+
+    try:
+        if not needs_migration(db_cur):
+            logger.info("Database {} does not need a migration".format(database_name))
+            print "INFO: Database {} does not need a migration".format(database_name)
+            if vacuum:
+                vacuum_database(db_cur)
+            return 0
+
+        columns = get_columns(db_cur)
+        key = [name for name, declared_type, pk in columns if pk][0]
+        values = [name for name, declared_type, pk in columns if not pk]
+
+        db_cur.execute("DROP TABLE IF EXISTS history_migrated")
+        db_cur.execute("CREATE TABLE history_migrated ({} INTEGER PRIMARY KEY NOT NULL, {})"
+                       .format(key, ", ".join("{} {}".format(name, declared_type)
+                                              for name, declared_type, pk in columns if not pk)))
+
+        copy_sql = ("INSERT INTO history_migrated SELECT CAST({0} AS INTEGER), {1} FROM history WHERE {0} > ? "
+                    "ORDER BY {0} LIMIT ?").format(key, ", ".join(values))
+
+        # Copy the rows in chunks, each in its own short transaction, so that the sensor server is only blocked for
+        # the duration of one chunk at a time.
+        last_time = -1
+        n = 0
+        while True:
+            db_cur.execute("BEGIN IMMEDIATE")
+            db_cur.execute(copy_sql, (last_time, chunk_size))
+            copied = db_cur.rowcount
+            db_cur.execute("SELECT MAX({}) FROM history_migrated".format(key))
+            last_time = db_cur.fetchone()[0]
+            if copied < chunk_size:
+                # Last chunk: swap the tables in the same transaction, so no row inserted in between gets lost.
+                db_cur.execute("DROP TABLE history")
+                db_cur.execute("ALTER TABLE history_migrated RENAME TO history")
+                db_cur.execute("COMMIT")
+                n += copied
+                break
+            db_cur.execute("COMMIT")
+            n += copied
+            print "INFO: Migrated {} rows...\r".format(n),
+
+        logger.info("Migrated {} rows of database {}".format(n, database_name))
+        print "\nINFO: Migrated {} rows of database {}".format(n, database_name)
+
+        if vacuum:
+            vacuum_database(db_cur)
+
+        return n
+    except Exception:
+        try:
+            db_cur.execute("ROLLBACK")
+        except sqlite3.Error:
+            # No transaction is active
+            pass
+        raise
+    finally:
+        db_conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Migrate a history database to the rowid-aliased time key layout")
+    parser.add_argument("database_name", help="specify database file")
+    parser.add_argument("--chunk-size", dest="chunk_size", type=int, default=10000,
+                        help="specify number of rows copied per transaction")
+    parser.add_argument("--vacuum", dest="vacuum", action="store_true",
+                        help="reclaim the free space and enable incremental vacuum once the migration is done")
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.database_name):
+        parser.error("database {} does not exist".format(args.database_name))
+
+    migrate(args.database_name, chunk_size=args.chunk_size, vacuum=args.vacuum)
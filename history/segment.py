@@ -0,0 +1,480 @@
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from storage import HistoryStorage, lock_writer
+
+logger = logging.getLogger(__name__)
+
+# Header of a sealed segment: magic, number of rows, number of value columns, first time, last time
+SEGMENT_HEADER = struct.Struct("<4sIIqq4x")
+SEGMENT_MAGIC = "APSS"
+# Entry of the time index: first time, last time, number of rows of a sealed segment
+INDEX_ENTRY = struct.Struct("<qqI")
+
+
+class SegmentStorage(HistoryStorage):
+    """Append-only columnar history storage engine
+
+    The directory holds
+      * 'active.log', an append-only journal of fixed-width rows (int64 time followed by float64 values) that receives
+        the newest samples;
+      * sealed segments 'seg-<first time>.col', each holding a header, the time column and then every value column as
+        contiguous little-endian arrays. They are never modified once written, so readers map them with mmap;
+      * 'index', a small append-only time index with one fixed-width entry per sealed segment, so that readers only
+        read the entries appended since their last query;
+      * 'resolution', the number of time units per second, absent from storages created in whole seconds;
+      * 'columns', the names of all the value columns the storage has had, and the number of value columns of the
+        journal rows. Channels can be appended to the channels of an existing storage, or the last ones dropped: the
+        journal is then sealed with its old columns, and segments without a column read it as missing.
+
+    The journal is sealed into a segment whenever a new row falls into a different seal_interval window than the first
+    row of the journal. Missing values are stored as NaN.
+    """
+
+    def __init__(self, path, value_columns, writable=False, seal_interval=3600, resolution=1):
+        self.path = path
+        self.value_columns = value_columns
+        self.writable = writable
+
+        self.row_struct = struct.Struct("<q" + "d" * len(self.value_columns))
+        self.journal_path = os.path.join(self.path, "active.log")
+        self.columns_path = os.path.join(self.path, "columns")
+        self.index_path = os.path.join(self.path, "index")
+
+        # Sealed segments as (first time, last time, number of rows, file name), in time order
+        self.segments = []
+        # (inode, size) of the index file when it was last loaded
+        self.index_stat = None
+        # Memory maps of the sealed segments that have been read, by file name
+        self.maps = {}
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        # The resolution is kept in a file of its own, which storages in whole seconds may not have
+        resolution_path = os.path.join(self.path, "resolution")
+        if self.writable and not os.path.exists(resolution_path) and not os.path.exists(self.journal_path) and \
+                not os.path.exists(self.index_path):
+            with open(resolution_path, "w") as f:
+                f.write("{}\n".format(resolution))
+        self.resolution = 1
+        if os.path.exists(resolution_path):
+            with open(resolution_path) as f:
+                self.resolution = int(f.read())
+        # Length of the seal windows in time units
+        self.seal_interval = seal_interval * self.resolution
+
+        # The lock file serializes index updates between the writer and the archiver
+        self.lock_file = open(os.path.join(self.path, "index.lock"), "a")
+
+        # Names of all the value columns of the storage, or None if the storage does not record them, and number of
+        # value columns of the journal rows, which differs from the number of value columns of this storage object
+        # until the writer opens the storage with the new channels
+        self.column_names = None
+        self.journal_columns = self.read_journal_columns()
+
+        self.journal = None
+        self.journal_first_time = None
+        self.last_time = None
+        # Size of the journal at the last commit, which a rollback truncates it back to
+        self.committed_size = 0
+        # A second writer would append to the same journal and seal it on its own, so only one may have it open
+        self.writer_lock_file = None
+        if self.writable:
+            self.writer_lock_file = lock_writer(os.path.join(self.path, "writer.lock"), self.path)
+            try:
+                self.recover()
+            except Exception:
+                self.close()
+                raise
+
+    def lock(self):
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+
+    def unlock(self):
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def load_index(self):
+        # Load the index entries appended since the last call. The index is only rewritten, and renamed over the old
+        # one, when segments are deleted, in which case it is read again from the start.
+        if not os.path.exists(self.index_path):
+            self.segments = []
+            self.index_stat = None
+        else:
+            stat = os.stat(self.index_path)
+            if self.index_stat is None or self.index_stat[0] != stat.st_ino or self.index_stat[1] > stat.st_size:
+                self.segments = []
+                offset = 0
+            else:
+                offset = self.index_stat[1]
+
+            if offset != stat.st_size:
+                with open(self.index_path, "rb") as reader:
+                    reader.seek(offset)
+                    data = reader.read()
+                size = INDEX_ENTRY.size
+                for entry_offset in xrange(0, len(data) - size + 1, size):
+                    first_time, last_time, n = INDEX_ENTRY.unpack_from(data, entry_offset)
+                    self.segments.append((first_time, last_time, n, "seg-{}.col".format(first_time)))
+                offset += len(data) - len(data) % size
+            self.index_stat = (stat.st_ino, offset)
+
+        # Unmap the segments deleted by the archiver in the meantime
+        if len(self.maps) > 0:
+            names = set(segment[3] for segment in self.segments)
+            for name in self.maps.keys():
+                if name not in names:
+                    self.maps.pop(name).close()
+
+    def append_index(self, segment):
+        with open(self.index_path, "ab") as writer:
+            writer.write(INDEX_ENTRY.pack(*segment[:3]))
+            writer.flush()
+            os.fsync(writer.fileno())
+
+    def save_index(self):
+        # Write the index aside and rename it over the old one, so readers always see a complete index
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "wb") as writer:
+            for segment in self.segments:
+                writer.write(INDEX_ENTRY.pack(*segment[:3]))
+            writer.flush()
+            os.fsync(writer.fileno())
+        os.rename(tmp_path, self.index_path)
+
+    def read_journal_columns(self):
+        # Storages created before channels could be added have no 'columns' file, and their journal has the columns of
+        # the segments
+        if os.path.exists(self.columns_path):
+            with open(self.columns_path) as f:
+                self.column_names = f.readline().strip().split(",")
+                return int(f.readline())
+
+        self.lock()
+        try:
+            self.load_index()
+        finally:
+            self.unlock()
+        if len(self.segments) > 0:
+            return SEGMENT_HEADER.unpack_from(self.get_map(self.segments[-1][3]), 0)[2]
+        return len(self.value_columns)
+
+    def read_journal(self, adapt=True):
+        # Get the complete rows of the journal, with the value columns of this storage object unless adapt is False. A
+        # partial row at the end, left by a crash, is ignored.
+        if not os.path.exists(self.journal_path):
+            return []
+
+        with open(self.journal_path, "rb") as reader:
+            data = reader.read()
+
+        row_struct = struct.Struct("<q" + "d" * self.journal_columns)
+        rows = [row_struct.unpack_from(data, offset) for offset in xrange(0, len(data) - row_struct.size + 1,
+                                                                          row_struct.size)]
+        if self.journal_columns == len(self.value_columns) or not adapt:
+            return rows
+
+        # Rows with other columns are cut, or padded with missing values
+        padding = (float("nan"),) * max(0, len(self.value_columns) - self.journal_columns)
+        return [row[:len(self.value_columns) + 1] + padding for row in rows]
+
+    def recover(self):
+        # Rebuild the journal of the writer. Rows that were already sealed before a crash are dropped, and so is a
+        # partial row at the end.
+        self.lock()
+        try:
+            self.load_index()
+        finally:
+            self.unlock()
+        sealed_time = self.segments[-1][1] if len(self.segments) > 0 else None
+
+        # Columns are matched by position in segments, so channels can only be appended or dropped from the end
+        value_columns = list(self.value_columns)
+        column_names = self.column_names if self.column_names is not None else value_columns
+        n = min(len(column_names), len(value_columns))
+        if column_names[:n] != value_columns[:n]:
+            raise ValueError("Channels of {} are {}, new channels can only be appended to them"
+                             .format(self.path, ", ".join(column_names)))
+        if len(value_columns) > len(column_names):
+            column_names = value_columns
+
+        rows = [row for row in self.read_journal(adapt=False) if sealed_time is None or row[0] > sealed_time]
+        if self.journal_columns != len(self.value_columns):
+            # The channels changed: seal the rows of the journal with their own columns, before the journal rows change
+            # width. If we crash before the journal is emptied, its rows are dropped as already sealed.
+            if len(rows) > 0:
+                self.write_segment(rows)
+                sealed_time = rows[-1][0]
+            rows = []
+
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "wb") as writer:
+            for row in rows:
+                writer.write(self.row_struct.pack(*row))
+            writer.flush()
+            os.fsync(writer.fileno())
+        os.rename(tmp_path, self.journal_path)
+        self.journal = open(self.journal_path, "ab")
+        self.committed_size = len(rows) * self.row_struct.size
+
+        if self.column_names != column_names or self.journal_columns != len(value_columns):
+            with open(self.columns_path + ".tmp", "w") as f:
+                f.write("{}\n{}\n".format(",".join(column_names), len(value_columns)))
+            os.rename(self.columns_path + ".tmp", self.columns_path)
+            self.column_names = column_names
+            self.journal_columns = len(value_columns)
+
+        self.journal_first_time = rows[0][0] if len(rows) > 0 else None
+        self.last_time = rows[-1][0] if len(rows) > 0 else sealed_time
+
+    def insert(self, row):
+        if self.last_time is not None and row[0] <= self.last_time:
+            raise ValueError("Time {} is not greater than the last time {}".format(row[0], self.last_time))
+
+        if self.journal_first_time is not None and \
+                row[0] // self.seal_interval != self.journal_first_time // self.seal_interval:
+            self.seal()
+
+        self.journal.write(self.row_struct.pack(row[0], *[float("nan") if v is None else v for v in row[1:]]))
+        if self.journal_first_time is None:
+            self.journal_first_time = row[0]
+        self.last_time = row[0]
+
+    def insert_many(self, rows, conflict="abort"):
+        # Segments are append-only, so 'ignore' skips the rows that are not newer than the newest row, and rows cannot
+        # be replaced
+        if conflict not in ("abort", "ignore"):
+            raise ValueError("The segment storage engine cannot replace rows")
+        n = 0
+        for row in rows:
+            if conflict == "ignore" and self.last_time is not None and row[0] <= self.last_time:
+                continue
+            self.insert(row)
+            n += 1
+        return n
+
+    def commit(self):
+        if self.journal is None:
+            # Only the writer has rows to commit
+            return
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.committed_size = os.fstat(self.journal.fileno()).st_size
+
+    def rollback(self):
+        # Truncate the journal back to its last commit. Rows sealed into a segment in the meantime were committed by
+        # the seal, so they stay.
+        if self.journal is None:
+            return
+        self.journal.close()
+        with open(self.journal_path, "r+b") as f:
+            f.truncate(self.committed_size)
+            f.flush()
+            os.fsync(f.fileno())
+        self.recover()
+
+    def seal(self):
+        # Turn the journal into a columnar segment
+        self.commit()
+        rows = self.read_journal()
+        if len(rows) == 0:
+            return
+
+        self.write_segment(rows)
+
+        # Readers skip journal rows that are already in a segment, so the journal can be truncated after the index
+        # has been updated.
+        self.journal.seek(0)
+        self.journal.truncate()
+        self.commit()
+        self.journal_first_time = None
+
+    def write_segment(self, rows):
+        # Write rows into a new segment and add it to the index
+        n = len(rows)
+        name = "seg-{}.col".format(rows[0][0])
+        segment_path = os.path.join(self.path, name)
+        tmp_path = segment_path + ".tmp"
+        with open(tmp_path, "wb") as writer:
+            writer.write(encode_segment(rows))
+            writer.flush()
+            os.fsync(writer.fileno())
+        os.rename(tmp_path, segment_path)
+
+        self.lock()
+        try:
+            self.append_index((rows[0][0], rows[-1][0], n))
+        finally:
+            self.unlock()
+
+    def get_map(self, name):
+        segment_map = self.maps.get(name)
+        if segment_map is None:
+            with open(os.path.join(self.path, name), "rb") as reader:
+                segment_map = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[name] = segment_map
+        return segment_map
+
+    def read_segment(self, segment, start_time, end_time):
+        # Binary search the time column of a sealed segment, then read every column of the matching rows through a
+        # buffer over the mapped pages, so the values are copied once, into their array, instead of being sliced out
+        # of the map first. The buffers do not outlive the call, since the map is closed once the archiver deletes
+        # the segment.
+        name = segment[3]
+        n = segment[2]
+        segment_map = self.get_map(name)
+        base = SEGMENT_HEADER.size
+
+        lo = search_times(segment_map, base, n, start_time)
+        hi = search_times(segment_map, base, n, end_time + 1)
+        if lo >= hi:
+            return []
+
+        # Segments written before channels were added have fewer columns, the new ones are missing there, and the
+        # columns of channels that were dropped since are skipped
+        n_columns = SEGMENT_HEADER.unpack_from(segment_map, 0)[2]
+        columns = [struct.unpack_from("<{}q".format(hi - lo), segment_map, base + lo * 8)]
+        for i in xrange(0, len(self.value_columns)):
+            if i < n_columns:
+                columns.append(from_bytes("d", buffer(segment_map, base + ((i + 1) * n + lo) * 8, (hi - lo) * 8)))
+            else:
+                columns.append([float("nan")] * (hi - lo))
+        return zip(*columns)
+
+    def query(self, start_time, end_time):
+        # Read the journal before the index: if the writer seals in between, the rows show up in the new segment and
+        # are skipped in the journal, instead of being missed by both.
+        if self.writable:
+            self.commit()
+        journal_rows = self.read_journal()
+
+        self.lock()
+        try:
+            self.load_index()
+        finally:
+            self.unlock()
+        sealed_time = self.segments[-1][1] if len(self.segments) > 0 else None
+
+        # Find the first segment that may hold start_time with a binary search over the index
+        lo, hi = 0, len(self.segments)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.segments[mid][1] < start_time:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        for segment in self.segments[lo:]:
+            if segment[0] > end_time:
+                break
+            for row in self.read_segment(segment, start_time, end_time):
+                yield row
+
+        for row in journal_rows:
+            if start_time <= row[0] <= end_time and (sealed_time is None or row[0] > sealed_time):
+                yield row
+
+    def get_first_time(self):
+        self.lock()
+        try:
+            self.load_index()
+        finally:
+            self.unlock()
+        if len(self.segments) > 0:
+            return self.segments[0][0]
+
+        rows = self.read_journal()
+        return rows[0][0] if len(rows) > 0 else None
+
+    def get_last_time(self):
+        if self.writable:
+            return self.last_time
+
+        rows = self.read_journal()
+        if len(rows) > 0:
+            return rows[-1][0]
+        self.lock()
+        try:
+            self.load_index()
+        finally:
+            self.unlock()
+        return self.segments[-1][1] if len(self.segments) > 0 else None
+
+    def delete_before(self, end_time):
+        # Only whole sealed segments are deleted. Segments do not span seal_interval windows, so deleting before a
+        # multiple of seal_interval is exact.
+        self.lock()
+        try:
+            self.load_index()
+            deleted = [segment for segment in self.segments if segment[1] < end_time]
+            self.segments = [segment for segment in self.segments if segment[1] >= end_time]
+            self.save_index()
+        finally:
+            self.unlock()
+
+        for segment in deleted:
+            segment_map = self.maps.pop(segment[3], None)
+            if segment_map is not None:
+                segment_map.close()
+            os.remove(os.path.join(self.path, segment[3]))
+
+    def close(self):
+        # The journal is only committed: it is sealed by a writer once its seal_interval window is over, so that every
+        # short-lived writer, such as a startup check or a tool, does not leave a small segment behind
+        if self.journal is not None:
+            self.commit()
+            self.journal.close()
+            self.journal = None
+        for segment_map in self.maps.values():
+            segment_map.close()
+        self.maps.clear()
+        self.lock_file.close()
+        if self.writer_lock_file is not None:
+            self.writer_lock_file.close()
+            self.writer_lock_file = None
+
+
+def encode_segment(rows):
+    """Encode rows as a segment: the header, the time column, then every value column, with NaN for missing values"""
+    n = len(rows)
+    columns = zip(*rows)
+    data = [SEGMENT_HEADER.pack(SEGMENT_MAGIC, n, len(columns) - 1, rows[0][0], rows[-1][0]),
+            struct.pack("<{}q".format(n), *columns[0])]
+    for column in columns[1:]:
+        if None in column:
+            column = [float("nan") if value is None else value for value in column]
+        data.append(to_bytes(array("d", column)))
+    return "".join(data)
+
+
+def to_bytes(values):
+    # Value columns are stored little-endian whatever the byte order of the board. The time column is packed with
+    # struct instead, since array has no 64-bit integer type in Python 2.
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values.tostring()
+
+
+def from_bytes(typecode, data):
+    values = array(typecode)
+    values.fromstring(data)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+def search_times(segment_map, base, n, t):
+    # Get the index of the first time in the mapped time column that is not smaller than t
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if struct.unpack_from("<q", segment_map, base + mid * 8)[0] < t:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
@@ -0,0 +1,210 @@
+import logging
+import math
+import sqlite3
+import struct
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# Centroid of a serialized sketch: mean, weight
+CENTROID = struct.Struct("<dI")
+
+
+class TDigest(object):
+    """Mergeable quantile sketch (merging t-digest)
+
+    Values are buffered and then merged into sorted centroids whose weights are bounded by the k1 scale function, so
+    the sketch keeps at most about compression centroids whatever the number of values, with small centroids, and
+    therefore accurate quantiles, near the tails. Digests merge by merging their centroids, so the digest of a range is
+    the merge of the digests of its blocks.
+    """
+
+    def __init__(self, compression=100, centroids=None):
+        self.compression = compression
+        # Sorted [mean, weight] centroids, and (value, weight) pairs not merged yet
+        self.centroids = [] if centroids is None else centroids
+        self.buffer = []
+        self.count = sum(weight for _, weight in self.centroids)
+
+    def add(self, value, weight=1):
+        self.buffer.append((value, weight))
+        self.count += weight
+        if len(self.buffer) >= 5 * self.compression:
+            self.compress()
+
+    def merge(self, other):
+        # Add the centroids of another digest
+        other.compress()
+        self.buffer.extend((mean, weight) for mean, weight in other.centroids)
+        self.count += other.count
+        if len(self.buffer) >= 5 * self.compression:
+            self.compress()
+
+    def compress(self):
+        if len(self.buffer) == 0:
+            return
+        items = sorted(self.centroids + [[value, weight] for value, weight in self.buffer])
+        self.buffer = []
+
+        total = float(self.count)
+        centroids = [list(items[0])]
+        cumulative = 0
+        limit = total * self.get_q_limit(0.0)
+        for mean, weight in items[1:]:
+            current = centroids[-1]
+            if cumulative + current[1] + weight <= limit:
+                # Weighted mean of the centroid and the item
+                current[1] += weight
+                current[0] += (mean - current[0]) * weight / current[1]
+            else:
+                cumulative += current[1]
+                limit = total * self.get_q_limit(cumulative / total)
+                centroids.append([mean, weight])
+        self.centroids = centroids
+
+    def get_q_limit(self, q):
+        # Get the quantile up to which a centroid starting at quantile q may extend, one step of the k1 scale function
+        k = self.compression / (2 * math.pi) * math.asin(2 * q - 1) + 1
+        if k >= self.compression / 4.0:
+            return 1.0
+        return (math.sin(min(k * 2 * math.pi / self.compression, math.pi / 2)) + 1) / 2
+
+    def quantile(self, q):
+        """Get the value at quantile q between 0 and 1, or None if the digest is empty"""
+        self.compress()
+        if self.count == 0:
+            return None
+        if len(self.centroids) == 1:
+            return self.centroids[0][0]
+
+        # Every centroid stands for its weight centered on its mean; interpolate between the centers
+        target = q * self.count
+        cumulative = 0.0
+        previous_center = None
+        previous_mean = None
+        for mean, weight in self.centroids:
+            center = cumulative + weight / 2.0
+            if target < center:
+                if previous_center is None:
+                    return mean
+                return previous_mean + (mean - previous_mean) * (target - previous_center) / (center - previous_center)
+            previous_center = center
+            previous_mean = mean
+            cumulative += weight
+        return self.centroids[-1][0]
+
+    def to_bytes(self):
+        self.compress()
+        return "".join(CENTROID.pack(mean, weight) for mean, weight in self.centroids)
+
+    @staticmethod
+    def from_bytes(data, compression=100):
+        return TDigest(compression, [list(CENTROID.unpack_from(data, offset))
+                                     for offset in xrange(0, len(data), CENTROID.size)])
+
+
+class HourlySketches(object):
+    """Per-block quantile sketches of every channel of the history, for percentile queries
+
+    Like the block summaries, sketches are updated as the sensor server inserts rows: the sketches of closed blocks are
+    saved in a small SQLite database next to the history, and those of the block being filled are kept in memory. A
+    percentile over a range merges the sketches of its blocks, so its cost depends on the number of blocks, not of rows.
+    Ranges are widened to whole blocks.
+    """
+
+    def __init__(self, database_name, value_columns, block_seconds=3600, compression=100, metrics=None):
+        self.database_name = database_name
+        self.value_columns = list(value_columns)
+        self.block_seconds = block_seconds
+        self.compression = compression
+        self.metrics = metrics
+
+        # The sensor server thread adds rows and the main thread queries, so share the connection under a lock
+        self.lock = Lock()
+        self.db_conn = sqlite3.connect(self.database_name, check_same_thread=False)
+        self.db_conn.execute("CREATE TABLE IF NOT EXISTS sketches (block INTEGER NOT NULL, channel TEXT NOT NULL, "
+                             "sketch BLOB NOT NULL, PRIMARY KEY (block, channel))")
+        self.db_conn.commit()
+
+        # Block being filled and its sketch per channel
+        self.current = None
+        self.current_sketches = None
+        # Time of the newest row included in the sketches
+        self.last_time = None
+
+    def get_channel(self, name):
+        # Get the history channel of a case-insensitive name, or None
+        for channel in self.value_columns:
+            if channel.lower() == name.lower():
+                return channel
+        return None
+
+    def get_saved_time(self):
+        # Get the end of the last saved block, or None if no block has been saved
+        block = self.db_conn.execute("SELECT MAX(block) FROM sketches").fetchone()[0]
+        return None if block is None else block + self.block_seconds
+
+    def invalidate(self, start_time):
+        # Drop the saved sketches from the block of start_time on, for example after rows were imported into the
+        # history, so that they are rebuilt from the history at the next startup
+        with self.lock:
+            self.db_conn.execute("DELETE FROM sketches WHERE block >= ?",
+                                 (start_time - start_time % self.block_seconds,))
+            self.db_conn.commit()
+
+    def rebuild(self, rows):
+        """Build the sketches of rows newer than the last saved block, in one pass, at startup"""
+        n = 0
+        for row in rows:
+            self.add(row)
+            n += 1
+        logger.info("Rebuilt quantile sketches from {} rows".format(n))
+
+    def add(self, row):
+        # Add a row, inserted in time order, to the sketches of its block. Missing values are skipped.
+        block = row[0] - row[0] % self.block_seconds
+        with self.lock:
+            if self.current is not None and self.current != block:
+                self.save()
+            if self.current is None:
+                self.current = block
+                self.current_sketches = [TDigest(self.compression) for _ in self.value_columns]
+            for i in xrange(0, len(self.value_columns)):
+                value = row[i + 1]
+                if value is not None and not math.isnan(value):
+                    self.current_sketches[i].add(value)
+            self.last_time = row[0]
+
+    def save(self):
+        # Save the sketches of the closed block; the caller must hold the lock
+        self.db_conn.executemany("INSERT OR REPLACE INTO sketches VALUES (?, ?, ?)",
+                                 [(self.current, self.value_columns[i],
+                                   sqlite3.Binary(self.current_sketches[i].to_bytes()))
+                                  for i in xrange(0, len(self.value_columns)) if self.current_sketches[i].count > 0])
+        self.db_conn.commit()
+        self.current = None
+        self.current_sketches = None
+
+    def get(self, channel, start_time, end_time):
+        """Get the merged sketch of a channel over the blocks that overlap [start_time, end_time]"""
+        first_block = start_time - start_time % self.block_seconds
+        sketch = TDigest(self.compression)
+        with self.lock:
+            n = 0
+            for data, in self.db_conn.execute("SELECT sketch FROM sketches WHERE channel = ? AND block >= ? AND "
+                                              "block <= ?", (channel, first_block, end_time)):
+                sketch.merge(TDigest.from_bytes(str(data), self.compression))
+                n += 1
+            if self.current is not None and first_block <= self.current <= end_time:
+                sketch.merge(self.current_sketches[self.value_columns.index(channel)])
+                n += 1
+
+        if self.metrics is not None:
+            self.metrics.increment('percentile_requests')
+            self.metrics.increment('percentile_blocks', n)
+        return sketch
+
+    def close(self):
+        # The sketches of the block being filled are not saved; they are rebuilt from the history at the next startup
+        with self.lock:
+            self.db_conn.close()
@@ -0,0 +1,209 @@
+import errno
+import fcntl
+import logging
+import sqlite3
+
+from migrate import get_columns, needs_migration
+
+logger = logging.getLogger(__name__)
+
+# What insert_many does with a row whose time is already in the storage: raise an error, skip the row, or overwrite the
+# stored row
+CONFLICT_POLICIES = ('abort', 'ignore', 'replace')
+
+
+class StorageLockedError(IOError):
+    """Raised when a storage is opened for writing while another writer has it open"""
+    pass
+
+
+def lock_writer(path, name):
+    """Take the exclusive lock of the writer of the storage name in the lock file path, held until the returned file is
+    closed"""
+    lock_file = open(path, "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        lock_file.close()
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            raise StorageLockedError("History {} is open for writing elsewhere, stop its writer first".format(name))
+        raise
+    return lock_file
+
+
+class HistoryStorage(object):
+    """Interface of the history storage engines
+
+    Rows are tuples of (epoch time, value 1, ..., value n), inserted in increasing time order. Each thread opens its own
+    storage object; only the one opened with writable=True by the sensor server appends samples. A storage object opened
+    with writable=True holds an exclusive lock until it is closed, and opening a second one raises StorageLockedError.
+
+    Times are integers in units of 1 / resolution seconds. The resolution is chosen when the storage is created and kept
+    with it: 1 for whole seconds, the only one of the storages created before sub-second sampling, or 1000 for
+    milliseconds.
+    """
+
+    resolution = 1
+
+    def insert(self, row):
+        raise NotImplementedError
+
+    def insert_many(self, rows, conflict="abort"):
+        # Insert a batch of rows in time order, and get the number of rows inserted. Engines that can do better than one
+        # insert per row override this, as do those that can skip ('ignore') or overwrite ('replace') the rows whose
+        # time is already in the storage instead of raising an error ('abort').
+        if conflict != "abort":
+            raise ValueError("The storage engine only supports the 'abort' conflict policy")
+        n = 0
+        for row in rows:
+            self.insert(row)
+            n += 1
+        return n
+
+    def commit(self):
+        # Make the inserted rows durable and visible to other storage objects
+        raise NotImplementedError
+
+    def rollback(self):
+        # Discard the rows inserted since the last commit
+        raise NotImplementedError
+
+    def query(self, start_time, end_time):
+        # Get an iterable of the rows between start_time and end_time, both inclusive, in time order
+        raise NotImplementedError
+
+    def get_first_time(self):
+        # Get the time of the oldest row, or None if the storage is empty
+        raise NotImplementedError
+
+    def get_last_time(self):
+        # Get the time of the newest committed row, or None if the storage is empty
+        raise NotImplementedError
+
+    def delete_before(self, end_time):
+        # Delete the rows older than end_time
+        raise NotImplementedError
+
+    def reclaim(self):
+        # Give the space of deleted rows back to the file system
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteStorage(HistoryStorage):
+    """History storage engine backed by the 'history' table of a SQLite database"""
+
+    def __init__(self, database_name, value_columns, writable=False, timeout=5.0, resolution=1):
+        self.database_name = database_name
+        self.value_columns = value_columns
+
+        # When a database is accessed by multiple connections, and one of the processes modifies the database, the
+        # SQLite database is locked until that transaction is committed. The timeout parameter specifies how long the
+        # connection should wait for the lock to go away until raising an exception.
+        self.db_conn = sqlite3.connect(self.database_name, timeout=timeout)
+        self.db_cur = self.db_conn.cursor()
+
+        # SQLite serializes the transactions of concurrent writers, but the summaries kept next to the history are only
+        # up to date with the rows of a single writer
+        self.lock_file = None
+        if writable:
+            try:
+                self.lock_file = lock_writer(self.database_name + ".lock", self.database_name)
+            except IOError:
+                self.db_conn.close()
+                raise
+            self.create_table(resolution)
+
+        # The resolution is kept in the user version of the database, which is 0 for databases in whole seconds
+        self.resolution = self.db_conn.execute("PRAGMA user_version").fetchone()[0] or 1
+
+        # Name the columns, since the table may have more of them than this storage object reads or writes
+        columns = ", ".join(["time"] + list(self.value_columns))
+        placeholders = ", ".join(["?"] * (len(self.value_columns) + 1))
+        self.insert_sql = "INSERT INTO history ({}) VALUES ({})".format(columns, placeholders)
+        self.insert_many_sql = dict((conflict, "INSERT OR {} INTO history ({}) VALUES ({})"
+                                     .format(conflict.upper(), columns, placeholders))
+                                    for conflict in CONFLICT_POLICIES)
+        self.query_sql = "SELECT {} FROM history WHERE time >= ? AND time <= ?".format(columns)
+
+    def create_table(self, resolution=1):
+        # Let the archiver give the pages of archived rows back to the file system. This only takes effect on a new
+        # database; existing ones are converted by 'python -m history.migrate --vacuum'.
+        self.db_cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+        # Create a 'history' table for history data.
+        #  TIME | Temp |  SN1 |  SN2 |  SN3 |  SN4 | PM25
+        # -----------------------------------------------
+        #   int | real | real | real | real | real | real
+        # The key is declared as 'INTEGER' so that SQLite aliases it to the rowid instead of building an autoindex.
+        new = self.db_cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'history'")\
+            .fetchone()[0] == 0
+        self.db_cur.execute("CREATE TABLE IF NOT EXISTS history (time INTEGER PRIMARY KEY NOT NULL, {})"
+                            .format(", ".join("{} real".format(name) for name in self.value_columns)))
+        if new and resolution != 1:
+            self.db_cur.execute("PRAGMA user_version = {:d}".format(resolution))
+        # Add the channels the table does not have yet; the older rows get NULL values for them
+        existing = set(column[0].lower() for column in get_columns(self.db_cur))
+        for name in self.value_columns:
+            if name.lower() not in existing:
+                self.db_cur.execute("ALTER TABLE history ADD COLUMN {} real".format(name))
+                logger.info("Added column {} to database {}".format(name, self.database_name))
+        self.db_conn.commit()
+
+        if needs_migration(self.db_cur):
+            logger.warn("Database {} uses the legacy history layout, run 'python -m history.migrate {}' to convert it"
+                        .format(self.database_name, self.database_name))
+
+    def insert(self, row):
+        self.db_cur.execute(self.insert_sql, row)
+
+    def insert_many(self, rows, conflict="abort"):
+        if conflict not in CONFLICT_POLICIES:
+            raise ValueError("Unknown conflict policy {}".format(conflict))
+        self.db_cur.executemany(self.insert_many_sql[conflict], rows)
+        # Rows skipped by 'OR IGNORE' are not counted
+        return self.db_cur.rowcount
+
+    def commit(self):
+        self.db_conn.commit()
+
+    def rollback(self):
+        self.db_conn.rollback()
+
+    def query(self, start_time, end_time):
+        # Use a cursor of its own, so that the rows can be streamed while the storage is used for something else
+        return self.db_conn.execute(self.query_sql, (start_time, end_time))
+
+    def get_first_time(self):
+        return self.db_conn.execute("SELECT MIN(time) FROM history").fetchone()[0]
+
+    def get_last_time(self):
+        return self.db_conn.execute("SELECT MAX(time) FROM history").fetchone()[0]
+
+    def delete_before(self, end_time):
+        self.db_cur.execute("DELETE FROM history WHERE time < ?", (end_time,))
+
+    def reclaim(self):
+        # This only has an effect if the database was created with 'auto_vacuum = INCREMENTAL'. The pragma frees one
+        # page per step, so fetch all of its rows to run it to completion.
+        self.db_conn.execute("PRAGMA incremental_vacuum").fetchall()
+
+    def close(self):
+        # Gracefully close the database connection, and let another writer open the database.
+        self.db_conn.close()
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+
+def open_storage(engine, database_name, value_columns, writable=False, resolution=1):
+    """Open the history storage engine 'sqlite' or 'segment', created with the given resolution if it does not exist"""
+    if engine == "sqlite":
+        return SQLiteStorage(database_name, value_columns, writable=writable, resolution=resolution)
+    elif engine == "segment":
+        # Imported here because the segment engine module itself imports HistoryStorage from this module
+        from segment import SegmentStorage
+        return SegmentStorage(database_name, value_columns, writable=writable, resolution=resolution)
+    raise ValueError("Unknown storage engine {}".format(engine))
@@ -0,0 +1,116 @@
+import logging
+import sqlite3
+import zlib
+from threading import Lock
+
+from transfer import encode_row, scale_time
+
+logger = logging.getLogger(__name__)
+
+# Resolutions a client can receive its 'h' lines in: whole seconds, or milliseconds after 'timestamps ms'
+CLIENT_RESOLUTIONS = (1, 1000)
+
+
+class BlockSummaries(object):
+    """Per-block row counts and checksums of the history, for clients that keep a cache of their own
+
+    The checksum of a block is the CRC32 of its rows encoded as 'h' lines, in time order, exactly as a history transfer
+    sends them, so a client can compute it over the lines it has cached. The times of the lines are in the resolution of
+    the client, so a block has one checksum per client resolution. Summaries are updated as the sensor server inserts
+    rows: closed blocks are saved in a small SQLite database next to the history, and the block being filled is kept in
+    memory. Answering a summary query never reads raw rows.
+    """
+
+    def __init__(self, database_name, block_seconds=3600, resolution=1, metrics=None):
+        self.database_name = database_name
+        self.block_seconds = block_seconds
+        self.resolution = resolution
+        self.metrics = metrics
+
+        # The sensor server thread adds rows and the main thread queries, so share the connection under a lock
+        self.lock = Lock()
+        self.db_conn = sqlite3.connect(self.database_name, check_same_thread=False)
+        columns = [row[1] for row in self.db_conn.execute("PRAGMA table_info(blocks)")]
+        if len(columns) > 0 and "crc_ms" not in columns:
+            # Summaries saved before they had a checksum per client resolution are dropped, and rebuilt from the
+            # history at startup
+            self.db_conn.execute("DROP TABLE blocks")
+            logger.info("Dropped the block summaries of {}, they will be rebuilt".format(self.database_name))
+        self.db_conn.execute("CREATE TABLE IF NOT EXISTS blocks (block INTEGER PRIMARY KEY NOT NULL, "
+                             "count INTEGER NOT NULL, crc INTEGER NOT NULL, crc_ms INTEGER NOT NULL)")
+        self.db_conn.commit()
+
+        # Block being filled: [block start, count, crc in seconds, crc in milliseconds]
+        self.current = None
+        # Time of the newest row included in the summaries
+        self.last_time = None
+
+    def get_saved_time(self):
+        # Get the end of the last saved block, or None if no block has been saved. Only closed blocks are saved, so the
+        # summaries are complete up to that time.
+        block = self.db_conn.execute("SELECT MAX(block) FROM blocks").fetchone()[0]
+        return None if block is None else block + self.block_seconds
+
+    def invalidate(self, start_time):
+        # Drop the saved blocks from the one of start_time on, for example after rows were imported into the history,
+        # so that they are rebuilt from the history at the next startup
+        with self.lock:
+            self.db_conn.execute("DELETE FROM blocks WHERE block >= ?", (start_time - start_time % self.block_seconds,))
+            self.db_conn.commit()
+
+    def rebuild(self, rows):
+        """Build the summaries of rows newer than the last saved block, in one pass, at startup"""
+        n = 0
+        for row in rows:
+            self.add(row)
+            n += 1
+        logger.info("Rebuilt block summaries from {} rows".format(n))
+
+    def add(self, row):
+        # Add a row, inserted in time order, to the summary of its block. The line is encoded once, and only its time
+        # is encoded again in the other client resolutions.
+        line = encode_row(row)
+        values = line[len("h{}".format(row[0])):]
+        crc_lines = [line if client_resolution == self.resolution else
+                     "h{}".format(scale_time(row[0], self.resolution, client_resolution)) + values
+                     for client_resolution in CLIENT_RESOLUTIONS]
+        block = row[0] - row[0] % self.block_seconds
+        with self.lock:
+            if self.current is not None and self.current[0] != block:
+                self.save(self.current)
+                self.current = None
+            if self.current is None:
+                self.current = [block, 0, 0, 0]
+            self.current[1] += 1
+            for i in xrange(0, len(crc_lines)):
+                self.current[i + 2] = zlib.crc32(crc_lines[i], self.current[i + 2]) & 0xffffffff
+            self.last_time = row[0]
+
+    def save(self, summary):
+        # Save a closed block; the caller must hold the lock
+        self.db_conn.execute("INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?)", summary)
+        self.db_conn.commit()
+
+    def get(self, start_time, end_time, client_resolution=None):
+        """Get [(block start, count, crc), ...] of the non-empty blocks that overlap [start_time, end_time], with the
+        checksums of the 'h' lines in client_resolution, the resolution of the history by default"""
+        if client_resolution is None:
+            client_resolution = self.resolution
+        crc_column = "crc" if client_resolution == 1 else "crc_ms"
+        first_block = start_time - start_time % self.block_seconds
+        with self.lock:
+            summaries = self.db_conn.execute("SELECT block, count, {} FROM blocks WHERE block >= ? AND block <= ? "
+                                             "ORDER BY block".format(crc_column), (first_block, end_time)).fetchall()
+            if self.current is not None and first_block <= self.current[0] <= end_time:
+                summaries.append((self.current[0], self.current[1],
+                                  self.current[2 + CLIENT_RESOLUTIONS.index(client_resolution)]))
+
+        if self.metrics is not None:
+            self.metrics.increment('sync_requests')
+            self.metrics.increment('sync_blocks', len(summaries))
+        return summaries
+
+    def close(self):
+        # The block being filled is not saved; it is rebuilt from the history at the next startup
+        with self.lock:
+            self.db_conn.close()
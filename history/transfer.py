@@ -0,0 +1,78 @@
+import logging
+import re
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Number of history rows per block; a continuation token is sent after each block
+BLOCK_ROWS = 64
+
+TOKEN_PATTERN = re.compile(r"^(\d+)\.(\d+)\.(\d+)\.(\d+)\.([0-9a-f]{8})$")
+
+
+def encode_token(start_time, end_time, max_points, last_time, crc):
+    # A token holds the request, the time of the last row sent, and the CRC32 of all the 'h' lines sent so far
+    return "{}.{}.{}.{}.{:08x}".format(start_time, end_time, max_points, last_time, crc)
+
+
+def decode_token(token):
+    """Get (start time, end time, max points, last time, crc) of a continuation token"""
+    result = TOKEN_PATTERN.match(token)
+    if result is None:
+        raise ValueError("Invalid continuation token {}".format(token))
+
+    start_time, end_time, max_points, last_time = [int(result.group(i)) for i in xrange(1, 5)]
+    if not start_time <= last_time <= end_time:
+        raise ValueError("Invalid continuation token {}".format(token))
+    return start_time, end_time, max_points, last_time, int(result.group(5), 16)
+
+
+def scale_time(t, resolution, client_resolution):
+    # Convert a time in units of 1 / resolution seconds into units of 1 / client_resolution seconds, rounding down
+    if client_resolution >= resolution:
+        return t * (client_resolution // resolution)
+    return t // (resolution // client_resolution)
+
+
+def scale_range(start_time, end_time, client_resolution, resolution):
+    # Convert a range of times in units of 1 / client_resolution seconds, both inclusive, into the range in units of
+    # 1 / resolution seconds that holds the same rows
+    if resolution >= client_resolution:
+        ratio = resolution // client_resolution
+        return start_time * ratio, end_time * ratio + ratio - 1
+    ratio = client_resolution // resolution
+    return -(-start_time // ratio), end_time // ratio
+
+
+def encode_row(row):
+    # Encode a history row as an 'h' line, with as many values as the history has channels
+    return "h" + ",".join("{}".format(value) for value in row) + "\n"
+
+
+def encode_history(rows, start_time, end_time, max_points=0, crc=0, block_rows=BLOCK_ROWS, resolution=1,
+                   client_resolution=1):
+    """Yield the lines of a history transfer
+
+    Every row is sent as an 'h' line, and every block of rows is followed by a 'c' line carrying a continuation token. A
+    client that gets disconnected sends 'history resume <token>' with the last token it received to get the rest of the
+    rows. The CRC in the last token covers the whole transfer, so the client can check what it has assembled.
+
+    Rows and tokens are in the resolution of the storage, and the times of the 'h' lines in the resolution of the client.
+    """
+    n = 0
+    last_time = None
+    for row in rows:
+        if client_resolution != resolution:
+            line = encode_row((scale_time(row[0], resolution, client_resolution),) + tuple(row[1:]))
+        else:
+            line = encode_row(row)
+        crc = zlib.crc32(line, crc) & 0xffffffff
+        last_time = row[0]
+        n += 1
+        yield line
+
+        if n % block_rows == 0:
+            yield "c" + encode_token(start_time, end_time, max_points, last_time, crc) + "\n"
+
+    if last_time is not None and n % block_rows != 0:
+        yield "c" + encode_token(start_time, end_time, max_points, last_time, crc) + "\n"
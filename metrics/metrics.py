@@ -0,0 +1,64 @@
+import logging
+from bisect import bisect_left
+from threading import Lock
+from time import time
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics(object):
+    """Thread-safe counters, gauges and histograms shared by the sensor server, the history path and the Bluetooth
+    server"""
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        # Histograms as [upper bounds, counts per bucket plus one for the values above the last bound, count, sum]
+        self.histograms = {}
+        self.start_time = time()
+
+        # The sensor server thread, the asyncore thread and the main thread all update metrics, so protect them with a
+        # lock.
+        self.lock = Lock()
+
+    def increment(self, name, value=1):
+        # Add value to the counter 'name', creating it if necessary
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        # Overwrite the gauge 'name' with the latest value
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value, bounds):
+        # Add value to the histogram 'name', creating it with the given sorted bucket upper bounds if necessary
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = [list(bounds), [0] * (len(bounds) + 1), 0, 0.0]
+                self.histograms[name] = histogram
+            histogram[1][bisect_left(histogram[0], value)] += 1
+            histogram[2] += 1
+            histogram[3] += value
+
+    def get(self, name, default=0):
+        with self.lock:
+            if name in self.counters:
+                return self.counters[name]
+            return self.gauges.get(name, default)
+
+    def get_uptime(self):
+        # Get the number of seconds since the metrics were created
+        return time() - self.start_time
+
+    def snapshot(self):
+        # Get a copy of all counters, gauges and histograms in a single dict
+        with self.lock:
+            output = dict(self.counters)
+            output.update(self.gauges)
+            for name, histogram in self.histograms.iteritems():
+                output[name] = {'bounds': list(histogram[0]), 'counts': list(histogram[1]), 'count': histogram[2],
+                                'sum': histogram[3]}
+        output['uptime'] = self.get_uptime()
+        return output
@@ -0,0 +1,4 @@
+from frames import ALL_CHANNELS, AQI_CHANNELS, CHANNELS, FORMATS, FrameCache, encode_binary, encode_frame
+from frames import parse_channels
+from delta import DEFAULT_DEADBANDS, DeltaState, parse_deadbands
+from broadcast import RealtimeBroadcaster
@@ -0,0 +1,56 @@
+import logging
+
+from delta import DeltaState
+
+logger = logging.getLogger(__name__)
+
+
+class RealtimeBroadcaster(object):
+    """Fan-out of the real-time frames of a sample to the subscribed clients
+
+    Every client gets the frame of its subscription, shared through the FrameCache of the sample, or the next frame of
+    its delta encoding state in delta mode, at most once every N seconds of its subscription. Frames are queued to the
+    link scheduler, which sends them before anything else.
+    """
+
+    def __init__(self, scheduler, default_format="csv", deadbands=None, keyframe_interval=20, metrics=None):
+        self.scheduler = scheduler
+        self.default_format = default_format
+        self.deadbands = deadbands
+        self.keyframe_interval = keyframe_interval
+        self.metrics = metrics
+        # Delta encoding state of the clients in delta mode
+        self.delta_states = {}
+
+    def forget(self, active_client_handlers):
+        # Forget the delta encoding state of the clients that are gone
+        for client_handler in self.delta_states.keys():
+            if client_handler not in active_client_handlers:
+                self.delta_states.pop(client_handler)
+
+    def send(self, client_handler, frame_cache, epoch_time):
+        # Times of the frames are in the resolution the client asked for
+        client_resolution = client_handler.sending_status.get('resolution')
+        channels, every, last_time, delta = client_handler.sending_status.get('subscription')
+        output_format = client_handler.sending_status.get('format') or self.default_format
+        if epoch_time - last_time < every:
+            return
+
+        # The frame has a leading character 'r' to indicate its a real-time data, and a newline character '\n' to
+        # indicate the end of the line. Real-time frames have priority over everything else on the link.
+        if delta:
+            if last_time == -1 or client_handler not in self.delta_states:
+                # New subscription, start with a keyframe
+                self.delta_states[client_handler] = DeltaState(channels, self.deadbands, self.keyframe_interval,
+                                                               self.metrics)
+            elif self.scheduler.is_sending_realtime(client_handler):
+                # The frame still waiting is about to be replaced by this one, so the client would never get the
+                # changes it carries: send a keyframe instead of a delta against it. If the frame gets sent in the
+                # meantime, the keyframe is only redundant.
+                self.delta_states[client_handler].reset()
+            frame = self.delta_states[client_handler].next_frame(frame_cache, output_format, client_resolution)
+        else:
+            frame = frame_cache.get(output_format, channels, client_resolution)
+
+        self.scheduler.send_realtime(client_handler, frame)
+        client_handler.sending_status['subscription'][2] = epoch_time
@@ -0,0 +1,70 @@
+import logging
+
+from frames import CHANNEL_NAMES, CHANNELS
+
+logger = logging.getLogger(__name__)
+
+# Smallest change of each channel that is worth sending, in degrees, ppb and ug/m3. Any change of an AQI channel is
+# sent.
+DEFAULT_DEADBANDS = {'temp': 0.1, 'SN1': 1.0, 'SN2': 1.0, 'SN3': 1.0, 'SN4': 1.0, 'PM25': 0.5}
+
+
+def parse_deadbands(text):
+    """Get the deadbands of a comma-separated list such as 'PM25=0.2,no2=2', on top of the default ones"""
+    deadbands = dict(DEFAULT_DEADBANDS)
+    if not text:
+        return deadbands
+
+    for item in text.split(','):
+        name, _, value = item.partition('=')
+        channel = CHANNEL_NAMES.get(name.strip().lower())
+        if channel is None:
+            raise ValueError("Unknown channel {}".format(name))
+        deadbands[channel] = float(value)
+    return deadbands
+
+
+class DeltaState(object):
+    """Delta encoding state of one real-time client
+
+    The first frame is a keyframe, a regular 'r' frame. The following ones are 'd' frames that only carry the channels
+    whose value moved by more than their deadband since it was last sent, until keyframe_interval frames have been sent
+    and a new keyframe resynchronizes the client.
+    """
+
+    def __init__(self, channels=CHANNELS, deadbands=None, keyframe_interval=20, metrics=None):
+        self.channels = channels
+        self.deadbands = DEFAULT_DEADBANDS if deadbands is None else deadbands
+        self.keyframe_interval = keyframe_interval
+        self.metrics = metrics
+
+        # Values as the client knows them, and number of frames sent since the last keyframe
+        self.reference = None
+        self.n_frames = 0
+
+    def reset(self):
+        # Send a keyframe next, for example because a frame could not be delivered
+        self.reference = None
+
+    def next_frame(self, frame_cache, output_format, resolution=1):
+        sample = frame_cache.sample
+        keyframe = frame_cache.get(output_format, self.channels, resolution)
+
+        if self.reference is None or self.n_frames >= self.keyframe_interval:
+            self.reference = dict((channel, sample[channel]) for channel in self.channels)
+            self.n_frames = 0
+            return keyframe
+
+        changed = tuple(channel for channel in self.channels
+                        if abs(sample[channel] - self.reference[channel]) > self.deadbands.get(channel, 0.0))
+        for channel in changed:
+            self.reference[channel] = sample[channel]
+        self.n_frames += 1
+
+        frame = frame_cache.get_delta(output_format, changed, resolution)
+        if self.metrics is not None:
+            self.metrics.increment('delta_bytes_saved', len(keyframe) - len(frame))
+            hours = self.metrics.get_uptime() / 3600.0
+            if hours > 0:
+                self.metrics.set_gauge('delta_bytes_saved_per_hour', self.metrics.get('delta_bytes_saved') / hours)
+        return frame
@@ -0,0 +1,149 @@
+import json
+import logging
+import struct
+
+logger = logging.getLogger(__name__)
+
+# Channels of a real-time frame, in the order they are sent
+CHANNELS = ('temp', 'SN1', 'SN2', 'SN3', 'SN4', 'PM25')
+
+# Channels only sent to the clients that subscribe to them: the air quality index and the sub-index of every
+# pollutant, -1 until their averaging window has a sample
+AQI_CHANNELS = ('AQI', 'AQI_PM25', 'AQI_OX', 'AQI_CO', 'AQI_NO2', 'AQI_SO2')
+ALL_CHANNELS = CHANNELS + AQI_CHANNELS
+
+# Output formats of real-time frames
+FORMATS = ('csv', 'json', 'binary')
+
+# Header of a binary frame after the leading 'b' and its length byte: kind (0 for a keyframe, 1 for a delta frame, plus
+# 2 when the time is in milliseconds, plus 4 when the mask has 16 bits), epoch time, bit mask of the channels that
+# follow as float32 values (bit i for ALL_CHANNELS[i]). The mask only has 16 bits when a channel past the eighth is
+# sent.
+BINARY_HEADER = struct.Struct("<BIB")
+BINARY_HEADER_MS = struct.Struct("<BQB")
+BINARY_HEADER_WIDE = struct.Struct("<BIH")
+BINARY_HEADER_MS_WIDE = struct.Struct("<BQH")
+
+# Names accepted in subscriptions, case-insensitive; sensor names are accepted as well as frame keys
+CHANNEL_NAMES = dict([(channel.lower(), channel) for channel in ALL_CHANNELS] +
+                     [('no2', 'SN1'), ('ox', 'SN2'), ('co', 'SN3'), ('so2', 'SN4')])
+
+
+def parse_channels(text):
+    """Get the tuple of channels of a comma-separated list such as 'PM25,no2,aqi', or the sensor channels for 'all'"""
+    if text is None or text.lower() == 'all':
+        return CHANNELS
+
+    selected = set()
+    for name in text.split(','):
+        channel = CHANNEL_NAMES.get(name.strip().lower())
+        if channel is None:
+            raise ValueError("Unknown channel {}".format(name))
+        selected.add(channel)
+    # Keep the frame order whatever the order of the subscription
+    return tuple(channel for channel in ALL_CHANNELS if channel in selected)
+
+
+def encode_frame(sample, output_format, channels=CHANNELS):
+    # Encode the time and the given channels of a sample, without the leading 'r' and the trailing newline
+    if output_format == "json":
+        output = {'time': sample['time']}
+        for channel in channels:
+            output[channel] = sample[channel]
+        return json.dumps(output)
+
+    # Create CSV message "time, channel 1, ..., channel n".
+    return ",".join(str(value) for value in [sample['time']] + [sample[channel] for channel in channels])
+
+
+def encode_delta(sample, output_format, channels):
+    # Encode the time and the given channels of a sample as a delta frame, without the leading 'd' and the trailing
+    # newline
+    if output_format == "json":
+        return encode_frame(sample, output_format, channels)
+
+    # Create CSV message "time, channel 1=value 1, ..., channel n=value n".
+    return ",".join([str(sample['time'])] + ["{}={}".format(channel, sample[channel]) for channel in channels])
+
+
+def encode_binary(sample, channels, delta=False, resolution=1):
+    # Encode a binary frame: 'b', the length of the rest of the frame, the header, then one float32 per channel. Binary
+    # frames are not newline-terminated, since their payload may contain any byte.
+    mask = 0
+    for i in xrange(0, len(ALL_CHANNELS)):
+        if ALL_CHANNELS[i] in channels:
+            mask |= 1 << i
+    kind = 1 if delta else 0
+    if mask < 256:
+        if resolution == 1:
+            header = BINARY_HEADER.pack(kind, sample['time'], mask)
+        else:
+            header = BINARY_HEADER_MS.pack(kind | 2, sample['time'], mask)
+    elif resolution == 1:
+        header = BINARY_HEADER_WIDE.pack(kind | 4, sample['time'], mask)
+    else:
+        header = BINARY_HEADER_MS_WIDE.pack(kind | 6, sample['time'], mask)
+    payload = header + \
+        struct.pack("<{}f".format(len(channels)), *[sample[channel] for channel in channels])
+    return 'b' + chr(len(payload)) + payload
+
+
+class FrameCache(object):
+    """Encoded real-time frames of one sample
+
+    Each distinct (format, channels) combination is encoded once per sample and the frame is shared by every client that
+    subscribed to it, so the cost of a broadcast depends on the number of subscription shapes, not of clients.
+
+    The time of the sample is in units of 1 / resolution seconds. Clients get it in whole seconds unless they asked for
+    milliseconds.
+    """
+
+    def __init__(self, sample, metrics=None, resolution=1):
+        self.sample = sample
+        self.metrics = metrics
+        self.resolution = resolution
+        self.frames = {}
+
+    def get_sample(self, resolution):
+        # Get the sample with its time in the given resolution, rounded down
+        if resolution == self.resolution:
+            return self.sample
+        sample = dict(self.sample)
+        if resolution > self.resolution:
+            sample['time'] = self.sample['time'] * (resolution // self.resolution)
+        else:
+            sample['time'] = self.sample['time'] // (self.resolution // resolution)
+        return sample
+
+    def get(self, output_format, channels=CHANNELS, resolution=1):
+        key = (output_format, channels, resolution)
+        frame = self.frames.get(key)
+        if frame is None:
+            sample = self.get_sample(resolution)
+            if output_format == "binary":
+                frame = encode_binary(sample, channels, resolution=resolution)
+            else:
+                frame = 'r' + encode_frame(sample, output_format, channels) + '\n'
+            self.frames[key] = frame
+            if self.metrics is not None:
+                self.metrics.increment('frames_encoded')
+        elif self.metrics is not None:
+            self.metrics.increment('frames_reused')
+        return frame
+
+    def get_delta(self, output_format, channels, resolution=1):
+        # A delta frame only depends on the sample and the channels that changed, so clients share it as well
+        key = ('delta', output_format, channels, resolution)
+        frame = self.frames.get(key)
+        if frame is None:
+            sample = self.get_sample(resolution)
+            if output_format == "binary":
+                frame = encode_binary(sample, channels, delta=True, resolution=resolution)
+            else:
+                frame = 'd' + encode_delta(sample, output_format, channels) + '\n'
+            self.frames[key] = frame
+            if self.metrics is not None:
+                self.metrics.increment('frames_encoded')
+        elif self.metrics is not None:
+            self.metrics.increment('frames_reused')
+        return frame
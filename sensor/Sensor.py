@@ -1,35 +1,112 @@
 import logging
-import sqlite3
-from neo import Gpio
+from adc import DEFAULT_CHANNEL_MAP, IIO_PATH, AdcReader, parse_channel_map
+from adctrace import TraceWriter
+from deadline import DeadlineScheduler
+from history import open_storage
+from motion import MOTION_NAMES, MotionPoller
+from neo import GPIO_PATH, Barometer, Gpio, Temp, drivers
 from threading import Thread
 from threading import Lock
-from time import sleep, time
+from time import time
 
 logger = logging.getLogger(__name__)
 
+# Names of the sensors, in the order of the columns of the history
+SENSOR_NAMES = ['Temp', 'NO2', 'OX', 'CO', 'SO2', 'PM25']
+
+# Channels of the onboard temperature, in degrees Celsius, and pressure, in kPa, recorded when they are sampled
+ONBOARD_NAMES = ['BoardTemp', 'Pressure']
+
+
+def get_channel_names(motion=False, onboard=False):
+    # Get the channels of the history. Optional channels come after the sensors, in a fixed order, since the segment
+    # storage engine can only append channels.
+    return SENSOR_NAMES + (MOTION_NAMES if motion else []) + (ONBOARD_NAMES if onboard else [])
+
+
+def calibrate(channels, sensor_names=SENSOR_NAMES):
+    """Convert the 12 ADC channels of a round of readings, in mV, to (temperature, NO2, OX, CO, SO2, PM2.5)"""
+    c0, c1, c2, c3, c4, c5, c6, c7, c8, c9, c10, c11 = channels
+    # Temperature constant
+    t0 = 550
+    # Channel 1 is not connected so we don't care about its output
+    temp = c0 - t0
+    logger.info("{} sensor outputs {} degree".format(sensor_names[0], temp))
+
+    # NO2-A43F
+    sn1 = ((c2 - 220) - (c3 - 260) / 2.02) / 0.207
+    # based on the certificate of 25-000014 and AAN803-03 document
+    logger.info("{} sensor outputs {} ppb".format(sensor_names[1], sn1))
+
+    sn2 = ((c4 - 414) - (c5 - 400) / 1.28) / 0.256
+    # OX-A431
+    logger.info("{} sensor outputs {} ppb".format(sensor_names[2], sn2))
+
+    sn3 = ((c6 - 346) - (c7 - 274) / -1.00) / 0.276
+    # CO-A4
+    logger.info("{} sensor outputs {} ppb".format(sensor_names[3], sn3))
+
+    sn4 = ((c8 - 300) - (c9 - 294) / 1.82) / 0.300
+    # SO2-A4
+    logger.info("{} sensor outputs {} ppb".format(sensor_names[4], sn4))
+
+    # Channel 11 is not connected so we don't care about its output
+    x = c10 / 1000.0
+    hppcf = 240 * pow(x, 6) - 2491.3 * pow(x, 5) + 9448.7 * pow(x, 4) - 14840.0 * pow(x, 3) \
+            + 10684.0 * pow(x, 2) + 2211.8 * x + 7.9623
+    umg3 = 0.518 + 0.0274 * hppcf
+    pm25 = umg3
+    if pm25 < 0:
+        pm25 = 0
+    # Reverse-engineered from:
+    # https://github.com/Lahorde/airbeam/blob/master/firmware/arduino/AirBeam/AirBeam.ino
+    # Note that its its 'analogtotal' is in volts rather than millivolts. In our case, the output of c10 is in
+    # volts so we need to fix the conversion function.
+    logger.info("{} sensor outputs {} ppb".format(sensor_names[5], pm25))
+
+    return temp, sn1, sn2, sn3, sn4, pm25
+
 
 class SensorServer(Thread):
-    """Sensor server that keeps reading sensors and provide get_sensor_output() method for user"""
+    """Sensor server that keeps reading sensors and provide get_sensor_output() method for user
+
+    A round of readings goes through acquire(), which waits for the deadline and reads the ADC, calibrate() and
+    store_row(). Subclasses without the hardware, such as the replay server, override setup_hardware(),
+    start_acquisition() and acquire().
+    """
+
+    # Roots of the sysfs interfaces of the GPIOs and of the ADC, and manager of the drivers of the onboard sensors,
+    # which subclasses may point to fake trees
+    gpio_path = GPIO_PATH
+    iio_path = IIO_PATH
+    drivers = drivers
 
-    def __init__(self, database_name="air_pollution_data.db"):
+    def __init__(self, database_name="air_pollution_data.db", storage_engine="sqlite", block_summaries=None, ring=None,
+                 resolution=1, period=2.4, settle_time=0.05, overrun_policy="skip", metrics=None, motion_rate=0,
+                 onboard=False, channel_map=None, aqi_engine=None, sketches=None, trace_path=None):
         # Parent class constructor
         Thread.__init__(self)
 
-        # Assign GPIO pins that controls MUX, LSB to MSB
-        self.gpio_pins = [24, 25, 26, 27]
-        self.gpio = Gpio()
-        # Set GPIO pins to output
-        try:
-            for pin in self.gpio_pins:
-                self.gpio.pinMode(pin, self.gpio.OUTPUT)
-        except Exception as e:
-            logger.error("Error setting GPIO pin {}, reason {}".format(pin, e.message))
+        # What __del__ releases, set first so that a constructor that fails half-way does not make it fail as well
+        self.storage = None
+        self.trace = None
+        self.gpio = None
+
+        self.sensor_names = self.get_sensor_names(motion_rate, onboard)
 
-        # Use A0 port
-        self.adc_raw = "/sys/bus/iio/devices/iio:device0/in_voltage0_raw"
-        self.adc_scale = "/sys/bus/iio/devices/iio:device0/in_voltage_scale"
+        # Time between the starts of two rounds of readings, and time the MUX output takes to settle, in seconds. With
+        # the default channel map, every channel goes through the MUX into A0, so a round takes 12 settle times plus
+        # the database commit, and the default period leaves 1.8 seconds of idle time.
+        self.period = period
+        self.settle_time = settle_time
+        self.setup_hardware(motion_rate, onboard, channel_map)
+        # Rounds of readings start on a fixed grid of a monotonic clock, so that samples are evenly spaced
+        self.deadlines = DeadlineScheduler(self.period, policy=overrun_policy, metrics=metrics)
 
-        self.sensor_names = ['Temp', 'NO2', 'OX', 'CO', 'SO2', 'PM25']
+        # Raw readings of every round are recorded to a trace, for replaying them later
+        self.trace = None
+        if trace_path is not None:
+            self.trace = TraceWriter(trace_path, self.sensor_names[len(SENSOR_NAMES):])
 
         # Use a dict to store sensor output, the format is:
         # { "time": [time stamp],
@@ -42,6 +119,15 @@ class SensorServer(Thread):
         # read at the same time; similarly, when reading the result, lock it on to prevent it from being updated.
         self.sensor_output_lock = Lock()
 
+        # Time stamp of the newest sample committed to the database. Rows up to this time never change, so history
+        # responses of ranges that end before it can be cached.
+        self.last_commit_time = -1
+        # Number of rows inserted per commit, and time stamp of the newest row inserted. The sensors commit every
+        # sample, while a replay as fast as possible commits in batches.
+        self.commit_rows = 1
+        self.last_insert_time = -1
+        self.pending_rows = 0
+
         # Here we have a decision to make. I decide to let sensor server write sensor outputs to the local database. Of
         # course we can do so in a different thread either in a synchronous way or in an asynchronous way. If we do it
         # with a synchronous approach, we need to use locks to keep synchronization; if we do it with an asynchronous
@@ -49,46 +135,80 @@ class SensorServer(Thread):
         # of complexity. Perhaps the most reasonable way would be specifying the database in the main thread and then
         # send it to the sensor server thread.
         self.database_name = database_name
+        self.storage_engine = storage_engine
+        self.storage = None
+        # Time resolution of new databases, in time units per second; existing ones keep their own
+        self.resolution = resolution
+        # Per-block summaries of the history for client synchronization, updated as rows are inserted
+        self.block_summaries = block_summaries
+        # Per-block quantile sketches of the history for percentile queries, updated as rows are inserted
+        self.sketches = sketches
+        # Rolling means of the air quality index, updated as rows are inserted
+        self.aqi_engine = aqi_engine
+        # Shared-memory ring that committed samples are published to, when acquiring in a process of its own
+        self.ring = ring
 
         try:
-            # Create the database file and get the connection object.
-            self.db_conn = sqlite3.connect(self.database_name)
-            # Get database cursor from the connection object.
-            self.db_cur = self.db_conn.cursor()
+            # Create the database and its 'history' table. The storage is opened again by the sensor server thread,
+            # since a SQLite connection can only be used by the thread that created it.
+            open_storage(self.storage_engine, self.database_name, self.sensor_names, writable=True,
+                         resolution=self.resolution).close()
         except Exception as e:
-            logger.error("Error connecting the database {}, reason: {}".format(self.database_name, e.message))
-            self.__del__()
-
-        # Create a 'history' table for history data.
-        #  TIME | Temp |  SN1 |  SN2 |  SN3 |  SN4 | PM25
-        # -----------------------------------------------
-        #   int | real | real | real | real | real | real
-        self.db_cur.execute(("CREATE TABLE IF NOT EXISTS history (time int PRIMARY KEY NOT NULL,"
-                             " {0} real, {1} real, {2} real, {3} real, {4} real, {5} real)")
-                            .format(self.sensor_names[0],
-                                    self.sensor_names[1],
-                                    self.sensor_names[2],
-                                    self.sensor_names[3],
-                                    self.sensor_names[4],
-                                    self.sensor_names[5]))
-
-        # Commit the changes. When a database is accessed by multiple connections, and one of the processes modifies the
-        # database, the SQLite database is locked until that transaction is committed. The timeout parameter specifies
-        # how long the connection should wait for the lock to go away until raising an exception. The default for the
-        # timeout parameter is 5.0 (five seconds).
-        self.db_conn.commit()
+            logger.error("Error connecting the database {}, reason: {}".format(self.database_name, repr(e)))
 
     def __del__(self):
-        # Gracefully close the database connection.
-        self.db_conn.close()
+        # Gracefully close the history storage and the trace.
+        if self.storage is not None:
+            self.storage.close()
+        if self.trace is not None:
+            self.trace.close()
         # Reset GPIOs.
-        for i in xrange(0, 4):
-            self.gpio.digitalWrite(24 + i, Gpio.LOW)
+        if self.gpio is not None:
+            for i in xrange(0, 4):
+                self.gpio.digitalWrite(24 + i, self.gpio.LOW)
+
+    def get_sensor_names(self, motion_rate, onboard):
+        # Get the channels of the history rows
+        return get_channel_names(motion_rate > 0, onboard)
+
+    def setup_hardware(self, motion_rate, onboard, channel_map):
+        # Assign GPIO pins that controls MUX, LSB to MSB
+        self.gpio_pins = [24, 25, 26, 27]
+        self.gpio = Gpio(self.gpio_path)
+        # Set GPIO pins to output
+        try:
+            for pin in self.gpio_pins:
+                self.gpio.pinMode(pin, self.gpio.OUTPUT)
+        except Exception as e:
+            logger.error("Error setting GPIO pin {}, reason {}".format(pin, e.message))
+
+        # Poll the onboard motion sensors at motion_rate Hz, and store their summaries as extra channels
+        self.motion_poller = None
+        if motion_rate > 0:
+            self.motion_poller = MotionPoller(motion_rate)
+            self.motion_poller.daemon = True
+
+        # Sample the onboard temperature and pressure in every round, for the compensation of the gas sensors. Their
+        # drivers are only loaded if missing, and their values are read through descriptors that stay open.
+        self.board_temp = None
+        self.barometer = None
+        if onboard:
+            self.board_temp = Temp(self.drivers)
+            self.barometer = Barometer(self.drivers)
+
+        # ADC inputs and MUX channels of the 12 channels, sensor n on channels 2n and 2n + 1
+        if channel_map is None:
+            channel_map = parse_channel_map(DEFAULT_CHANNEL_MAP)
+        self.adc = AdcReader(channel_map, self.set_mux_channel, self.settle_time, path=self.iio_path)
 
     def get_sensor_output(self):
         # Get the latest sensor output
         return self.sensor_output.copy()
 
+    def get_last_commit_time(self):
+        # Get the time stamp of the newest sample committed to the database
+        return self.last_commit_time
+
     def set_mux_channel(self, m):
         # Set MUX channel
         # Convert n into a binary string
@@ -97,121 +217,101 @@ class SensorServer(Thread):
         for i in xrange(0, 4):
             self.gpio.digitalWrite(24 + i, bin_repr[i])
 
-    def read_sensor(self, n):
-        # Read raw data from sensor n, we allocate 2 channels for each sensor:
-        # sensor 0: channel 0, 1
-        # sensor 1: channel 2, 3
-        # ...
-        # sensor 7: channel 14, 15
-
-        # Set MUX to read the first channel
-        try:
-            self.set_mux_channel(2 * n)
-            # Wait for 50 ms
-            sleep(0.05)
-            v1 = int(open(self.adc_raw).read()) * float(open(self.adc_scale).read())
-
-            # Set MUX to read the second channel
-            # According to https://www.udoo.org/docs-neo/Hardware_&_Accessories/ADC.html, the output has 12-bit
-            # precision (0 - 4095) representing 0 - 3300 mv region
-            self.set_mux_channel(2 * n + 1)
-            sleep(0.05)
-            v2 = int(open(self.adc_raw).read()) * float(open(self.adc_scale).read())
-
-            return v1, v2
-        except Exception as e:
-            logger.error("Error reading sensor {}, reason: {}".format(n, e.message))
-            return 0.0, 0.0
+    def read_onboard(self):
+        # Read the onboard temperature and pressure, which are missing if their device could not be set up
+        temp = self.board_temp.getTemp("c") if self.board_temp.reader is not None else float("nan")
+        pressure = self.barometer.getPressure() if self.barometer.preader is not None else float("nan")
+        return temp, pressure
 
     def run(self):
         try:
-            # Create the database file and get the connection object.
-            self.db_conn = sqlite3.connect(self.database_name)
-            # Get database cursor from the connection object.
-            self.db_cur = self.db_conn.cursor()
+            # Open the history storage for appending samples.
+            self.storage = open_storage(self.storage_engine, self.database_name, self.sensor_names, writable=True,
+                                        resolution=self.resolution)
         except Exception as e:
-            logger.error("Error connecting the database {}, reason: {}".format(self.database_name, e.message))
-            self.__del__()
+            logger.error("Error connecting the database {}, reason: {}".format(self.database_name, repr(e)))
+            return
+
+        # Time stamps are in the resolution of the database, which is whole seconds for the databases created before
+        # sub-second sampling. Two samples in the same time unit cannot both be stored.
+        self.resolution = self.storage.resolution
+        if self.resolution == 1 and self.period < 1:
+            logger.warn("Database {} stores whole seconds, samples taken in the same second will be dropped"
+                        .format(self.database_name))
+
+        self.start_acquisition()
 
-        # Keep reading sensors.
+        # Keep reading sensors until the source runs out, which only a replayed one does
         while True:
-            # Acquire the lock
-            self.sensor_output_lock.acquire()
-            # Add time stamp
-            epoch_time = int(time())
-            self.sensor_output['time'] = epoch_time
-
-            # Do sensor reading here
-            #  1. set MUX to sensor 0, read sensor 0;
-            #  2. set MUX to sensor 1, read sensor 1;
-            #  ...
-            #  n. set MUX to sensor n - 1, read sensor n - 1.
-            logger.info("Reading {} sensor...".format(self.sensor_names[0]))
-            # Temperature constant
-            t0 = 550
-            c0, c1 = self.read_sensor(0)
-            # Channel 1 is not connected so we don't care about its output
-            temp = c0 - t0
-            logger.info("{} sensor outputs {} degree".format(self.sensor_names[0], temp))
-            # Save output to the dict
-            self.sensor_output[self.sensor_names[0]] = temp
-
-            logger.info("Reading {} sensor...".format(self.sensor_names[1]))
-            c2, c3 = self.read_sensor(1)
-            # NO2-A43F
-            sn1 = ((c2 - 220) - (c3 - 260) / 2.02) / 0.207
-            # based on the certificate of 25-000014 and AAN803-03 document
-            logger.info("{} sensor outputs {} ppb".format(self.sensor_names[1], sn1))
-            # Save output to the dict
-            self.sensor_output[self.sensor_names[1]] = sn1
-
-            logger.info("Reading {} sensor...".format(self.sensor_names[2]))
-            c4, c5 = self.read_sensor(2)
-            sn2 = ((c4 - 414) - (c5 - 400) / 1.28) / 0.256
-            # OX-A431
-            logger.info("{} sensor outputs {} ppb".format(self.sensor_names[2], sn2))
-            # Save output to the dict
-            self.sensor_output[self.sensor_names[2]] = sn2
-
-            logger.info("Reading {} sensor...".format(self.sensor_names[3]))
-            c6, c7 = self.read_sensor(3)
-            sn3 = ((c6 - 346) - (c7 - 274) / -1.00) / 0.276
-            # CO-A4
-            logger.info("{} sensor outputs {} ppb".format(self.sensor_names[3], sn3))
-            # Save output to the dict
-            self.sensor_output[self.sensor_names[3]] = sn3
-
-            logger.info("Reading {} sensor...".format(self.sensor_names[4]))
-            c8, c9 = self.read_sensor(4)
-            sn4 = ((c8 - 300) - (c9 - 294) / 1.82) / 0.300
-            # SO2-A4
-            logger.info("{} sensor outputs {} ppb".format(self.sensor_names[4], sn4))
-            # Save output to the dict
-            self.sensor_output[self.sensor_names[4]] = sn4
-
-            logger.info("Reading {} sensor...".format(self.sensor_names[5]))
-            c10, c11 = self.read_sensor(5)
-            # Channel 11 is not connected so we don't care about its output
-            x = c10 / 1000.0
-            hppcf = 240 * pow(x, 6) - 2491.3 * pow(x, 5) + 9448.7 * pow(x, 4) - 14840.0 * pow(x, 3) \
-                    + 10684.0 * pow(x, 2) + 2211.8 * x + 7.9623
-            umg3 = 0.518 + 0.0274 * hppcf
-            pm25 = umg3
-            if pm25 < 0:
-                pm25 = 0
-            # Reverse-engineered from:
-            # https://github.com/Lahorde/airbeam/blob/master/firmware/arduino/AirBeam/AirBeam.ino
-            # Note that its its 'analogtotal' is in volts rather than millivolts. In our case, the output of c10 is in
-            # volts so we need to fix the conversion function.
-            logger.info("{} sensor outputs {} ppb".format(self.sensor_names[5], pm25))
-            # Save output to the dict
-            self.sensor_output[self.sensor_names[5]] = pm25
-
-            self.db_cur.execute("INSERT INTO history VALUES ({}, {}, {}, {}, {}, {}, {})"
-                                .format(epoch_time, temp, sn1, sn2, sn3, sn4, pm25))
-
-            self.db_conn.commit()
-            self.sensor_output_lock.release()
-
-            # Idle for 3 seconds
-            sleep(1.8)
+            sample = self.acquire()
+            if sample is None:
+                break
+            epoch_time, channels, extras = sample
+            if self.trace is not None:
+                self.trace.write(epoch_time / float(self.resolution), channels, extras)
+            self.store_row(self.get_row(epoch_time, channels, extras))
+
+        # Only a replayed source runs out
+        with self.sensor_output_lock:
+            self.commit()
+        self.storage.close()
+        self.storage = None
+
+    def start_acquisition(self):
+        if self.adc.get_settle_count() * self.settle_time >= self.period:
+            logger.warn("Sample period of {} s is shorter than the settle times of a round of readings, every round "
+                        "will overrun".format(self.period))
+
+        if self.motion_poller is not None:
+            self.motion_poller.start()
+
+    def acquire(self):
+        """Wait for the next round of readings and get (time stamp, the 12 ADC channels in mV, values of the motion and
+        onboard channels), or None once there is no more sample"""
+        # Wait for the next deadline
+        skipped = self.deadlines.wait()
+        if skipped > 0:
+            logger.warn("Reading sensors overran, skipped {} samples".format(skipped))
+
+        # Time stamp of the start of the readings
+        epoch_time = int(time() * self.resolution)
+
+        # Read the two channels of every sensor, grouped by MUX channel
+        channels = self.adc.read_all()
+        extras = ()
+        if self.motion_poller is not None:
+            extras += tuple(self.motion_poller.get_summary())
+        if self.board_temp is not None:
+            extras += self.read_onboard()
+        return epoch_time, channels, extras
+
+    def get_row(self, epoch_time, channels, extras):
+        # Calibrate a round of readings into a history row
+        return (epoch_time,) + calibrate(channels, self.sensor_names) + tuple(extras)
+
+    def store_row(self, row):
+        # Publish a sample, and append it to the history and everything that is updated with it
+        with self.sensor_output_lock:
+            self.sensor_output = dict(zip(['time'] + self.sensor_names, row))
+            if row[0] > self.last_insert_time:
+                self.storage.insert(row)
+                self.last_insert_time = row[0]
+                self.pending_rows += 1
+                if self.pending_rows >= self.commit_rows:
+                    self.commit()
+                if self.block_summaries is not None:
+                    self.block_summaries.add(row)
+                if self.sketches is not None:
+                    self.sketches.add(row)
+                if self.aqi_engine is not None:
+                    self.aqi_engine.add(row)
+                if self.ring is not None:
+                    self.ring.publish(row)
+            else:
+                logger.warn("Sample at {} is not newer than the last stored one, dropping it".format(row[0]))
+
+    def commit(self):
+        # Commit the rows inserted so far
+        self.storage.commit()
+        self.last_commit_time = self.last_insert_time
+        self.pending_rows = 0
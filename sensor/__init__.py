@@ -1 +1,8 @@
-from Sensor import SensorServer
+from Sensor import ONBOARD_NAMES, SENSOR_NAMES, SensorServer, calibrate, get_channel_names
+from adctrace import ADC_NAMES, TraceSource, TraceWriter
+from adc import DEFAULT_CHANNEL_MAP, IIO_PATH, AdcReader, parse_channel_map
+from deadline import DeadlineScheduler, monotonic
+from motion import MOTION_NAMES, MotionPoller
+from ring import SampleRing
+from process import SensorProcess
+from replay import HistorySource, ReplayClock, ReplayServer, get_source_columns, open_source
@@ -0,0 +1,112 @@
+import logging
+import os
+import re
+from time import sleep
+
+logger = logging.getLogger(__name__)
+
+# Root of the sysfs interface of the ADC of the Neo
+IIO_PATH = "/sys/bus/iio/devices/iio:device0/"
+
+# Number of ADC channels read in a round: two per sensor
+N_CHANNELS = 12
+
+# Default channel map: every channel goes through the 16:1 MUX into input A0, channel n on MUX channel n
+DEFAULT_CHANNEL_MAP = ",".join("A0.{}".format(n) for n in xrange(0, N_CHANNELS))
+
+
+def parse_channel_map(spec):
+    """Parse a channel map such as 'A0.0,A1.0,A0.1,A1.1,...' into a list of (ADC input, MUX channel) pairs
+
+    Entry n tells where channel n is wired: 'A<input>.<MUX channel>' behind the MUX, whose select lines may drive
+    several MUXes feeding different inputs, or 'A<input>' straight to an ADC input. MUX channel is None for the latter.
+    """
+    entries = [entry.strip() for entry in spec.split(",")]
+    if len(entries) != N_CHANNELS:
+        raise ValueError("Channel map has {} entries instead of {}".format(len(entries), N_CHANNELS))
+
+    channel_map = []
+    for entry in entries:
+        match = re.match(r"^A(\d+)(?:\.(\d+))?$", entry)
+        if match is None:
+            raise ValueError("Invalid channel map entry '{}'".format(entry))
+        mux_channel = None if match.group(2) is None else int(match.group(2))
+        if mux_channel is not None and mux_channel > 15:
+            raise ValueError("Invalid MUX channel in '{}'".format(entry))
+        channel_map.append((int(match.group(1)), mux_channel))
+
+    if len(set(channel_map)) != len(channel_map):
+        raise ValueError("Channel map reads the same input twice")
+    return channel_map
+
+
+class AdcReader(object):
+    """Reads the 12 sensor channels through several ADC inputs, sharing the MUX settle times
+
+    The channels are grouped by MUX channel: the MUX is switched, and waited for, once per group, and then every input
+    of the group is read, so channels wired to MUXes that share the select lines settle together. Inputs wired without
+    a MUX are read first, with no settle time. The raw values are read through descriptors that stay open, and the
+    scale of every input once.
+    """
+
+    def __init__(self, channel_map, set_mux, settle_time=0.05, path=IIO_PATH):
+        self.channel_map = channel_map
+        self.set_mux = set_mux
+        self.settle_time = settle_time
+        self.path = path
+
+        # Groups of (channel, input) read after each MUX switch, in the order of the MUX channels, direct inputs first
+        groups = {}
+        for channel, (adc_input, mux_channel) in enumerate(self.channel_map):
+            groups.setdefault(mux_channel, []).append((channel, adc_input))
+        self.groups = sorted(groups.items(), key=lambda group: -1 if group[0] is None else group[0])
+
+        self.fds = {}
+        self.scales = {}
+        for adc_input in set(adc_input for adc_input, _ in self.channel_map):
+            try:
+                self.fds[adc_input] = os.open(os.path.join(self.path, "in_voltage{}_raw".format(adc_input)),
+                                              os.O_RDONLY)
+                self.scales[adc_input] = self.read_scale(adc_input)
+            except (OSError, IOError, ValueError) as e:
+                logger.error("Error opening ADC input A{}, reason: {}".format(adc_input, repr(e)))
+
+    def read_scale(self, adc_input):
+        # Inputs have a scale of their own, or share the one of the ADC
+        path = os.path.join(self.path, "in_voltage{}_scale".format(adc_input))
+        if not os.path.exists(path):
+            path = os.path.join(self.path, "in_voltage_scale")
+        with open(path) as f:
+            return float(f.read())
+
+    def get_settle_count(self):
+        # Number of MUX settle times of a round
+        return len([mux_channel for mux_channel, _ in self.groups if mux_channel is not None])
+
+    def read_input(self, adc_input):
+        # Read an input in mV. According to https://www.udoo.org/docs-neo/Hardware_&_Accessories/ADC.html, the output
+        # has 12-bit precision (0 - 4095) representing 0 - 3300 mv region
+        fd = self.fds[adc_input]
+        os.lseek(fd, 0, os.SEEK_SET)
+        return int(os.read(fd, 32)) * self.scales[adc_input]
+
+    def read_all(self):
+        """Read all the channels in mV, 0.0 for a channel that cannot be read"""
+        values = [0.0] * N_CHANNELS
+        for mux_channel, group in self.groups:
+            try:
+                if mux_channel is not None:
+                    self.set_mux(mux_channel)
+                    # Wait for the MUX outputs to settle
+                    sleep(self.settle_time)
+                for channel, adc_input in group:
+                    values[channel] = self.read_input(adc_input)
+            except Exception as e:
+                logger.error("Error reading channels {}, reason: {}".format([channel for channel, _ in group],
+                                                                             repr(e)))
+        return values
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
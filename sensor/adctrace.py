@@ -0,0 +1,72 @@
+import gzip
+import logging
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Names of the 12 ADC channels of a round of readings, in the order AdcReader.read_all() returns them
+ADC_NAMES = ["c{}".format(i) for i in xrange(0, 12)]
+
+
+class TraceWriter(object):
+    """Recorder of the raw readings of the sensor server, for replaying them through the calibration later
+
+    A trace is a CSV file, gzip-compressed if its name ends with .gz, of one line per round of readings: the time in
+    seconds, the 12 ADC channels in mV, and the values of the motion and onboard channels, named after the header line.
+    Every line is flushed, so a trace cut by a power loss is readable up to its last complete round.
+    """
+
+    def __init__(self, path, extra_names=()):
+        self.path = path
+        self.file = gzip.open(path, "wb", 6) if path.endswith(".gz") else open(path, "wb")
+        self.file.write(",".join(["time"] + ADC_NAMES + list(extra_names)) + "\n")
+
+    def write(self, t, channels, extras=()):
+        # repr() keeps every digit of the floats, so that a replayed round is calibrated to the same values
+        self.file.write(",".join([repr(float(t))] + [repr(value) for value in channels] +
+                                 [repr(value) for value in extras]) + "\n")
+        if isinstance(self.file, gzip.GzipFile):
+            self.file.flush(zlib.Z_SYNC_FLUSH)
+        else:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class TraceSource(object):
+    """Rounds of readings of a trace recorded by TraceWriter, as (time in seconds, the 12 ADC channels, extra values)"""
+
+    # The readings are raw, so they go through the calibration when replayed
+    calibrated = False
+
+    def __init__(self, path):
+        self.path = path
+        with self.open() as f:
+            names = f.readline().strip().split(",")
+        if names[:len(ADC_NAMES) + 1] != ["time"] + ADC_NAMES:
+            raise ValueError("{} is not a trace of ADC readings".format(path))
+        # Channels recorded after the ADC ones, such as the motion and onboard ones
+        self.extra_names = names[len(ADC_NAMES) + 1:]
+
+    def open(self):
+        return gzip.open(self.path, "rb") if self.path.endswith(".gz") else open(self.path, "rb")
+
+    def __iter__(self):
+        f = self.open()
+        try:
+            f.readline()
+            while True:
+                try:
+                    line = f.readline()
+                except (IOError, EOFError, zlib.error) as e:
+                    # A gzip trace whose recording was cut has no trailer
+                    logger.warn("Trace {} ends abruptly, reason: {}".format(self.path, repr(e)))
+                    return
+                if not line.endswith("\n"):
+                    # End of the trace, or a line cut in the middle
+                    return
+                values = [float(field) for field in line.split(",")]
+                yield values[0], values[1:len(ADC_NAMES) + 1], tuple(values[len(ADC_NAMES) + 1:])
+        finally:
+            f.close()
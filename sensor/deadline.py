@@ -0,0 +1,81 @@
+import ctypes
+import ctypes.util
+import logging
+from time import sleep
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the buckets of the period jitter histogram, in milliseconds
+JITTER_BOUNDS_MS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2 has no monotonic clock, so read CLOCK_MONOTONIC through clock_gettime(), which older C libraries only
+    # provide in librt
+    CLOCK_MONOTONIC = 1
+
+    class TimeSpec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    clock_gettime = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c"),
+                                use_errno=True).clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(TimeSpec)]
+
+    def monotonic():
+        t = TimeSpec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "clock_gettime failed")
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+
+class DeadlineScheduler(object):
+    """Start the cycles of a loop on a fixed grid of periods of a monotonic clock
+
+    The deadlines are k * period after the first cycle, so the time the cycles take and the precision of sleep() never
+    accumulate into drift, and setting the wall clock has no effect. When a cycle overruns past the next deadline, the
+    'skip' policy drops the missed deadlines and waits for the next one on the grid, while the 'compress' policy starts
+    the late cycles right away until the loop is back on schedule, up to max_backlog periods.
+    """
+
+    def __init__(self, period, policy="skip", max_backlog=10, metrics=None, clock=monotonic):
+        if policy not in ("skip", "compress"):
+            raise ValueError("Unknown overrun policy {}".format(policy))
+        self.period = period
+        self.policy = policy
+        self.max_backlog = max_backlog
+        self.metrics = metrics
+        self.clock = clock
+
+        # Deadline of the next cycle, and start of the previous one
+        self.deadline = None
+        self.last_start = None
+
+    def wait(self):
+        # Wait for the deadline of the next cycle. Returns the number of deadlines dropped because of an overrun.
+        now = self.clock()
+        skipped = 0
+        if self.deadline is None:
+            self.deadline = now
+        elif now > self.deadline:
+            late = int((now - self.deadline) / self.period)
+            if self.policy == "skip" or late > self.max_backlog:
+                skipped = late + 1 if self.policy == "skip" else late
+                self.deadline += skipped * self.period
+            if self.metrics is not None:
+                self.metrics.increment('acquisition_overruns')
+                self.metrics.increment('acquisition_skipped', skipped)
+
+        delay = self.deadline - self.clock()
+        if delay > 0:
+            sleep(delay)
+
+        start = self.clock()
+        if self.last_start is not None and self.metrics is not None:
+            # Deviation of the time between two consecutive cycles from the grid, skipped deadlines included
+            self.metrics.observe('acquisition_period_jitter_ms',
+                                 abs(start - self.last_start - (skipped + 1) * self.period) * 1000, JITTER_BOUNDS_MS)
+        self.last_start = start
+        self.deadline += self.period
+        return skipped
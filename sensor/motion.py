@@ -0,0 +1,139 @@
+import logging
+import math
+import os
+from array import array
+from threading import Lock, Thread
+
+from deadline import DeadlineScheduler
+
+logger = logging.getLogger(__name__)
+
+# Root of the sysfs interface of the onboard motion sensors
+MOTION_PATH = "/sys/class/misc/"
+
+# Onboard motion sensors, in the order of their axes in a sample
+MOTION_DEVICES = ["FreescaleAccelerometer", "FreescaleMagnetometer", "FreescaleGyroscope"]
+
+# Channels added to the history when the motion sensors are polled: spread of the acceleration (vibration), peak
+# deviation of the angular rate (rotation), and move of the mean magnetic field since the previous sample (tamper)
+MOTION_NAMES = ['Vibration', 'Rotation', 'Magnetic']
+
+
+class MotionPoller(Thread):
+    """Thread that polls the accelerometer, magnetometer and gyroscope together at a high rate
+
+    The data files of the three devices stay open, and every poll reads them from the start into a preallocated ring of
+    integers: nine axes per sample, with the poll time in a ring of its own. The sensor server calls get_summary() once
+    per round of readings to reduce the samples polled since the previous round to the MOTION_NAMES channels. The
+    summaries are based on deviations within a round, so the offsets of the sensors cancel out and no calibration is
+    needed.
+
+    The two sides run in different threads, so a lock covers the ring: the poller holds it only to store a sample it has
+    already read, and get_summary() only to copy the samples out, and the summary is computed from the copy. Without
+    it, a sample being written, or a slot overwritten by a poll that wraps around, could be summarized.
+    """
+
+    def __init__(self, rate=100, slots=4096, path=MOTION_PATH):
+        # Parent class constructor
+        Thread.__init__(self, name="Motion Poller")
+
+        self.rate = rate
+        self.slots = slots
+        self.path = path
+
+        # Ring of samples: axes [x, y, z] of each device, in MOTION_DEVICES order, and poll times
+        self.samples = array('i', [0]) * (9 * self.slots)
+        self.times = array('d', [0.0]) * self.slots
+        # Sample being polled, outside the ring; the axes of a missing device stay 0
+        self.sample = array('i', [0]) * 9
+        # Lock of the ring and of the number of samples polled
+        self.lock = Lock()
+        # Number of samples polled so far, and number of samples already summarized
+        self.count = 0
+        self.position = 0
+        # Mean magnetic field of the previous summary
+        self.last_field = None
+
+        self.fds = []
+        for device in MOTION_DEVICES:
+            try:
+                with open(os.path.join(self.path, device, "enable"), "w") as enabler:
+                    enabler.write("1")
+                self.fds.append(os.open(os.path.join(self.path, device, "data"), os.O_RDONLY))
+            except (OSError, IOError) as e:
+                logger.error("Error enabling {}, reason: {}".format(device, repr(e)))
+                self.fds.append(None)
+
+    def poll(self, now=0.0):
+        # Read the three devices once into the sample buffer, and store it into the next slot of the ring
+        sample = self.sample
+        base = 0
+        for fd in self.fds:
+            if fd is not None:
+                os.lseek(fd, 0, os.SEEK_SET)
+                x, y, z = os.read(fd, 64).split(',')
+                sample[base] = int(x)
+                sample[base + 1] = int(y)
+                sample[base + 2] = int(z)
+            base += 3
+        with self.lock:
+            slot = self.count % self.slots
+            self.samples[9 * slot:9 * slot + 9] = sample
+            self.times[slot] = now
+            self.count += 1
+
+    def run(self):
+        deadlines = DeadlineScheduler(1.0 / self.rate)
+        while True:
+            deadlines.wait()
+            try:
+                self.poll(deadlines.last_start)
+            except (OSError, ValueError) as e:
+                logger.error("Error polling motion sensors, reason: {}".format(repr(e)))
+
+    def get_summary(self):
+        """Get the MOTION_NAMES values of the samples polled since the last call, or missing values if there is none"""
+        # Copy the new samples out of the ring, in the order they were polled
+        with self.lock:
+            count = self.count
+            first = max(self.position, count - self.slots)
+            n = count - first
+            start = first % self.slots
+            if start + n <= self.slots:
+                samples = self.samples[9 * start:9 * (start + n)]
+            else:
+                samples = self.samples[9 * start:] + self.samples[:9 * (start + n - self.slots)]
+        self.position = count
+        if n == 0:
+            return [float("nan")] * len(MOTION_NAMES)
+
+        # Sums of the axes and of the acceleration magnitude, for the means
+        sums = [0.0] * 9
+        magnitudes = []
+        for base in xrange(0, 9 * n, 9):
+            for axis in xrange(0, 9):
+                sums[axis] += samples[base + axis]
+            magnitudes.append(math.sqrt(samples[base] ** 2 + samples[base + 1] ** 2 + samples[base + 2] ** 2))
+        means = [s / n for s in sums]
+
+        mean_magnitude = sum(magnitudes) / n
+        vibration = math.sqrt(sum((m - mean_magnitude) ** 2 for m in magnitudes) / n)
+
+        rotation = 0.0
+        for base in xrange(0, 9 * n, 9):
+            rotation = max(rotation, math.sqrt((samples[base + 6] - means[6]) ** 2 +
+                                               (samples[base + 7] - means[7]) ** 2 +
+                                               (samples[base + 8] - means[8]) ** 2))
+
+        field = means[3:6]
+        magnetic = 0.0 if self.last_field is None else \
+            math.sqrt(sum((field[axis] - self.last_field[axis]) ** 2 for axis in xrange(0, 3)))
+        self.last_field = field
+
+        return [vibration, rotation, magnetic]
+
+    def close(self):
+        for fd in self.fds:
+            if fd is not None:
+                os.close(fd)
+        self.fds = []
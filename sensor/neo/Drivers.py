@@ -0,0 +1,75 @@
+from os import O_RDONLY, SEEK_SET, close, listdir, lseek, read
+from os import open as os_open
+from os.path import isdir, join
+from subprocess import call
+
+# Root of the devices of the i2c bus of the onboard and snap-in sensors, and of the loaded kernel modules
+I2C_PATH = "/sys/class/i2c-dev/i2c-1/device/"
+MODULE_PATH = "/sys/module/"
+
+
+class SysfsValue:
+    """Numeric sysfs attribute that stays open and is read again from the start on every call"""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os_open(path, O_RDONLY)
+
+    def read(self):
+        lseek(self.fd, 0, SEEK_SET)
+        return float(read(self.fd, 64))
+
+    def close(self):
+        if self.fd is not None:
+            close(self.fd)
+            self.fd = None
+
+
+class DriverManager:
+    """Loads the kernel drivers of the i2c sensors and instantiates their devices, only when they are missing
+
+    Kernel modules that are already loaded, built in or not, and devices that the device tree or an earlier run already
+    instantiated, are used as they are: the check is a couple of stat() calls instead of unloading and reloading the
+    driver through a shell on every start.
+    """
+
+    def __init__(self, i2c_path=I2C_PATH, module_path=MODULE_PATH):
+        self.i2c_path = i2c_path
+        self.module_path = module_path
+        # Paths of the devices already set up, by address
+        self.devices = {}
+
+    def load_module(self, module):
+        # Load a kernel module unless it is loaded already
+        if isdir(join(self.module_path, module)):
+            return
+        if call(["modprobe", module]) != 0:
+            raise IOError("Couldn't load kernel module %s" % module)
+
+    def get_device(self, module, name, address):
+        """Get the sysfs directory of the i2c device at address, loading its driver and instantiating it if needed"""
+        path = self.devices.get(address)
+        if path is not None:
+            return path
+
+        path = join(self.i2c_path, "1-%04x" % address)
+        self.load_module(module)
+        if not isdir(path):
+            with open(join(self.i2c_path, "new_device"), "w") as new_device:
+                new_device.write("%s 0x%02x" % (name, address))
+            if not isdir(path):
+                raise IOError("Couldn't instantiate i2c device %s at 0x%02x" % (name, address))
+        self.devices[address] = path
+        return path
+
+    def get_iio_device(self, module, name, address):
+        # Get the directory of the IIO device of an i2c device, whose number depends on the order of probing
+        path = self.get_device(module, name, address)
+        for entry in sorted(listdir(path)):
+            if entry.startswith("iio:device"):
+                return join(path, entry)
+        raise IOError("No IIO device under %s" % path)
+
+
+# Shared by every sensor object, so creating one more never checks the drivers again
+drivers = DriverManager()
@@ -1,43 +1,54 @@
-from os import system, devnull
-from subprocess import call, STDOUT
+from os.path import isdir, join
 from sys import exit
 from time import sleep
 from threading import Thread
 
+from Drivers import SysfsValue, drivers
+
+
+# Root of the sysfs GPIO interface
+GPIO_PATH = "/sys/class/gpio/"
+
 
 class Gpio:
-    def __init__(self):
+    def __init__(self, path=GPIO_PATH):
+        # Root of the sysfs GPIO interface, which may be a fake tree for trying programs away from the board
+        self.path = path
         self.gpios = ["178", "179", "104", "143", "142", "141", "140", "149", "105", "148", "146", "147", "100", "102",
                       "102", "106", "106", "107", "180", "181", "172", "173", "182", "124",
                       "25", "22", "14", "15", "16", "17", "18", "19", "20", "21", "203", "202", "177", "176", "175",
                       "174", "119", "124", "127", "116", "7", "6", "5", "4"]
-        self.gpioval = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
-                        0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-        self.gpiodir = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
-                        0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-        self.current = 0
+        # Value and direction of each pin, read when the pin is first used
+        self.gpioval = [0] * len(self.gpios)
+        self.gpiodir = [0] * len(self.gpios)
+        # Pins are exported on first use rather than all at once, so that only the pins a program uses are touched
+        self.exported = set()
         self.OUTPUT = 1
         self.INPUT = 0
         self.HIGH = 1
         self.LOW = 0
-        for num in self.gpios:
-            try:
-                with open("/sys/class/gpio/export", "w") as create:
-                    create.write(num)
-                with open("/sys/class/gpio/gpio" + self.gpios[current] + "/value", "r") as reads:
-                    self.gpioval[self.current] = reads.read()
-                with open("/sys/class/gpio/gpio" + self.gpios[current] + "/direction", "r") as readdir:
-                    self.gpiodir[self.current] = (1 if "out" in readdir.read() else 0)
-                self.current += 1
-            except:
-                sleep(0.000001)
         print "Neo gpios started, make sure arduino isn't using the same pins or you can ruin this board!"
 
+    def export(self, pin):
+        # Export a pin unless the kernel already did, and read its current value and direction
+        gpio = self.gpios[pin]
+        if not isdir(self.path + "gpio" + gpio):
+            with open(self.path + "export", "w") as create:
+                create.write(gpio)
+        with open(self.path + "gpio" + gpio + "/value", "r") as reads:
+            self.gpioval[pin] = int(reads.read())
+        with open(self.path + "gpio" + gpio + "/direction", "r") as readdir:
+            self.gpiodir[pin] = (1 if "out" in readdir.read() else 0)
+        self.exported.add(pin)
+
     def pinMode(self, pin=2, direction=0):
         try:
-            gpio = self.gpios[int(pin)]
+            pin = int(pin)
+            if pin not in self.exported:
+                self.export(pin)
+            gpio = self.gpios[pin]
             if int(direction) != self.gpiodir[pin]:
-                with open("/sys/class/gpio/gpio" + gpio + "/direction", "w") as writer:
+                with open(self.path + "gpio" + gpio + "/direction", "w") as writer:
                     writer.write("in" if direction < 1 else "out")
                 self.gpiodir[pin] = (0 if direction < 1 else 1)
             return True
@@ -83,13 +94,17 @@ class Gpio:
 
     def digitalWrite(self, pin=2, value=0):
         try:
-            gpio = self.gpios[int(pin)]
+            pin = int(pin)
+            value = int(value)
+            if pin not in self.exported:
+                self.export(pin)
+            gpio = self.gpios[pin]
             if self.gpiodir[pin] != 1:
-                with open("/sys/class/gpio/gpio" + gpio + "/direction", "w") as re:
+                with open(self.path + "gpio" + gpio + "/direction", "w") as re:
                     re.write("out")
                 self.gpiodir[pin] = 1
-            if self.gpioval[pin] != int(value):
-                with open("/sys/class/gpio/gpio" + gpio + "/value", "w") as writes:
+            if self.gpioval[pin] != value:
+                with open(self.path + "gpio" + gpio + "/value", "w") as writes:
                     writes.write("0" if value < 1 else "1")
                 self.gpioval[pin] = (0 if value < 1 else 1)
             return True
@@ -102,12 +117,15 @@ class Gpio:
 
     def digitalRead(self, pin=2):
         try:
-            gpio = self.gpios[int(pin)]
+            pin = int(pin)
+            if pin not in self.exported:
+                self.export(pin)
+            gpio = self.gpios[pin]
             if self.gpiodir[pin] != 0:
-                with open("/sys/class/gpio/gpio" + gpio + "/direction", "w") as re:
+                with open(self.path + "gpio" + gpio + "/direction", "w") as re:
                     re.write("in")
                 self.gpiodir[pin] = 0
-            with open("/sys/class/gpio/gpio" + gpio + "/value", "r") as reader:
+            with open(self.path + "gpio" + gpio + "/value", "r") as reader:
                 self.gpioval[pin] = int(reader.read().replace('\n', ''))
             return self.gpioval[pin]
         except ValueError:
@@ -153,68 +171,58 @@ class Led:
 
 
 class Temp:
-    def __init__(self):  # Start temp module on object call
+    def __init__(self, manager=drivers):  # Set up the temp module on object call, unless it is already
         self.temp = 0000
-        NULLS = open(devnull, 'w')
-        try:
-            call(["rmmod", "lm75"], stdout=NULLS, stderr=STDOUT)  # Reset module
-        finally:
-            sleep(0.0001)  # wait for script update
-        try:
-            call(["modprobe", "lm75"], stdout=NULLS, stderr=STDOUT)
-        finally:
-            sleep(0.0001)  # again script update
+        self.reader = None
         try:
-            system(
-                "sh -c 'echo lm75 0x48 >/sys/class/i2c-dev/i2c-1/device/new_device' 2&>/dev/null")  # easier to run command to black hole using system
-        finally:
-            sleep(0.001)  # longer script wait
+            path = manager.get_device("lm75", "lm75", 0x48)
+            self.reader = SysfsValue(join(path, "temp1_input"))  # Kept open, read once per call
+        except (IOError, OSError, ValueError):
+            print "Snap in sensor is not plugged in!"
 
     def getTemp(self, mode="f"):  # Return with mode
         try:
-            with open("/sys/class/i2c-dev/i2c-1/device/1-0048/temp1_input", "r") as reader:  # Read i2c millicel file
-                self.temp = (float(reader.read().replace(' ', '').replace('\n', ''))) * (0.001)  # Turn into celcius
-        except:
+            self.temp = self.reader.read() * (0.001)  # Millicel file, turn into celcius
+        except (AttributeError, IOError, OSError, ValueError):
             print "Snap in sensor is not plugged in!"
         finally:
             return ((self.temp) * 1.8 + 32) if "f" in mode else (self.temp)  # Either return into Far or Celc
 
 
 class Barometer:
-    def __init__(self):
+    def __init__(self, manager=drivers):
         self.temp = 0000
         self.Tempscale = 0000
         self.pressure = 0000
         self.Tempress = 000
-        NULLS = open(devnull, 'w')
-        try:
-            call(["rmmod", "mpl3115"], stdout=NULLS, stderr=STDOUT)  # Reset module
-        finally:
-            sleep(0.0001)  # wait for script update
+        self.treader = None
+        self.preader = None
         try:
-            call(["modprobe", "mpl3115"], stdout=NULLS, stderr=STDOUT)
-        finally:
-            sleep(0.0001)  # again script update
+            path = manager.get_iio_device("mpl3115", "mpl3115", 0x60)
+            # The scales never change, only the raw values are read on every call
+            self.treader = SysfsValue(join(path, "in_temp_raw"))
+            self.preader = SysfsValue(join(path, "in_pressure_raw"))
+            scale = SysfsValue(join(path, "in_temp_scale"))
+            self.Tempscale = scale.read()
+            scale.close()
+            scale = SysfsValue(join(path, "in_pressure_scale"))
+            self.Tempress = scale.read()
+            scale.close()
+        except (IOError, OSError, ValueError):
+            print "Barometer is not plugged in!"
 
     def getTemp(self, mode="f"):  # Return from Barometer
         try:
-            with open("/sys/class/i2c-dev/i2c-1/device/1-0060/iio:device0/in_temp_raw", "r") as treader:
-                self.temp = (float(treader.read().replace('\n', '')))
-            with open("/sys/class/i2c-dev/i2c-1/device/1-0060/iio:device0/in_temp_scale", "r") as tsreader:
-                self.Tempscale = (float(tsreader.read().replace('\n', '')))
-            self.temp = ((self.temp) * (self.Tempscale))
-        except:
+            self.temp = self.treader.read() * self.Tempscale
+        except (AttributeError, IOError, OSError, ValueError):
             print "Barometer is not plugged in!"
         finally:
             return ((self.temp) * 1.8 + 32) if "f" in mode else (self.temp)
 
     def getPressure(self):  # Return raw data which is (kPA) a form of pressure measurments sea level is about 100
         try:
-            with open("/sys/class/i2c-dev/i2c-1/device/1-0060/iio:device0/in_pressure_raw", "r") as preader:
-                self.pressure = (float(preader.read().replace('\n', '')))
-            with open("/sys/class/i2c-dev/i2c-1/device/1-0060/iio:device0/in_pressure_scale", "r") as psreader:
-                self.Tempress = (float(psreader.read().replace('\n', '')))
-        except:
+            self.pressure = self.preader.read()
+        except (AttributeError, IOError, OSError, ValueError):
             print "Barometer is not plugged in!"
         finally:
             return float((self.pressure) * (self.Tempress))
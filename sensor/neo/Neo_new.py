@@ -1,22 +1,52 @@
 from os import geteuid
+from os.path import isdir, join
 from time import sleep
 
+from Drivers import SysfsValue, drivers
 from Maps import Maps
-from Resources import MemoryMap, Command
-
-if geteuid() != 0:
-    print "Please run script as root! (If you are sudo it must be root\nLike this sudo su -c '<command>'"
-    exit(1)
+from Resources import MemoryMap, ResourceError
 
+# Importing this module has no side effects: pins are exported, and their files mapped, the first time they are used
 maps = Maps()
-init_gpio = True
-init_pwm = False
-export_gpio = open(maps.gpio_export, "w")
-export_pwm = open(maps.pwm_export, "w")
 io_maps = [[None, None]] * (len(maps.gpios) + 1)
 io_maps_pwm = [[None, None, None]] * (len(maps.pwms) + 1)
 
 
+def check_root():
+    # Exporting pins needs root privileges
+    if geteuid() != 0:
+        raise ResourceError("Please run script as root! (If you are sudo it must be root\nLike this sudo su -c "
+                            "'<command>'")
+
+
+def get_gpio(pin):
+    # Get the [value, direction] maps of a pin, exporting it unless the kernel already did
+    if io_maps[pin][0] is None:
+        check_root()
+        cur_path = maps.get_gpio_path(pin)
+        if not isdir(cur_path):
+            with open(maps.gpio_export, "w") as export_gpio:
+                export_gpio.write(maps.gpios[pin])
+        io_maps[pin] = [MemoryMap(cur_path + "value"),
+                        MemoryMap(cur_path + "direction")]
+    return io_maps[pin]
+
+
+def get_pwm(pin, period):
+    # Get the [period, duty cycle, enable] maps of a PWM output, exporting it unless the kernel already did
+    if io_maps_pwm[pin][0] is None:
+        check_root()
+        cur_path = maps.get_pwm_path(pin)
+        if not isdir(cur_path):
+            with open(maps.pwm_export, "w") as export_pwm:
+                export_pwm.write(maps.pwms[pin])
+        io_maps_pwm[pin] = [MemoryMap(cur_path + "period"),
+                            MemoryMap(cur_path + "duty_cycle"),
+                            MemoryMap(cur_path + "enable")]
+        io_maps_pwm[pin][0].write_line(str(period))
+    return io_maps_pwm[pin]
+
+
 def re_map(value, omin, omax, nmin, nmax):
     return ((value - omin) /
             (omax - omin)) * (nmax - nmin) + nmin
@@ -24,52 +54,41 @@ def re_map(value, omin, omax, nmin, nmax):
 
 class Gpio:
     def __init__(self, reset=False):
-        if init_gpio or reset:
+        # Pins are exported on first use. A reset releases the mapped ones so that they are mapped again.
+        if reset:
             for pin in range(0, len(maps.gpios)):
-                try:
-                    cur_path = maps.get_gpio_path(pin)
-                    raw_pin = maps.gpios[pin]
-                    # self.export.resize(len(raw_pin))
-                    export_gpio.write(raw_pin)
-                    export_gpio.flush()
-                    io_maps[pin] = [MemoryMap(cur_path + "value"),
-                                    MemoryMap(cur_path + "direction")]
-                except (OSError, ValueError, IndexError, IOError, TypeError):
-                    try:
-                        io_maps[pin][0].close()
-                        io_maps[pin][1].close()
-                    except (TypeError, AttributeError):
-                        pass
-            export_gpio.close()
+                if io_maps[pin][0] is not None:
+                    Gpio.release(pin)
 
     @staticmethod
     def pin_mode(pin, direction=0):
         try:
-            io_maps[pin][1].write_line("in" if direction < 1 else "out")
-        except (ValueError, IndexError, TypeError), e:
+            get_gpio(pin)[1].write_line("in" if direction < 1 else "out")
+        except (ValueError, IndexError, TypeError, IOError), e:
             print e
             raise ValueError("Current distribute %d" % pin)
 
     @staticmethod
     def digital_write(pin, value=0):
         try:
-            io_maps[pin][0].write_digit(int(value > 0))
-        except (ValueError, IndexError, TypeError):
+            get_gpio(pin)[0].write_digit(int(value > 0))
+        except (ValueError, IndexError, TypeError, IOError):
             raise ValueError("Couldn't write %s to pin %s" % (str(value), str(pin)))
 
     @staticmethod
     def digital_read(pin):
         try:
-            return io_maps[pin][0].read_digit(pin)
-        except (ValueError, IndexError, TypeError):
+            return get_gpio(pin)[0].read_digit()
+        except (ValueError, IndexError, TypeError, IOError):
             raise ValueError("Couldn't read state from pin %s" % str(pin))
 
     @staticmethod
     def release(pin):
         try:
-            io_maps[pin][0].close(pin)
-            io_maps[pin][1].close(pin)
-        except (ValueError, IndexError, TypeError):
+            io_maps[pin][0].close()
+            io_maps[pin][1].close()
+            io_maps[pin] = [None, None]
+        except (ValueError, IndexError, TypeError, AttributeError):
             raise ValueError("Couldn't release pin %s (Maybe already released)" % str(pin))
 
 
@@ -98,39 +117,24 @@ class PWM:
     def __init__(self):
         self.period = 2040816  # Arduino default: 490Hz
         self.duty_cycle = 50  # Default
-
-        for pin in range(0, len(maps.pwms)):
-            try:
-                cur_path = maps.get_pwm_path(pin)
-                raw_pin = maps.pwms[pin]
-                export_pwm.write(raw_pin)
-                export_pwm.flush()
-                io_maps_pwm[pin] = [MemoryMap(cur_path + "period"),
-                                    MemoryMap(cur_path + "duty_cycle"),
-                                    MemoryMap(cur_path + "enable")]
-                io_maps_pwm[pin][0].write_line(str(self.period))
-            except (OSError, ValueError, IndexError, IOError, TypeError):
-                try:
-                    io_maps_pwm[pin][0].close()
-                    io_maps[pin][1].close()
-                except (TypeError, AttributeError):
-                    pass
-        export_pwm.close()
+        # PWM outputs are exported on first use
 
     def set_period(self, pin=-1, frequency=2040816):
         self.period = frequency
         if pin != -1:
-            io_maps_pwm[pin][0].write_line(str(self.period))
+            get_pwm(pin, self.period)[0].write_line(str(self.period))
         else:
-            for pins in range(0, maps.pwms):
-                io_maps_pwm[pins][0].write_line(str(self.period))
+            # Only the outputs in use have a period to update, the others get the new one when they are exported
+            for pins in range(0, len(maps.pwms)):
+                if io_maps_pwm[pins][0] is not None:
+                    io_maps_pwm[pins][0].write_line(str(self.period))
 
     def pwm_write(self, pin, duty_cycle=50):
         min_val = int(0.1 * self.period)
         if duty_cycle == 0:
-            io_maps_pwm[pin][1].write_digit(0)
+            get_pwm(pin, self.period)[1].write_digit(0)
         else:
-            io_maps_pwm[pin][1].write_digit(1)
+            get_pwm(pin, self.period)[1].write_digit(1)
             new_val = re_map(duty_cycle, 0, 255, min_val, self.period)
             io_maps_pwm[pin][1].write_line(str(new_val))
 
@@ -141,10 +145,11 @@ class PWM:
     @staticmethod
     def release(pin):
         try:
-            io_maps_pwm[pin][0].close(pin)
-            io_maps_pwm[pin][1].close(pin)
-            io_maps_pwm[pin][2].close(pin)
-        except (ValueError, IndexError, TypeError):
+            io_maps_pwm[pin][0].close()
+            io_maps_pwm[pin][1].close()
+            io_maps_pwm[pin][2].close()
+            io_maps_pwm[pin] = [None, None, None]
+        except (ValueError, IndexError, TypeError, AttributeError):
             raise ValueError("Couldn't release pin %s (Maybe already released)" % str(pin))
 
 
@@ -195,28 +200,14 @@ class Led:
 
 
 class Temp:
-    def __init__(self):  # Start temp module on object call
+    def __init__(self):  # Set up the temp module on object call, unless it is already
         self.temp = 0000
-        self.coms = Command()
-        try:
-            self.coms.run("rmmod lm75")
-        finally:
-            pass
-        try:
-            self.coms.run("modprobe lm75")
-        finally:
-            pass
-        try:
-            self.coms.run("sh -c 'echo lm75 0x48 >/sys/class/i2c-dev/i2c-1/device/new_device' 2&>1")
-            # easier to run command to black hole using system
-        finally:
-            pass
-        self.mm_temp = MemoryMap("/sys/class/i2c-dev/i2c-1/device/1-0048/temp1_input", "r")
+        path = drivers.get_device("lm75", "lm75", 0x48)
+        self.mm_temp = SysfsValue(join(path, "temp1_input"))
 
     def get_temp(self, mode="f"):  # Return with mode
         try:
-            self.temp = (float(self.mm_temp.read_line().replace(' ', '').replace('\n', ''))) * (
-                0.001)  # Turn into celcius
+            self.temp = self.mm_temp.read() * 0.001  # Turn into celcius
         except (OSError, IndexError, IOError, ValueError):
             print "Snap in sensor is not plugged in!"
         finally:
@@ -229,27 +220,19 @@ class Barometer:
         self.Tempscale = 0000
         self.pressure = 0000
         self.Tempress = 000
-        self.coms = Command()
 
-        try:
-            self.coms.run("rmmod mpl3115")
-        finally:
-            pass
-        try:
-            self.coms.run("modprobe mpl3115")
-        finally:
-            pass
-        base = "/sys/class/i2c-dev/i2c-1/device/1-0060/iio:device0/"
-        self.mm_temp = MemoryMap(base + "in_temp_raw", "r")
-        self.mm_scale = MemoryMap(base + "in_temp_scale", "r")
-        self.mm_pressure = MemoryMap(base + "in_pressure_raw", "r")
-        self.mm_pressure_scale = MemoryMap(base + "in_pressure_scale", "r")
+        base = drivers.get_iio_device("mpl3115", "mpl3115", 0x60)
+        self.mm_temp = SysfsValue(join(base, "in_temp_raw"))
+        self.mm_scale = SysfsValue(join(base, "in_temp_scale"))
+        self.mm_pressure = SysfsValue(join(base, "in_pressure_raw"))
+        self.mm_pressure_scale = SysfsValue(join(base, "in_pressure_scale"))
+        # The scales never change, only the raw values are read on every call
+        self.Tempscale = self.mm_scale.read()
+        self.Tempress = self.mm_pressure_scale.read()
 
     def get_temp(self, mode="f"):  # Return from Barometer
         try:
-            self.temp = (float(self.mm_temp.read_line().replace('\n', '')))
-            self.Tempscale = (float(self.mm_scale.read_line().replace('\n', '')))
-            self.temp = (self.temp * self.Tempscale)
+            self.temp = self.mm_temp.read() * self.Tempscale
         except (IndexError, ValueError, IOError, TypeError, OSError):
             print "Barometer is not plugged in!"
         finally:
@@ -257,8 +240,7 @@ class Barometer:
 
     def get_pressure(self):  # Return raw data which is (kPA) a form of pressure measurments sea level is about 100
         try:
-            self.pressure = (float(self.mm_pressure.read_line().replace('\n', '')))
-            self.Tempress = (float(self.mm_pressure_scale.read_line().replace('\n', '')))
+            self.pressure = self.mm_pressure.read()
         except (IndexError, ValueError, IOError, TypeError, OSError):
             print "Barometer is not plugged in!"
         finally:
@@ -434,9 +416,11 @@ class Gyro:
             raise ValueError("Couldn't release Magnometer" % str(pin))
 
 
-led = Gpio()
-while True:
-    led.pin_mode(2, 1)
-    sleep(1)
-    led.pin_mode(2, 0)
-    sleep(1)
+if __name__ == '__main__':
+    # Blink pin 2
+    led = Gpio()
+    while True:
+        led.pin_mode(2, 1)
+        sleep(1)
+        led.pin_mode(2, 0)
+        sleep(1)
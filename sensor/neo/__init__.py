@@ -5,6 +5,8 @@ Neo
 
 GNU public license v2.0
 '''
+from Drivers import DriverManager, drivers
+from Neo import GPIO_PATH
 from Neo import Gpio
 from Neo import easyGpio
 from Neo import Temp
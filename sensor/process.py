@@ -0,0 +1,83 @@
+import logging
+from multiprocessing import Process
+
+from history import open_storage
+from ring import SampleRing
+from Sensor import SensorServer, get_channel_names
+
+logger = logging.getLogger(__name__)
+
+
+class SensorProcess(Process):
+    """Sensor server running in a process of its own, so that serving clients never delays acquisition
+
+    The child process runs a SensorServer that publishes every committed sample into a shared-memory SampleRing. The
+    serving process reads the ring through the same get_sensor_output() and get_last_commit_time() methods as those of
+    a SensorServer, and collects the samples committed since its last call with get_new_rows().
+    """
+
+    def __init__(self, database_name="air_pollution_data.db", storage_engine="sqlite", ring_slots=1024, resolution=1,
+                 period=2.4, settle_time=0.05, overrun_policy="skip", motion_rate=0, onboard=False, channel_map=None,
+                 trace_path=None):
+        # Parent class constructor
+        Process.__init__(self, name="Sensor Process")
+
+        self.database_name = database_name
+        self.storage_engine = storage_engine
+        self.sensor_names = get_channel_names(motion_rate > 0, onboard)
+        self.resolution = resolution
+        self.period = period
+        self.settle_time = settle_time
+        self.overrun_policy = overrun_policy
+        self.motion_rate = motion_rate
+        self.onboard = onboard
+        self.channel_map = channel_map
+        self.trace_path = trace_path
+
+        try:
+            # Create the database and its 'history' table before the serving process opens it for reading
+            open_storage(self.storage_engine, self.database_name, self.sensor_names, writable=True,
+                         resolution=self.resolution).close()
+        except Exception as e:
+            logger.error("Error connecting the database {}, reason: {}".format(self.database_name, repr(e)))
+
+        # The ring is created before the child process is forked, so both map the same memory
+        self.ring = SampleRing(len(self.sensor_names), slots=ring_slots)
+        # Number of samples of the ring already returned by get_new_rows()
+        self.position = 0
+
+    def run(self):
+        # Acquire in the main thread of the child process. The block summaries are maintained by the serving process,
+        # from the samples of the ring.
+        SensorServer(database_name=self.database_name, storage_engine=self.storage_engine, ring=self.ring,
+                     resolution=self.resolution, period=self.period, settle_time=self.settle_time,
+                     overrun_policy=self.overrun_policy, motion_rate=self.motion_rate,
+                     onboard=self.onboard, channel_map=self.channel_map, trace_path=self.trace_path).run()
+
+    def get_sensor_output(self):
+        # Get the latest sensor output, in the format of SensorServer.get_sensor_output()
+        row = self.ring.get_latest()
+        if row is None:
+            return {}
+        sensor_output = dict(zip(self.sensor_names, row[1:]))
+        sensor_output['time'] = row[0]
+        return sensor_output
+
+    def get_last_commit_time(self):
+        # Get the time stamp of the newest sample committed to the database
+        row = self.ring.get_latest()
+        return -1 if row is None else row[0]
+
+    def get_new_rows(self):
+        """Get the rows committed since the last call, and whether none of them has been overwritten in the meantime"""
+        count = self.ring.get_count()
+        complete = count - self.position <= self.ring.slots
+        rows = []
+        for i in xrange(max(self.position, count - self.ring.slots), count):
+            row = self.ring.read(i)
+            if row is None:
+                complete = False
+            else:
+                rows.append(row)
+        self.position = count
+        return rows, complete
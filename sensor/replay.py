@@ -0,0 +1,235 @@
+import argparse
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import zlib
+from time import sleep, time
+
+from adctrace import TraceSource
+from aqi import AqiEngine
+from deadline import monotonic
+from history import BlockSummaries, HourlySketches, open_storage
+from history.bulk import get_value_columns
+from metrics import Metrics
+from realtime import FrameCache
+from Sensor import SENSOR_NAMES, SensorServer
+
+logger = logging.getLogger(__name__)
+
+
+class HistorySource(object):
+    """Rows of an existing history storage, as (time in seconds, None, calibrated values), for replaying them"""
+
+    # The rows are already calibrated, so they are stored as they are
+    calibrated = True
+
+    def __init__(self, engine, database_name, start_time=0, end_time=2 ** 62):
+        self.engine = engine
+        self.database_name = database_name
+        self.start_time = start_time
+        self.end_time = end_time
+        self.value_columns = get_value_columns(engine, database_name)
+
+    def __iter__(self):
+        storage = open_storage(self.engine, self.database_name, self.value_columns)
+        try:
+            resolution = float(storage.resolution)
+            for row in storage.query(self.start_time, self.end_time):
+                yield row[0] / resolution, None, tuple(row[1:])
+        finally:
+            storage.close()
+
+
+def open_source(path, engine="sqlite"):
+    """Get the source of a replay: a trace of ADC readings if path is a .csv or .csv.gz file, else a history storage"""
+    if path.endswith(".csv") or path.endswith(".csv.gz"):
+        return TraceSource(path)
+    return HistorySource(engine, path)
+
+
+def get_source_columns(source):
+    # Channels of the history rows of a replay: those of the history it replays, or the sensors and the extra channels
+    # of the trace
+    if source.calibrated:
+        return list(source.value_columns)
+    return SENSOR_NAMES + source.extra_names
+
+
+class ReplayClock(object):
+    """Pace of a replay: samples are released speed times faster than they were recorded, or right away if speed is 0
+
+    The pace follows a monotonic clock from the first sample, so the time the pipeline takes never accumulates into
+    drift; a replay that falls behind catches up without sleeping.
+    """
+
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self.start = None
+        self.first_time = None
+
+    def wait(self, t):
+        # Wait until the sample recorded at t seconds is due
+        if self.speed <= 0:
+            return
+        now = monotonic()
+        if self.start is None:
+            self.start = now
+            self.first_time = t
+            return
+        delay = self.start + (t - self.first_time) / self.speed - now
+        if delay > 0:
+            sleep(delay)
+
+
+class ReplayServer(SensorServer):
+    """Sensor server that replays a recorded trace of ADC readings, or the rows of a history storage, instead of reading
+    the sensors
+
+    The samples go through the same calibration, storage, analytics and publishing as those of the sensors, with the
+    time stamps they were recorded with, so they should be replayed into a database of their own: samples that are not
+    newer than the last stored one are dropped. The server stops once the source runs out.
+    """
+
+    def __init__(self, source, speed=1.0, database_name="replay.db", storage_engine="sqlite", block_summaries=None,
+                 ring=None, resolution=1, metrics=None, aqi_engine=None, sketches=None):
+        self.source = source
+        self.clock = ReplayClock(speed)
+        self.metrics = metrics
+        SensorServer.__init__(self, database_name=database_name, storage_engine=storage_engine,
+                              block_summaries=block_summaries, ring=ring, resolution=resolution, metrics=metrics,
+                              aqi_engine=aqi_engine, sketches=sketches)
+        self.name = "Replay Server"
+        # Committing every sample would take most of the time of a replay as fast as possible
+        if speed <= 0:
+            self.commit_rows = 1000
+        # Number of samples replayed, and the time the replay took
+        self.count = 0
+        self.elapsed = None
+
+    def get_sensor_names(self, motion_rate, onboard):
+        return get_source_columns(self.source)
+
+    def setup_hardware(self, motion_rate, onboard, channel_map):
+        # There is nothing to set up
+        self.gpio = None
+        self.motion_poller = None
+        self.board_temp = None
+        self.barometer = None
+        self.adc = None
+
+    def start_acquisition(self):
+        self.samples = iter(self.source)
+        self.start = time()
+
+    def acquire(self):
+        try:
+            t, channels, extras = next(self.samples)
+        except StopIteration:
+            self.elapsed = time() - self.start
+            rate = self.count / self.elapsed if self.elapsed > 0 else float("inf")
+            logger.info("Replayed {} samples in {:.2f} s, {:.0f} samples/s".format(self.count, self.elapsed, rate))
+            print "INFO: Replayed {} samples in {:.2f} s, {:.0f} samples/s".format(self.count, self.elapsed, rate)
+            return None
+        self.clock.wait(t)
+        self.count += 1
+        if self.metrics is not None:
+            self.metrics.increment('replay_samples')
+        return int(round(t * self.resolution)), channels, extras
+
+    def get_row(self, epoch_time, channels, extras):
+        if self.source.calibrated:
+            return (epoch_time,) + tuple(extras)
+        return SensorServer.get_row(self, epoch_time, channels, extras)
+
+
+class FramePublisher(object):
+    # Stand-in for the broadcast of the main loop: encodes the real-time frame of every stored sample, in place of the
+    # ring a SensorServer publishes to
+    def __init__(self, sensor_names, aqi_engine, resolution):
+        self.sensor_names = sensor_names
+        self.aqi_engine = aqi_engine
+        self.resolution = resolution
+        self.frames = 0
+        self.crc = 0
+
+    def publish(self, row):
+        sensor_output = dict(zip(self.sensor_names, row[1:]))
+        sample = {'time': row[0],
+                  'temp': sensor_output.get('Temp', -1),
+                  'SN1': sensor_output.get('NO2', -1),
+                  'SN2': sensor_output.get('OX', -1),
+                  'SN3': sensor_output.get('CO', -1),
+                  'SN4': sensor_output.get('SO2', -1),
+                  'PM25': sensor_output.get('PM25', -1)}
+        aqi = self.aqi_engine.snapshot()
+        sample['AQI'] = -1 if aqi['aqi'] is None else aqi['aqi']
+        frame = FrameCache(sample, resolution=self.resolution).get("csv")
+        self.frames += 1
+        self.crc = zlib.crc32(frame, self.crc)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay a trace of ADC readings or a history database through the "
+                                                 "calibration, storage, analytics and frame encoding, without the "
+                                                 "sensors and the Bluetooth server")
+    parser.add_argument("source", help="specify trace (.csv or .csv.gz) or history database to replay")
+    parser.add_argument("--storage", dest="storage_engine", default="sqlite",
+                        help="set storage engine of the replayed database, and of the one written: sqlite, segment")
+    parser.add_argument("--speed", dest="speed", type=float, default=0,
+                        help="specify how many times faster than recorded to replay; 0 replays as fast as possible")
+    parser.add_argument("--database", dest="database_name", default="",
+                        help="specify database the replay is written to; a temporary one is removed afterwards")
+    parser.add_argument("--timestamps", dest="timestamps", default="s",
+                        help="set time resolution of the database written: s, ms")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARN)
+
+    try:
+        source = open_source(args.source, args.storage_engine)
+    except (IOError, ValueError, sqlite3.Error) as e:
+        print "ERROR: {}".format(e)
+        sys.exit(1)
+
+    directory = None
+    database_name = args.database_name
+    if not database_name:
+        directory = tempfile.mkdtemp(prefix="replay-")
+        database_name = os.path.join(directory, "replay.db")
+    try:
+        resolution = 1000 if args.timestamps == "ms" else 1
+        metrics = Metrics()
+        server = ReplayServer(source, speed=args.speed, database_name=database_name,
+                              storage_engine=args.storage_engine, resolution=resolution, metrics=metrics)
+        resolution = server.resolution
+        aqi_engine = AqiEngine(server.sensor_names, resolution)
+        server.aqi_engine = aqi_engine
+        server.block_summaries = BlockSummaries(database_name.rstrip("/") + ".blocks", block_seconds=3600 * resolution,
+                                                resolution=resolution, metrics=metrics)
+        server.sketches = HourlySketches(database_name.rstrip("/") + ".sketches", server.sensor_names,
+                                         block_seconds=3600 * resolution, metrics=metrics)
+        publisher = FramePublisher(server.sensor_names, aqi_engine, resolution)
+        server.ring = publisher
+
+        # Run in this thread, so that the run ends with the replay
+        server.run()
+
+        # CRC of the stored rows, which is the same for every replay of the same source
+        storage = open_storage(args.storage_engine, database_name, server.sensor_names)
+        crc = 0
+        rows = 0
+        for row in storage.query(0, 2 ** 62):
+            crc = zlib.crc32(repr(row), crc)
+            rows += 1
+        storage.close()
+        print "Rows stored: {}, CRC {:08x}; frames encoded: {}, CRC {:08x}"\
+            .format(rows, crc & 0xffffffff, publisher.frames, publisher.crc & 0xffffffff)
+        aqi = aqi_engine.snapshot()
+        print "AQI at the end of the replay: {}, dominant pollutant {}".format(aqi['aqi'], aqi['dominant'])
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
@@ -0,0 +1,111 @@
+import logging
+import mmap
+import struct
+from multiprocessing import Lock, cpu_count
+
+logger = logging.getLogger(__name__)
+
+# Ring header: magic, number of slots, slot size, number of samples published so far
+RING_HEADER = struct.Struct("<4sII4xQ")
+RING_MAGIC = "APSR"
+
+
+class SampleRing(object):
+    """Ring buffer of samples in shared memory, written by one process and read by any number of others
+
+    Every slot holds a sequence number followed by a fixed-width sample: the epoch time and one double per channel.
+    Writes are protected seqlock-style: the writer of the i-th sample sets the sequence number of its slot to 2i + 1,
+    writes the sample, then sets it to 2i + 2 and publishes the new sample count in the header. A reader unpacks the
+    sample straight from the shared mapping and only keeps it if the sequence number was 2i + 2 both before and after,
+    so it never blocks the writer and never sees a torn or overwritten sample.
+
+    The seqlock alone relies on the stores of the writer being seen by the readers in program order, which only holds
+    on a single core, such as the Cortex-A9 of the UDOO Neo: nothing in Python puts a memory barrier between the
+    writes to the mapping, and the ARM cores of a multi-core board may make them visible in another order. On a machine
+    with more cores, the writer and the readers also take a process-shared lock, whose operations are full memory
+    barriers; a reader then blocks the writer for the time of one copy at most.
+
+    The ring lives in an anonymous shared mapping inherited by the processes forked after it is created, or in a file,
+    for example under /dev/shm, that other processes can map as well. The lock is inherited the same way, so a ring in
+    a file is only safe to read from other processes on a single core.
+    """
+
+    def __init__(self, n_channels, slots=1024, path=None, locked=None):
+        self.record = struct.Struct("<q{}d".format(n_channels))
+        self.sequence = struct.Struct("<Q")
+        self.slot_size = self.sequence.size + self.record.size
+        self.slots = slots
+        size = RING_HEADER.size + self.slots * self.slot_size
+
+        if path is None:
+            self.map = mmap.mmap(-1, size)
+        else:
+            with open(path, "a+b") as f:
+                f.truncate(size)
+                self.map = mmap.mmap(f.fileno(), size)
+        RING_HEADER.pack_into(self.map, 0, RING_MAGIC, self.slots, self.slot_size, 0)
+
+        # Lock of the writer and the readers, on machines with more than one core unless locked says otherwise
+        if locked is None:
+            locked = cpu_count() > 1
+        self.lock = Lock() if locked else None
+        if self.lock is not None and path is not None:
+            logger.warn("Sample ring {} is locked, processes that map it without inheriting the ring may see torn "
+                        "samples".format(path))
+
+    def get_count(self):
+        # Get the number of samples published so far
+        return RING_HEADER.unpack_from(self.map, 0)[3]
+
+    def publish(self, row):
+        # Publish a sample (time, value 1, ..., value n); only one process may publish
+        if self.lock is None:
+            self.write(row)
+        else:
+            with self.lock:
+                self.write(row)
+
+    def write(self, row):
+        count = self.get_count()
+        offset = RING_HEADER.size + (count % self.slots) * self.slot_size
+        self.sequence.pack_into(self.map, offset, 2 * count + 1)
+        self.record.pack_into(self.map, offset + self.sequence.size, *row)
+        self.sequence.pack_into(self.map, offset, 2 * count + 2)
+        RING_HEADER.pack_into(self.map, 0, RING_MAGIC, self.slots, self.slot_size, count + 1)
+
+    def read(self, i, retries=100):
+        # Get the i-th sample published, or None if it has been overwritten already
+        if self.lock is None:
+            return self.read_slot(i, retries)
+        with self.lock:
+            return self.read_slot(i, retries)
+
+    def read_slot(self, i, retries):
+        offset = RING_HEADER.size + (i % self.slots) * self.slot_size
+        expected = 2 * i + 2
+        for _ in xrange(0, retries):
+            before = self.sequence.unpack_from(self.map, offset)[0]
+            if before == expected - 1:
+                # Being written right now, try again
+                continue
+            if before != expected:
+                return None
+            row = self.record.unpack_from(self.map, offset + self.sequence.size)
+            if self.sequence.unpack_from(self.map, offset)[0] == expected:
+                return row
+        return None
+
+    def get_latest(self, retries=100):
+        # Get the newest sample, or None if nothing has been published yet
+        for _ in xrange(0, retries):
+            count = self.get_count()
+            if count == 0:
+                return None
+            row = self.read(count - 1)
+            if row is not None:
+                return row
+            # Overwritten while reading, the writer is far ahead; read the new newest sample
+        return None
+
+    def close(self):
+        self.map.close()
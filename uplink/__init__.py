@@ -0,0 +1 @@
+from uplink import Uplink, UplinkCursor
@@ -0,0 +1,78 @@
+import argparse
+import gzip
+import logging
+import random
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from cStringIO import StringIO
+
+logger = logging.getLogger(__name__)
+
+
+class UplinkReceiver(HTTPServer):
+    """Stand-in for the central endpoint, for trying the uplink on a workstation
+
+    It stores the rows of every batch it acknowledges in a CSV file, drops batches it has already acknowledged by their
+    X-Batch-Id, and can fail a share of the requests, with an error status or by closing the connection after reading
+    the batch, to exercise retries and duplicates, and reject a share of them with a client error.
+    """
+
+    def __init__(self, address, output_path, fail_rate=0.0, drop_rate=0.0, reject_rate=0.0):
+        HTTPServer.__init__(self, address, UplinkRequestHandler)
+        self.output_path = output_path
+        self.fail_rate = fail_rate
+        self.drop_rate = drop_rate
+        self.reject_rate = reject_rate
+        self.batch_ids = set()
+        self.rows = 0
+        self.duplicates = 0
+
+
+class UplinkRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        if random.random() < self.server.fail_rate:
+            self.send_error(503, "Simulated failure")
+            return
+        if random.random() < self.server.reject_rate:
+            self.send_error(400, "Simulated rejection")
+            return
+
+        batch_id = self.headers.getheader('X-Batch-Id')
+        if batch_id in self.server.batch_ids:
+            self.server.duplicates += 1
+        else:
+            if self.headers.getheader('Content-Encoding') == 'gzip':
+                body = gzip.GzipFile(fileobj=StringIO(body)).read()
+            lines = body.splitlines(True)
+            with open(self.server.output_path, "a") as f:
+                f.writelines(lines[1:])
+            self.server.batch_ids.add(batch_id)
+            self.server.rows += len(lines) - 1
+
+        if random.random() < self.server.drop_rate:
+            # Received but never acknowledged: the uplink sends the batch again
+            self.close_connection = 1
+            return
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.info(format % args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Receive uplink batches and store their rows in a CSV file")
+    parser.add_argument("--port", dest="port", type=int, default=8080, help="specify port to listen on")
+    parser.add_argument("--output", dest="output_path", default="received.csv", help="specify CSV file of the rows")
+    parser.add_argument("--fail-rate", dest="fail_rate", type=float, default=0.0,
+                        help="specify share of the requests answered with 503")
+    parser.add_argument("--drop-rate", dest="drop_rate", type=float, default=0.0,
+                        help="specify share of the requests stored but never answered")
+    parser.add_argument("--reject-rate", dest="reject_rate", type=float, default=0.0,
+                        help="specify share of the requests answered with 400")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    UplinkReceiver(("", args.port), args.output_path, args.fail_rate, args.drop_rate,
+                   args.reject_rate).serve_forever()
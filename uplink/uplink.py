@@ -0,0 +1,198 @@
+import gzip
+import logging
+import os
+import random
+import urllib2
+from cStringIO import StringIO
+from threading import Thread
+from time import sleep, time
+
+from history import HistoryArchive, open_storage
+
+logger = logging.getLogger(__name__)
+
+# Client error statuses that are worth retrying: the request timed out, or the endpoint asks to slow down
+RETRIED_CLIENT_ERRORS = (408, 429)
+
+
+def is_rejected(error):
+    # Whether the endpoint refused a batch for good: a 4xx answer means sending the same request again cannot succeed
+    return isinstance(error, urllib2.HTTPError) and 400 <= error.code < 500 and error.code not in RETRIED_CLIENT_ERRORS
+
+
+class UplinkCursor(object):
+    """Time of the newest row the endpoint has acknowledged, kept in a small file that survives restarts"""
+
+    def __init__(self, path):
+        self.path = path
+        self.time = None
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                text = f.read().strip()
+            self.time = int(text) if text else None
+
+    def save(self, t):
+        # Write the new time aside and rename it over the old one, so a crash leaves either time behind
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("{}\n".format(t))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        self.time = t
+
+
+class Uplink(Thread):
+    """Background thread that forwards the committed history rows to an HTTP endpoint
+
+    The history itself is the store: the thread reads the rows newer than a persistent cursor, at most batch_rows at a
+    time, and POSTs them as a gzip-compressed CSV body. The cursor only moves once the endpoint has answered with a 2xx
+    status, so every row is delivered at least once; a batch that was received but not acknowledged is sent again, with
+    the same X-Batch-Id, so the endpoint can drop the duplicate. Failed uploads (network errors and 5xx answers) are
+    retried with exponential backoff and jitter. A batch refused with a 4xx answer would be refused again, so it is
+    written to the rejected directory instead, as it would have been sent, and the cursor moves past it, so that one
+    bad batch does not hold back the rows after it. Only one batch is held in memory, so the board can stay offline for
+    days: the backlog waits in the history, and rows older than the retention period are read from the archive.
+    """
+
+    def __init__(self, url, engine, database_name, value_columns, station, cursor_path=None, archive=None,
+                 batch_rows=1000, interval=60, timeout=30, min_backoff=5, max_backoff=3600, resolution=1,
+                 metrics=None, rejected_dir=None):
+        # Parent class constructor
+        Thread.__init__(self, name="Uplink")
+
+        self.url = url
+        self.engine = engine
+        self.database_name = database_name
+        self.value_columns = value_columns
+        self.station = station
+        self.cursor = UplinkCursor(database_name.rstrip("/") + ".uplink" if cursor_path is None else cursor_path)
+        self.rejected_dir = database_name.rstrip("/") + ".rejected" if rejected_dir is None else rejected_dir
+        self.archive = archive
+        self.batch_rows = batch_rows
+        self.interval = interval
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.resolution = resolution
+        self.metrics = metrics
+
+        # Number of failed uploads in a row
+        self.failures = 0
+
+    def read_batch(self, storage):
+        # Get the next rows to upload, oldest first. Rows moved to the archive since they were committed are read from
+        # there, and skipped in the storage in case the archiver was interrupted before deleting them.
+        start_time = 0 if self.cursor.time is None else self.cursor.time + 1
+        rows = []
+        if self.archive is not None:
+            # Rows older than the oldest row of the storage can only be in the archive
+            first_time = storage.get_first_time()
+            archive_end_time = first_time - 1 if first_time is not None else int(time() * self.resolution)
+            if start_time <= archive_end_time:
+                for row in self.archive.read_range(start_time, archive_end_time):
+                    rows.append(row)
+                    if len(rows) >= self.batch_rows:
+                        return rows
+                start_time = archive_end_time + 1
+
+        for row in storage.query(start_time, 2 ** 62):
+            rows.append(tuple(row))
+            if len(rows) >= self.batch_rows:
+                break
+        return rows
+
+    def encode_batch(self, rows):
+        # Encode rows as gzip-compressed CSV with a header line, in the format of the archive
+        buf = StringIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb") as writer:
+            writer.write(",".join(["time"] + list(self.value_columns)) + "\n")
+            for row in rows:
+                writer.write(HistoryArchive.encode_row(row))
+        return buf.getvalue()
+
+    def get_batch_id(self, rows):
+        return "{}-{}-{}".format(self.station, rows[0][0], rows[-1][0])
+
+    def post(self, body, rows):
+        # POST a batch, raising on anything but a 2xx answer
+        request = urllib2.Request(self.url, body, {
+            'Content-Type': 'text/csv',
+            'Content-Encoding': 'gzip',
+            'X-Station': self.station,
+            'X-Batch-Id': self.get_batch_id(rows),
+            'X-Time-Resolution': str(self.resolution)})
+        response = urllib2.urlopen(request, timeout=self.timeout)
+        try:
+            response.read()
+        finally:
+            response.close()
+
+    def upload_once(self, storage):
+        """Upload the next batch; returns the number of rows acknowledged, 0 if there was nothing to send"""
+        rows = self.read_batch(storage)
+        if len(rows) == 0:
+            return 0
+
+        body = self.encode_batch(rows)
+        try:
+            self.post(body, rows)
+        except urllib2.HTTPError as e:
+            if not is_rejected(e):
+                raise
+            self.set_aside(body, rows, e)
+            self.cursor.save(rows[-1][0])
+            if self.metrics is not None:
+                self.metrics.increment('uplink_rejected_rows', len(rows))
+            return len(rows)
+        self.cursor.save(rows[-1][0])
+
+        if self.metrics is not None:
+            self.metrics.increment('uplink_rows', len(rows))
+            self.metrics.increment('uplink_bytes', len(body))
+            self.metrics.set_gauge('uplink_lag_seconds', time() - float(rows[-1][0]) / self.resolution)
+        return len(rows)
+
+    def set_aside(self, body, rows, error):
+        # Keep a refused batch, as it was sent, in the rejected directory; it is on disk before the cursor moves past it
+        if not os.path.isdir(self.rejected_dir):
+            os.makedirs(self.rejected_dir)
+        path = os.path.join(self.rejected_dir, self.get_batch_id(rows) + ".csv.gz")
+        with open(path + ".tmp", "wb") as f:
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + ".tmp", path)
+        logger.error("History batch of {} rows from {} to {} rejected by {} with status {}, set aside in {}"
+                     .format(len(rows), rows[0][0], rows[-1][0], self.url, error.code, path))
+
+    def get_backoff(self):
+        # Exponential backoff with full jitter, so a fleet that lost the endpoint does not retry in lockstep
+        return random.uniform(self.min_backoff, min(self.max_backoff, self.min_backoff * 2 ** self.failures))
+
+    def run(self):
+        try:
+            storage = open_storage(self.engine, self.database_name, self.value_columns)
+        except Exception as e:
+            logger.error("Error opening the history storage {}, reason: {}".format(self.database_name, repr(e)))
+            return
+
+        while True:
+            try:
+                n = self.upload_once(storage)
+            except Exception as e:
+                # Network errors, and HTTPError for 5xx answers and the client errors worth retrying, are all retried
+                # the same way
+                self.failures += 1
+                backoff = self.get_backoff()
+                logger.warn("Error uploading history to {}, reason: {}, retrying in {:.0f} s"
+                            .format(self.url, repr(e), backoff))
+                if self.metrics is not None:
+                    self.metrics.increment('uplink_failures')
+                sleep(backoff)
+                continue
+
+            self.failures = 0
+            # Catch up without waiting while full batches are pending
+            if n < self.batch_rows:
+                sleep(self.interval)